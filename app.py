@@ -1,17 +1,55 @@
-from fastapi import FastAPI, Response, Header, status
+from fastapi import FastAPI, Request, Response, Header, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from typing import Union
 from typing_extensions import Annotated
 import uvicorn
 import os
+import json
+import socket
+import asyncio
+import importlib
+import threading
+import time
+from urllib.parse import urlparse
 from dotenv import load_dotenv
+from clients.lazy import lazyImport
 from main import Main
+from asyncmain import AsyncMain
+from database.mongodb import MongoDB
+from database.asyncmongodb import AsyncMongoDB
+from clients.asyncfeedly import AsyncFeedly
+from clients.feedlyauth import FeedlyManager
+from clients.ratelimit import RateLimiter
+from processing.cleaning import shutdownExecutor
+from processing.packing import getEncoding
+from cache.llmcache import LLMCache
+from cache.configcache import ConfigCache
+from jobs.jobqueue import JobQueue
+from monitoring.context import requestContext
+from monitoring.metrics import Metrics
+from monitoring.logs import configureLogging
+from monitoring.readiness import Readiness, warmUp
 import logging
 import traceback
 from pydantic import BaseModel
 
+bson = lazyImport('bson')
+
 class Insights(BaseModel):
   userId: str
   days: int = 1
+  cache: bool = True
+  background: bool = False
+  incremental: bool = False
+  fromStore: bool = False
+  stream: bool = False
+
+class Digest(BaseModel):
+  userId: str
+  days: int = 7
+  cache: bool = True
+  fromStore: bool = False
 
 class Post(BaseModel):
   userId: str
@@ -20,10 +58,28 @@ class Post(BaseModel):
   role: str = 'You are a marketing manager working for a consultancy called ProfessionalPulse.'
   post_prompt: str = ''
   image_prompt: str = f'Generate an image based on the following LinkedIn post:'
+  cache: bool = True
+  background: bool = False
+  stream: bool = False
+  pipelined: bool = False
 
 load_dotenv()
+configureLogging()
 app = FastAPI()
 
+@app.middleware("http")
+async def trackRequest(request: Request, call_next):
+  """
+  Process the request under the id sent in the X-Request-Id header, or a new one, and time it
+  """
+  with requestContext(request.headers.get('x-request-id')) as requestId:
+    started = time.perf_counter()
+    response = await call_next(request)
+    endpoint = request.scope.get('endpoint')
+    Metrics.getInstance().observe('marketing_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint.__name__ if endpoint is not None else 'none', method=request.method, status=response.status_code)
+    response.headers['X-Request-Id'] = requestId
+    return response
+
 def authoriseRequest(x_api_key):
    auth_api_key = os.getenv('AUTH_API_KEY')
    if auth_api_key == x_api_key:
@@ -31,37 +87,142 @@ def authoriseRequest(x_api_key):
    else:
       return False
 
+def formatInsightsResults(insights, failure="Could not insert insights in the database"):
+  """
+  Build the response body and status code from the per-folder insights results
+  """
+  if insights == "no-config-found":
+    return {
+      "status": "User config not found"
+    }, status.HTTP_404_NOT_FOUND
+
+  statuses = [result["status"] for result in insights]
+  if all(result_status == "no-articles-found" for result_status in statuses):
+    return {
+      "status": "No articles found",
+      "results": insights
+    }, status.HTTP_404_NOT_FOUND
+  if "OK" not in statuses:
+    return {
+      "status": failure,
+      "results": insights
+    }, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+  return {
+    "status": "OK",
+    "results": insights
+  }, status.HTTP_200_OK
+
+def formatPostResults(post):
+  """
+  Build the response body and status code from the LinkedIn post results
+  """
+  if post == "no-articles-found":
+    return {
+      "status": "No articles found"
+    }, status.HTTP_404_NOT_FOUND
+  elif post == "no-config-found":
+    return {
+      "status": "User config not found"
+    }, status.HTTP_404_NOT_FOUND
+  elif post == "post-failed":
+    return {
+      "status": "The post could not be saved to the database"
+    }, status.HTTP_500_INTERNAL_SERVER_ERROR
+  else:
+    return {
+      "status": "OK",
+      "results": {
+        "post": post[0],
+        "urls": post[1],
+        "image": post[2]
+      }
+    }, status.HTTP_200_OK
+
+def runInsights(params):
+  main = Main(useCache=params['cache'], incremental=params.get('incremental', False), fromStore=params.get('fromStore', False))
+  insights = main.generateInsights(userId=params['userId'], days=params['days'])
+  return formatInsightsResults(insights)
+
+def runLinkedInPost(params):
+  main = Main(useCache=params['cache'], pipelined=params.get('pipelined', False))
+  post = main.generateLinkedInPost(userId=params['userId'], days=params['days'], insightIds=params['insightIds'], prompt_role=params['role'], post_prompt=params['post_prompt'], image_prompt=params['image_prompt'])
+  return formatPostResults(post)
+
+def runDigest(params):
+  main = Main(useCache=params['cache'], fromStore=params.get('fromStore', False))
+  digest = main.generateDigest(userId=params['userId'], days=params['days'])
+  return formatInsightsResults(digest, failure="Could not generate the digest")
+
+async def runInsightsAsync(params):
+  main = AsyncMain(useCache=params['cache'], incremental=params.get('incremental', False), fromStore=params.get('fromStore', False))
+  insights = await main.generateInsights(userId=params['userId'], days=params['days'])
+  return formatInsightsResults(insights)
+
+async def runLinkedInPostAsync(params):
+  main = AsyncMain(useCache=params['cache'], pipelined=params.get('pipelined', False))
+  post = await main.generateLinkedInPost(userId=params['userId'], days=params['days'], insightIds=params['insightIds'], prompt_role=params['role'], post_prompt=params['post_prompt'], image_prompt=params['image_prompt'])
+  return formatPostResults(post)
+
+async def formatEvents(events):
+  """
+  Format the events of a generation as Server-Sent Events
+  """
+  try:
+    async for event, data in events:
+      yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+  except Exception as e:
+    logging.error(f'Error streaming events: \n{e}')
+    yield f'event: error\ndata: {json.dumps({"status": "error", "message": str(e)})}\n\n'
+
+def streamEvents(events):
+  return StreamingResponse(formatEvents(events), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def streamInsights(params):
+  main = AsyncMain(useCache=params['cache'], incremental=params.get('incremental', False), fromStore=params.get('fromStore', False))
+  return streamEvents(main.streamInsights(userId=params['userId'], days=params['days']))
+
+def streamLinkedInPost(params):
+  main = AsyncMain(useCache=params['cache'], pipelined=params.get('pipelined', False))
+  return streamEvents(main.streamLinkedInPost(userId=params['userId'], days=params['days'], insightIds=params['insightIds'], prompt_role=params['role'], post_prompt=params['post_prompt'], image_prompt=params['image_prompt']))
+
+def runJob(run):
+  def handler(params):
+    results, status_code = run(params)
+    return {
+      "statusCode": status_code,
+      "response": results
+    }
+  return handler
+
+jobQueue = JobQueue(handlers={
+  "insights": runJob(runInsights),
+  "linkedinpost": runJob(runLinkedInPost)
+})
+
+def submitJob(kind, params):
+  jobId = jobQueue.submit(kind, params)
+  if jobId is None:
+    return {
+      "status": "Busy",
+      "message": "Too many jobs are queued. Try again later."
+    }, status.HTTP_503_SERVICE_UNAVAILABLE
+  return {
+    "status": "Accepted",
+    "jobId": jobId
+  }, status.HTTP_202_ACCEPTED
+
 @app.post("/marketing/feedly/insights", status_code=status.HTTP_200_OK)
-def generateFeedlyInsights(insights: Insights, response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
+async def generateFeedlyInsights(insights: Insights, response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
   try: 
     if authoriseRequest(x_api_key):
-      main = Main()
-      insights = main.generateInsights(userId=insights.userId, days=insights.days)
-      results = None
-
-      if insights == "no-articles-found":
-        results = {
-          "status": "No articles found"
-        }
-        response.status_code = status.HTTP_404_NOT_FOUND
-      if insights == "no-config-found":
-        results = {
-          "status": "User config not found"
-        }
-        response.status_code = status.HTTP_404_NOT_FOUND
-      if insights == "insights-failed":
-        results = {
-          "status": "Could not insert insights in the database"
-        }
-        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+      params = dict(insights)
+      if insights.background:
+        results, response.status_code = await run_in_threadpool(submitJob, "insights", params)
+      elif insights.stream:
+        return streamInsights(params)
       else:
-        results = {
-          "status": "OK",
-          "results": {
-            "insights": insights[0] if insights is not None else "No insights.",
-            "urls": insights[1] if insights is not None else "No URLs."
-          }
-        }          
+        results, response.status_code = await runInsightsAsync(params)
 
       return results
     else:
@@ -82,37 +243,17 @@ def generateFeedlyInsights(insights: Insights, response: Response, x_api_key: An
     return error
 
 @app.post("/marketing/feedly/insights/linkedinpost", status_code=status.HTTP_200_OK)
-def generateFeedlyInsightsLinkedInPost(post: Post, response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
+async def generateFeedlyInsightsLinkedInPost(post: Post, response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
   logging.info(post)
   try: 
     if authoriseRequest(x_api_key):
-      main = Main()
-      post = main.generateLinkedInPost(userId=post.userId, days=post.days, insightIds=post.insightIds, prompt_role=post.role, post_prompt=post.post_prompt, image_prompt=post.image_prompt)
-
-      if post == "no-articles-found":
-        results = {
-          "status": "No articles found"
-        }
-        response.status_code = status.HTTP_404_NOT_FOUND
-      if post == "no-config-found":
-        results = {
-          "status": "User config not found"
-        }
-        response.status_code = status.HTTP_404_NOT_FOUND
-      if post == "post-failed":
-        results = {
-          "status": "The post could not be saved to the database"
-        }
-        response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+      params = dict(post)
+      if post.background:
+        results, response.status_code = await run_in_threadpool(submitJob, "linkedinpost", params)
+      elif post.stream:
+        return streamLinkedInPost(params)
       else:
-        results = {
-          "status": "OK",
-          "results": {
-            "post": post[0],
-            "urls": post[1],
-            "image": post[2]
-          }
-        }
+        results, response.status_code = await runLinkedInPostAsync(params)
 
       return results
     else:
@@ -131,16 +272,229 @@ def generateFeedlyInsightsLinkedInPost(post: Post, response: Response, x_api_key
     response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
     return error
 
+def isValidCursor(before):
+  timestamp, _, id = before.partition('_')
+  return timestamp.isdigit() and bson.ObjectId.is_valid(id)
+
+async def streamHistory(collection, userId, fields, limit, before):
+  """
+  Stream a page of the history of a user as it is read from the cursor, followed by the cursor of the next page
+  """
+  yield '{"status": "OK", "results": ['
+  count = 0
+  last = None
+  async for document in AsyncMongoDB().iterHistory(collection, userId=userId, fields=fields, limit=limit, before=before):
+    item = {"id": str(document['_id']), **{field: document.get(field) for field in fields}, "timestamp": document.get('timestamp')}
+    yield (',' if count > 0 else '') + json.dumps(item)
+    count += 1
+    last = document
+
+  next_cursor = f"{last['timestamp']}_{last['_id']}" if count == limit else None
+  yield f'], "next": {json.dumps(next_cursor)}}}'
+
+def getHistory(collection, fields, userId, limit, before, response, x_api_key):
+  if not authoriseRequest(x_api_key):
+    response.status_code = status.HTTP_401_UNAUTHORIZED
+    return {
+      "status": "Not Authorized",
+      "message": "You are not authorized to access this service."
+    }
+  if before is not None and not isValidCursor(before):
+    response.status_code = status.HTTP_400_BAD_REQUEST
+    return {
+      "status": "Invalid cursor"
+    }
+
+  limit = max(1, min(limit, int(os.getenv('HISTORY_MAX_LIMIT', 100))))
+  return StreamingResponse(streamHistory(collection, userId, fields, limit, before), media_type='application/json')
+
+@app.get("/marketing/feedly/insights/history", status_code=status.HTTP_200_OK)
+async def getInsightsHistory(userId: str, response: Response, limit: int = 20, before: Union[str, None] = None, x_api_key: Annotated[Union[str, None], Header()] = None):
+  return getHistory('insight', ["folder", "insights", "urls"], userId, limit, before, response, x_api_key)
+
+@app.get("/marketing/feedly/insights/linkedinpost/history", status_code=status.HTTP_200_OK)
+async def getLinkedInPostHistory(userId: str, response: Response, limit: int = 20, before: Union[str, None] = None, x_api_key: Annotated[Union[str, None], Header()] = None):
+  return getHistory('linkedin_post', ["insightIds", "post", "image", "urls"], userId, limit, before, response, x_api_key)
+
+@app.post("/marketing/feedly/insights/digest", status_code=status.HTTP_200_OK)
+async def generateInsightsDigest(digest: Digest, response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
+  try:
+    if not authoriseRequest(x_api_key):
+      response.status_code = status.HTTP_401_UNAUTHORIZED
+      return {
+        "status": "Not Authorized",
+        "message": "You are not authorized to access this service."
+      }
+    if digest.days < 1 or digest.days > int(os.getenv('DIGEST_MAX_DAYS', 92)):
+      response.status_code = status.HTTP_400_BAD_REQUEST
+      return {
+        "status": "Invalid number of days"
+      }
+
+    # The digest is mostly made of stored insights, so it runs on the synchronous pipeline in the thread pool
+    results, response.status_code = await run_in_threadpool(runDigest, dict(digest))
+    return results
+  except Exception as e:
+    error = {
+      "status": "Error",
+      "message": f"Error generating the digest: {e}"
+    }
+    logging.error(error)
+    response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    return error
+
+@app.get("/marketing/jobs/{jobId}", status_code=status.HTTP_200_OK)
+def getJob(jobId: str, response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
+  try:
+    if authoriseRequest(x_api_key):
+      job = jobQueue.getJob(jobId)
+      if job is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {
+          "status": "Job not found"
+        }
+
+      return {
+        "status": "OK",
+        "results": {
+          "jobId": str(job['_id']),
+          "kind": job['kind'],
+          "status": job['status'],
+          "result": job.get('result'),
+          "error": job.get('error'),
+          "createdAt": job.get('createdAt'),
+          "startedAt": job.get('startedAt'),
+          "finishedAt": job.get('finishedAt')
+        }
+      }
+    else:
+      response.status_code = status.HTTP_401_UNAUTHORIZED
+      return {
+        "status": "Not Authorized",
+        "message": "You are not authorized to access this service."
+      }
+  except Exception as e:
+    error = {
+      "status": "Error", 
+      "message": f"Error getting job {jobId}: {e}"
+    }
+    logging.error(error)
+    response.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    return error
+
+@app.delete("/marketing/config/cache", status_code=status.HTTP_200_OK)
+def invalidateConfigCache(response: Response, userId: Union[str, None] = None, x_api_key: Annotated[Union[str, None], Header()] = None):
+  if authoriseRequest(x_api_key):
+    return {
+      "status": "OK",
+      "results": {
+        "invalidated": ConfigCache.getInstance().invalidate(userId)
+      }
+    }
+  else:
+    response.status_code = status.HTTP_401_UNAUTHORIZED
+    return {
+      "status": "Not Authorized",
+      "message": "You are not authorized to access this service."
+    }
+
+def ensureIndexes():
+  try:
+    MongoDB().ensureIndexes()
+  except Exception as e:
+    logging.error(f'Could not ensure the MongoDB indexes: \n{e}')
+
+def loadTokenizer():
+  if getEncoding() is None:
+    raise Exception('Could not load the tokenizer, token counts are estimated')
+
+def importClients():
+  # The client libraries are imported lazily to keep the start-up short, so import them before the first request needs them
+  for module in ['openai', 'requests', 'aiohttp', 'numpy']:
+    importlib.import_module(module)
+
+def resolveHosts():
+  # Warm the resolver cache for the hosts every request talks to. The MongoDB SRV lookup is done by the client itself.
+  for url in [os.getenv('FEEDLY_API_URL', 'https://cloud.feedly.com'), os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')]:
+    socket.getaddrinfo(urlparse(url).hostname, 443, type=socket.SOCK_STREAM)
+
+async def pingAsyncMongoDB():
+  await AsyncMongoDB().ping()
+
+@app.on_event("startup")
+async def startWarmUp():
+  # Not awaited so that the server starts accepting requests, and reports it is not ready yet, while the process warms up
+  app.state.warmUp = asyncio.create_task(warmUp({
+    "tokenizer": loadTokenizer,
+    "imports": importClients,
+    "dns": resolveHosts,
+    "mongodb": lambda: MongoDB().ping(),
+    "asyncMongodb": pingAsyncMongoDB
+  }))
+
+@app.on_event("startup")
+def startup():
+  threading.Thread(target=ensureIndexes, name='mongodb-indexes', daemon=True).start()
+  jobQueue.start()
+  if os.getenv('CONFIG_CHANGE_STREAM', 'false').lower() == 'true':
+    ConfigCache.getInstance().startWatcher(MongoDB())
+
+@app.on_event("shutdown")
+async def shutdown():
+  await run_in_threadpool(jobQueue.stop)
+  await AsyncFeedly.closeSession()
+  FeedlyManager.getInstance().close()
+  AsyncMongoDB.closeClient()
+  MongoDB.closeClient()
+  shutdownExecutor()
+
+@app.get("/marketing/stats", status_code=status.HTTP_200_OK)
+def getStats(response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
+  if authoriseRequest(x_api_key):
+    return {
+      "status": "OK",
+      "results": {
+        "mongodb": MongoDB.poolStats(),
+        "asyncMongodb": AsyncMongoDB.poolStats(),
+        "llmCache": LLMCache.getInstance().stats() if LLMCache.getInstance() is not None else {"enabled": False},
+        "configCache": ConfigCache.getInstance().stats(),
+        "feedlyTokens": FeedlyManager.getInstance().stats(),
+        "jobs": jobQueue.stats(),
+        "rateLimits": RateLimiter.allStats()
+      }
+    }
+  else:
+    response.status_code = status.HTTP_401_UNAUTHORIZED
+    return {
+      "status": "Not Authorized",
+      "message": "You are not authorized to access this service."
+    }
+
+@app.get("/marketing/metrics", status_code=status.HTTP_200_OK)
+def getMetrics(response: Response, x_api_key: Annotated[Union[str, None], Header()] = None):
+  if authoriseRequest(x_api_key):
+    return PlainTextResponse(Metrics.getInstance().render(), media_type='text/plain; version=0.0.4')
+  else:
+    response.status_code = status.HTTP_401_UNAUTHORIZED
+    return {
+      "status": "Not Authorized",
+      "message": "You are not authorized to access this service."
+    }
+
 @app.get("/marketing/health", status_code=status.HTTP_200_OK)
-def checkHealth():
+def checkHealth(response: Response):
+  readiness = Readiness.getInstance()
   result = {
-    "status": "OK"
+    "status": "OK" if readiness.isReady() else "Starting",
+    "results": readiness.status()
   }
-  logging.info(result)
+  if not readiness.isReady():
+    response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+  logging.debug(result)
   return result
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
+    configureLogging()
     logging.info("Starting webserver...")
 
     try:
@@ -0,0 +1,585 @@
+import os
+import queue
+import asyncio
+import logging
+import itertools
+import threading
+import contextvars
+from datetime import datetime
+from itertools import islice
+from main import Main
+from database.asyncmongodb import AsyncMongoDB
+from clients.asyncfeedly import AsyncFeedly
+from clients.ratelimit import RateLimiter
+from clients.lazy import lazyImport
+from cache.configcache import ConfigCache
+from processing.packing import PromptPacker
+from processing.cleaning import cleanBatch
+from monitoring.metrics import span, atraceIter, imageCost
+
+openai = lazyImport('openai')
+
+END = object()
+
+async def asAsyncIterator(items):
+  if hasattr(items, '__aiter__'):
+    async for item in items:
+      yield item
+  else:
+    for item in items:
+      yield item
+
+async def iterInThread(source, pipeline, size=32):
+  """
+  Yield the results of a blocking pipeline, a function from an iterator of items to an iterator of results, run in a
+  worker thread over the items of an async iterator. Items and results go through bounded queues, so the pipeline
+  starts on the first items while the next ones are still arriving, and memory stays flat. The worker has its own
+  thread rather than one of the default executor, which it would hold for as long as the source keeps yielding.
+  """
+  loop = asyncio.get_running_loop()
+  inbox = queue.Queue()
+  outbox = asyncio.Queue()
+  # Items waiting for the pipeline, released by the worker, and results waiting for the consumer, released by the loop
+  inboxSlots = asyncio.Semaphore(size)
+  outboxSlots = threading.Semaphore(size)
+  stopped = threading.Event()
+
+  def post(callback, *args):
+    if not stopped.is_set():
+      loop.call_soon_threadsafe(callback, *args)
+
+  def items():
+    while True:
+      try:
+        item = inbox.get(timeout=0.1)
+      except queue.Empty:
+        if stopped.is_set():
+          return
+        continue
+      if item is END:
+        return
+      post(inboxSlots.release)
+      yield item
+
+  def run():
+    error = None
+    results = pipeline(items())
+    try:
+      for result in results:
+        # Waits for the consumer to catch up, unless it has stopped
+        while not outboxSlots.acquire(timeout=0.1):
+          if stopped.is_set():
+            return
+        post(outbox.put_nowait, (result, None))
+    except BaseException as e:
+      error = e
+    finally:
+      if hasattr(results, 'close'):
+        results.close()
+    post(outbox.put_nowait, (END, error))
+
+  async def feed():
+    async for item in asAsyncIterator(source):
+      await inboxSlots.acquire()
+      inbox.put(item)
+    inbox.put(END)
+
+  feeder = asyncio.ensure_future(feed())
+  context = contextvars.copy_context()
+  threading.Thread(target=context.run, args=(run,), name='pipeline', daemon=True).start()
+  try:
+    while True:
+      getter = asyncio.ensure_future(outbox.get())
+      # A failed source ends the pipeline, as no more items will arrive
+      await asyncio.wait([getter, feeder], return_when=asyncio.FIRST_COMPLETED)
+      if not getter.done():
+        if feeder.exception() is not None:
+          getter.cancel()
+          raise feeder.exception()
+        await getter
+      result, error = getter.result()
+      if result is END:
+        if error is not None:
+          raise error
+        return
+      outboxSlots.release()
+      yield result
+  finally:
+    stopped.set()
+    feeder.cancel()
+    await asyncio.gather(feeder, return_exceptions=True)
+
+class AsyncMain(Main):
+  """
+  Asynchronous variant of the API pipeline. Feedly, OpenAI and MongoDB are awaited instead of
+  blocking a thread, so a single worker can keep many generations in flight.
+  """
+  async def getConfig(self, userId):
+    logging.info(f'Get config for user {userId}')
+    self.mongo = AsyncMongoDB()
+    cache = ConfigCache.getInstance()
+    entry = cache.get(userId)
+    if entry is None:
+      config = await self.mongo.findConfigForUser(userId=userId)
+      if config is None:
+        return False
+      entry = cache.put(userId, config)
+
+    self.userId = userId
+    self.applyConfig(entry['config'], entry['clients'])
+    return True
+
+  def setupClients(self, clients=None):
+    if clients is not None and 'asyncfeedly' in clients:
+      self.feedly = clients['asyncfeedly']
+      return
+
+    logging.info('Setting up the async API clients...')
+    self.feedly = AsyncFeedly(self.getFeedlyCredentials(), self.FEEDLY_API_URL)
+    if clients is not None:
+      clients['asyncfeedly'] = self.feedly
+
+  async def callOpenAIChat(self, role, prompt):
+    with span('openai.chat', model=self.MODEL) as chat:
+      temperature = 0.2
+      key, cached = await asyncio.to_thread(self.readCache, 'chat', model=self.MODEL, temperature=temperature, role=role, prompt=prompt)
+      if cached is not None:
+        chat.set(cached=True)
+        return cached
+
+      limiter = RateLimiter.forKey('openai', self.OPENAI_API_KEY)
+      # Encoding a prompt of up to PROMPT_TOKEN_BUDGET tokens is CPU-bound, so it is kept off the event loop
+      promptTokens = await asyncio.to_thread(lambda: self.count_tokens(role) + self.count_tokens(prompt))
+      tokens = promptTokens + self.COMPLETION_TOKENS
+      response = await limiter.acall(lambda: openai.ChatCompletion.acreate(
+        api_key=self.OPENAI_API_KEY,
+        model=self.MODEL,
+        temperature=temperature,
+        n=1,
+        messages=[
+          {'role': 'system', 'content': role},
+          {'role': 'user', 'content': prompt}
+        ]
+      ), tokens=tokens)
+      limiter.settle(tokens, response.get('usage', {}).get('total_tokens'))
+      content = response['choices'][0]['message']['content']
+      usage = dict(response.get('usage') or {})
+      if not usage.get('completion_tokens'):
+        usage['completion_tokens'] = await asyncio.to_thread(self.count_tokens, content)
+      self.recordUsage(chat, role, prompt, content, dict(usage, prompt_tokens=usage.get('prompt_tokens') or promptTokens))
+
+      await asyncio.to_thread(self.writeCache, key, content, kind='chat')
+      return content
+
+  async def callOpenAIImage(self, prompt):
+    model = "dall-e-3"
+    size = "1024x1024"
+    quality = "standard"
+    with span('openai.image', model=model) as image:
+      key, cached = await asyncio.to_thread(self.readCache, 'image', model=model, size=size, quality=quality, prompt=prompt)
+      if cached is not None:
+        image.set(cached=True)
+        return cached
+
+      response = await RateLimiter.forKey('openai-image', self.OPENAI_API_KEY).acall(lambda: openai.Image.acreate(
+        api_key=self.OPENAI_API_KEY,
+        model=model,
+        prompt=prompt,
+        size=size,
+        quality=quality,
+        n=1,
+      ))
+      url = response.data[0].url
+      image.set(bytes=len(prompt.encode('utf-8')), cost=imageCost(model, quality, size))
+
+      await asyncio.to_thread(self.writeCache, key, url, kind='image')
+      return url
+
+  async def summariseArticles(self, article_prompts):
+    role = 'You are a research analyst.'
+    return await self.callOpenAIChat(role, self.buildSummaryPrompt(article_prompts))
+
+  async def condenseArticles(self, article_prompts, instructions=''):
+    """
+    Same as Main.condenseArticles. The article prompts, which can be an async iterator, are packed in a worker thread
+    as they arrive, and the first chunks are summarised while the remaining articles are still being fetched.
+    """
+    with span('prompt'):
+      packer = PromptPacker(self.PROMPT_TOKEN_BUDGET)
+      reserved = await asyncio.to_thread(self.count_tokens, instructions)
+      semaphore = asyncio.Semaphore(self.SUMMARY_WORKERS)
+      # Bounds the chunks waiting for a summary, which holds back the fetch when the summaries fall behind
+      slots = asyncio.Semaphore(self.SUMMARY_WORKERS * 2)
+      tasks = []
+      first = None
+
+      async def summarise(chunk):
+        async with semaphore:
+          return await self.summariseArticles(chunk)
+
+      async def start(chunk):
+        await slots.acquire()
+        task = asyncio.ensure_future(summarise(chunk))
+        task.add_done_callback(lambda task: slots.release())
+        tasks.append(task)
+
+      try:
+        # Counting the tokens of every article is CPU-bound, so packing is kept off the event loop
+        async for chunk in iterInThread(article_prompts, lambda prompts: packer.iterPack(prompts, reserved=reserved)):
+          if first is None:
+            first = chunk
+            continue
+          if not tasks:
+            await start(first)
+          await start(chunk)
+        if not tasks:
+          return ''.join(first) if first is not None else ''
+        logging.info(f'Summarising {len(tasks)} chunks of articles')
+        summaries = await asyncio.gather(*tasks)
+      except BaseException:
+        for task in tasks:
+          task.cancel()
+        raise
+
+      texts = [f'\n{summary}\n' for summary in summaries]
+      for attempt in itertools.count(2):
+        chunks = await asyncio.to_thread(packer.pack, texts, reserved=reserved)
+        if len(chunks) == 1:
+          return ''.join(chunks[0])
+        if len(chunks) >= len(texts):
+          return self.truncateChunks(chunks)
+
+        logging.info(f'Summarising {len(texts)} summaries in {len(chunks)} chunks (round {attempt})')
+        summaries = await asyncio.gather(*[summarise(chunk) for chunk in chunks])
+        texts = [f'\n{summary}\n' for summary in summaries]
+
+  async def processFolders(self, process):
+    folders = [folder_id for folder_id in self.FEEDLY_FOLDERS_LIST if folder_id != '']
+    semaphore = asyncio.Semaphore(max(1, self.FOLDER_WORKERS))
+
+    async def run(folder_id):
+      async with semaphore:
+        try:
+          return await process(folder_id)
+        except Exception as e:
+          logging.error(f'Error processing folder {folder_id}: \n{e}')
+          return {"folder": folder_id, "status": "error", "message": str(e)}
+
+    return list(await asyncio.gather(*[run(folder_id) for folder_id in folders]))
+
+  async def generateInsights(self, days, userId):
+    """
+    Generate insights from the articles of every folder
+    """
+    if await self.getConfig(userId):
+      return await self.processFolders(lambda folder_id: self.generateFolderInsights(userId=userId, folder_id=folder_id, days=days))
+    else:
+      return "no-config-found"
+
+  async def generateFolderInsights(self, userId, folder_id, days):
+    request = await self.prepareFolderInsights(folder_id=folder_id, days=days)
+    if request is None:
+      return {"folder": folder_id, "status": "no-articles-found"}
+
+    role, prompt, urls = request
+    insights = await self.callOpenAIChat(role, prompt)
+    return await self.saveFolderInsights(userId=userId, folder_id=folder_id, insights=insights, urls=urls)
+
+  async def prepareFolderInsights(self, folder_id, days):
+    """
+    Return the role, prompt and article URLs of the insights of a folder, or None if there are no articles
+    """
+    urls = []
+    role = 'You are a research analyst.'
+    articles = self.iterArticlePrompts(self.iterArticles(folder_id=folder_id, daysdelta=days), urls)
+    condensed = await self.condenseArticles(articles, instructions=role + self.buildInsightsPrompt(0))
+    if not urls:
+      logging.info(f'There are no articles to analyse for folder {folder_id}.')
+      return None
+
+    logging.info(f'Generating insights from {len(urls)} articles in folder: {folder_id}')
+    return role, self.buildInsightsPrompt(len(urls)) + condensed, urls
+
+  async def iterArticlePrompts(self, articles, urls, titles=None):
+    """
+    Yield the prompts of the articles, recording their URLs, and optionally their titles, as they stream past
+    """
+    async for article in articles:
+      urls.append(article['url'])
+      if titles is not None:
+        titles.append(article['title'])
+      yield next(self.buildArticlePrompts([article]))
+
+  async def saveFolderInsights(self, userId, folder_id, insights, urls):
+    since, until = self.windows.get(folder_id, (None, None))
+    insightId = await self.mongo.insertInsights(userId=userId, insights=insights, urls=urls, folder=folder_id, since=since, until=until)
+    if insightId:
+      await asyncio.to_thread(self.commitWatermark, folder_id)
+      return {"folder": folder_id, "status": "OK", "insightId": insightId, "insights": insights, "urls": urls}
+    else:
+      return {"folder": folder_id, "status": "insights-failed"}
+
+  async def generateLinkedInPost(self, userId, days, insightIds, prompt_role, post_prompt, image_prompt):
+    """
+    Generate a LinkedIn post from the articles
+    """
+    if await self.getConfig(userId=userId):
+      request = await self.prepareLinkedInPost(days=days, insightIds=insightIds, prompt_role=prompt_role, post_prompt=post_prompt)
+      if request is not None:
+        prompt, urls, subjects = request
+        imageTask = self.startImage(image_prompt, subjects)
+        try:
+          post = await self.callOpenAIChat(prompt_role, prompt)
+        except BaseException:
+          if imageTask is not None:
+            imageTask.cancel()
+          raise
+        result = await self.saveLinkedInPost(userId=userId, insightIds=insightIds, post=post, urls=urls, image_prompt=image_prompt, imageTask=imageTask)
+        if result != "post-failed":
+          await asyncio.to_thread(self.commitWatermark, self.FEEDLY_FOLDERS_LIST[0], 'linkedinpost')
+        return result
+      else:
+        return "no-articles-found"
+    else:
+      return "no-config-found"
+
+  async def prepareLinkedInPost(self, days, insightIds, prompt_role, post_prompt):
+    """
+    Return the prompt, source URLs and subjects of a LinkedIn post, from the insights if there are any or else
+    from the articles of the first folder, or None if there is nothing to write about
+    """
+    insights = []
+    urls = []
+
+    if len(insightIds) > 0:
+      for insight in await self.mongo.findInsightsByIds(insightIds):
+        insights.append(insight['insights'])
+        urls.append(insight['urls'])
+
+      if len(insights) > 0:
+        logging.info(f'Generating LinkedIn post from insights')
+        return self.buildInsightsPostPrompt(post_prompt, insights, urls), urls, insights
+    else:
+      titles = []
+      articles = self.iterArticles(folder_id=self.FEEDLY_FOLDERS_LIST[0], daysdelta=days, query=f'{post_prompt} {self.KEYWORDS}', flow='linkedinpost')
+      condensed = await self.condenseArticles(self.iterArticlePrompts(articles, urls, titles), instructions=prompt_role + self.buildArticlesPostPrompt(post_prompt, 0))
+      if urls:
+        logging.info(f'Generating LinkedIn post from {len(urls)} articles in folder: {self.FEEDLY_FOLDERS_LIST[0]}')
+        return self.buildArticlesPostPrompt(post_prompt, len(urls)) + condensed, urls, titles
+
+    return None
+
+  def startImage(self, image_prompt, subjects):
+    """
+    In pipelined mode, start generating the image from a brief of the post before the post is written
+    """
+    if not self.pipelined:
+      return None
+
+    async def generate():
+      brief = await asyncio.to_thread(self.buildImageBrief, subjects)
+      return await self.generateImage(f'{image_prompt} {brief}')
+    return asyncio.ensure_future(generate())
+
+  async def saveLinkedInPost(self, userId, insightIds, post, urls, image_prompt, imageTask=None):
+    if imageTask is None:
+      image, imagePath = await self.generateImage(f'{image_prompt} {post}')
+      if await self.mongo.insertPost(userId=userId, insightIds=insightIds, post=post, image=image, urls=urls, imagePath=imagePath):
+        return [post, urls, image]
+      else:
+        return "post-failed"
+
+    postId = await self.mongo.insertPost(userId=userId, insightIds=insightIds, post=post, image=None, urls=urls)
+    if not postId:
+      imageTask.cancel()
+      return "post-failed"
+    try:
+      image, imagePath = await imageTask
+    except Exception as e:
+      logging.error(f'Error generating the image of post {postId}: \n{e}')
+      return [post, urls, None]
+    await self.mongo.updatePostImage(postId, image=image, imagePath=imagePath)
+    return [post, urls, image]
+
+  async def generateImage(self, prompt):
+    image = await self.callOpenAIImage(prompt)
+    return image, await asyncio.to_thread(self.storeImage, image)
+
+  async def streamOpenAIChat(self, role, prompt):
+    """
+    Yield the completion in pieces as it is generated. The full completion is cached once the stream is complete.
+    """
+    with span('openai.chat', model=self.MODEL, stream=True) as chat:
+      temperature = 0.2
+      key, cached = await asyncio.to_thread(self.readCache, 'chat', model=self.MODEL, temperature=temperature, role=role, prompt=prompt)
+      if cached is not None:
+        chat.set(cached=True)
+        yield cached
+        return
+
+      limiter = RateLimiter.forKey('openai', self.OPENAI_API_KEY)
+      # Encoding a prompt of up to PROMPT_TOKEN_BUDGET tokens is CPU-bound, so it is kept off the event loop
+      promptTokens = await asyncio.to_thread(lambda: self.count_tokens(role) + self.count_tokens(prompt))
+      tokens = promptTokens + self.COMPLETION_TOKENS
+      # Only opening the stream is retried, as the pieces already sent cannot be taken back
+      stream = await limiter.acall(lambda: openai.ChatCompletion.acreate(
+        api_key=self.OPENAI_API_KEY,
+        model=self.MODEL,
+        temperature=temperature,
+        n=1,
+        stream=True,
+        messages=[
+          {'role': 'system', 'content': role},
+          {'role': 'user', 'content': prompt}
+        ]
+      ), tokens=tokens)
+
+      pieces = []
+      async for chunk in stream:
+        piece = chunk['choices'][0].get('delta', {}).get('content')
+        if piece:
+          pieces.append(piece)
+          yield piece
+
+      content = ''.join(pieces)
+      # Streamed completions do not report their usage
+      completionTokens = await asyncio.to_thread(self.count_tokens, content)
+      limiter.settle(tokens, promptTokens + completionTokens)
+      self.recordUsage(chat, role, prompt, content, {'prompt_tokens': promptTokens, 'completion_tokens': completionTokens})
+      await asyncio.to_thread(self.writeCache, key, content, kind='chat')
+
+  async def streamInsights(self, days, userId):
+    """
+    Yield the events of the generation of the insights of every folder: the tokens as they are generated
+    and the result of each folder once it is saved. The folders are processed concurrently.
+    """
+    if not await self.getConfig(userId):
+      yield 'error', {"status": "no-config-found"}
+      return
+
+    folders = [folder_id for folder_id in self.FEEDLY_FOLDERS_LIST if folder_id != '']
+    yield 'start', {"folders": folders}
+
+    events = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max(1, self.FOLDER_WORKERS))
+    results = []
+
+    async def run(folder_id):
+      async with semaphore:
+        try:
+          request = await self.prepareFolderInsights(folder_id=folder_id, days=days)
+          if request is None:
+            result = {"folder": folder_id, "status": "no-articles-found"}
+          else:
+            role, prompt, urls = request
+            await events.put(('folder', {"folder": folder_id, "articles": len(urls)}))
+            pieces = []
+            async for piece in self.streamOpenAIChat(role, prompt):
+              pieces.append(piece)
+              await events.put(('token', {"folder": folder_id, "content": piece}))
+            result = await self.saveFolderInsights(userId=userId, folder_id=folder_id, insights=''.join(pieces), urls=urls)
+        except Exception as e:
+          logging.error(f'Error processing folder {folder_id}: \n{e}')
+          result = {"folder": folder_id, "status": "error", "message": str(e)}
+        results.append(result)
+        await events.put(('result', result))
+
+    tasks = [asyncio.ensure_future(run(folder_id)) for folder_id in folders]
+    try:
+      for _ in range(len(folders)):
+        while True:
+          event = await events.get()
+          yield event
+          if event[0] == 'result':
+            break
+    finally:
+      for task in tasks:
+        task.cancel()
+
+    yield 'end', {"results": len(results)}
+
+  async def streamLinkedInPost(self, userId, days, insightIds, prompt_role, post_prompt, image_prompt):
+    """
+    Yield the events of the generation of a LinkedIn post: the tokens of the post as they are generated, then the saved post
+    """
+    if not await self.getConfig(userId=userId):
+      yield 'error', {"status": "no-config-found"}
+      return
+
+    request = await self.prepareLinkedInPost(days=days, insightIds=insightIds, prompt_role=prompt_role, post_prompt=post_prompt)
+    if request is None:
+      yield 'error', {"status": "no-articles-found"}
+      return
+
+    prompt, urls, subjects = request
+    yield 'start', {"urls": urls}
+    imageTask = self.startImage(image_prompt, subjects)
+    pieces = []
+    try:
+      async for piece in self.streamOpenAIChat(prompt_role, prompt):
+        pieces.append(piece)
+        yield 'token', {"content": piece}
+    except BaseException:
+      if imageTask is not None:
+        imageTask.cancel()
+      raise
+
+    result = await self.saveLinkedInPost(userId=userId, insightIds=insightIds, post=''.join(pieces), urls=urls, image_prompt=image_prompt, imageTask=imageTask)
+    if result == "post-failed":
+      yield 'error', {"status": result}
+    else:
+      await asyncio.to_thread(self.commitWatermark, self.FEEDLY_FOLDERS_LIST[0], 'linkedinpost')
+      yield 'result', {"post": result[0], "urls": result[1], "image": result[2]}
+    yield 'end', {}
+
+  async def iterArticles(self, folder_id, daysdelta, query=None, flow='insights'):
+    """
+    Yield the normalised articles of a folder without duplicates as they arrive, most relevant to the query first
+    """
+    since = await asyncio.to_thread(self.getSince, folder_id, daysdelta, flow)
+    self.windows[folder_id] = (since, int(datetime.now().timestamp() * 1000))
+    articles = atraceIter('articles', self.fetchArticles(folder_id, since), measure=self.measureArticle, folder=folder_id)
+    # Duplicates are removed in a worker thread as the articles arrive
+    async for article in iterInThread(articles, lambda articles: self.rankArticles(self.removeDuplicates(articles, since, folder_id), query)):
+      yield article
+
+  async def fetchArticles(self, folder_id, since):
+    if self.fromStore and self.store is not None:
+      logging.info(f'Getting articles for folder {folder_id} from the local store')
+      articles = self.store.iterArticles(folder_id, since)
+      # The store is read off the event loop, a batch of articles at a time
+      while batch := await asyncio.to_thread(lambda: list(islice(articles, 100))):
+        for article in batch:
+          yield article
+      return
+
+    logging.info(f'Getting articles for folder: {folder_id}')
+    batch_size = int(os.getenv('CLEANING_BATCH_SIZE', 32))
+    batch = []
+    async for entry in self.feedly.iterEntries(folder_id, newerThan=since):
+      batch.append(self.normaliseEntry(entry))
+      if len(batch) >= batch_size:
+        for article in await self.processBatch(folder_id, batch, since):
+          yield article
+        batch = []
+
+    if batch:
+      for article in await self.processBatch(folder_id, batch, since):
+        yield article
+
+  async def processBatch(self, folder_id, batch, since):
+    """
+    Clean a batch of articles, then save it to the local store, both off the event loop
+    """
+    articles = await asyncio.to_thread(cleanBatch, batch)
+    for article in articles:
+      self.watermarks[folder_id] = max(self.watermarks.get(folder_id, 0), article['timestamp'])
+    if self.store is not None:
+      await asyncio.to_thread(self.store.saveArticles, folder_id, articles)
+    return [article for article in articles if article['timestamp'] > since]
+
+  async def getArticles(self, folder_id, daysdelta, query=None, flow='insights'):
+    articles = [article async for article in self.iterArticles(folder_id=folder_id, daysdelta=daysdelta, query=query, flow=flow)]
+    if len(articles) == 0:
+      logging.info(f'There are no articles to analyse for folder {folder_id}.')
+    return articles
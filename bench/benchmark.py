@@ -0,0 +1,282 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from bench.fakeservers import FakeFeedly, FakeOpenAI
+from clients.smtpstub import LocalSMTPServer
+
+API_KEY = 'bench-api-key'
+# Metrics compared with the baseline, and whether a higher value is better
+COMPARED = {'p95Ms': False, 'p50Ms': False, 'throughput': True, 'peakMemoryMB': False, 'promptTokensPerRequest': False}
+
+class Benchmark():
+    """
+    Runs the insights and LinkedIn post flows of Main and of the API against local stand-ins for Feedly, OpenAI,
+    SMTP and MongoDB, and reports the latency percentiles, throughput, memory peak and tokens of each scenario.
+    Nothing leaves the machine, so runs are repeatable and can be compared with a saved baseline.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix='bench-')
+        self.feedly = FakeFeedly(articles=args.articles, words=args.words, latency=args.feedly_latency).start()
+        self.openai = FakeOpenAI(latency=args.openai_latency, tokens_per_second=args.tokens_per_second, completion_tokens=args.completion_tokens, image_latency=args.image_latency).start()
+        self.smtp = LocalSMTPServer().start()
+        self.configureEnvironment()
+
+        # Imported once the environment points at the stand-ins, as some settings are read at import time
+        import openai
+        from bench import memorymongo
+        openai.api_base = f'{self.openai.url}/v1'
+        self.mongo = memorymongo.install()
+        self.seedConfigs()
+        self.scenarios = {
+            'main-insights': self.mainInsights,
+            'main-linkedinpost': self.mainLinkedInPost,
+            'main-email': self.mainEmail,
+            'api-insights': self.apiRequest('POST', '/marketing/feedly/insights', lambda userId: {"userId": userId, "cache": False}),
+            'api-insights-stream': self.apiRequest('POST', '/marketing/feedly/insights', lambda userId: {"userId": userId, "cache": False, "stream": True}),
+            'api-linkedinpost': self.apiRequest('POST', '/marketing/feedly/insights/linkedinpost', lambda userId: {"userId": userId, "cache": False, "pipelined": self.args.pipelined}),
+            'api-history': self.apiRequest('GET', '/marketing/feedly/insights/history', lambda userId: {"userId": userId, "limit": 50})
+        }
+
+    def configureEnvironment(self):
+        os.environ.update({
+            'FEEDLY_API_URL': self.feedly.url,
+            'OPENAI_API_BASE': f'{self.openai.url}/v1',
+            'SMTP_HOST': '127.0.0.1',
+            'SMTP_PORT': str(self.smtp.port),
+            'SMTP_STARTTLS': 'false',
+            'AUTH_API_KEY': API_KEY,
+            'LLM_CACHE_PATH': os.path.join(self.workdir, 'llm_cache.sqlite'),
+            'ARTICLE_STORE_PATH': os.path.join(self.workdir, 'articles.sqlite'),
+            'DEDUP_INDEX_PATH': os.path.join(self.workdir, 'fingerprints.sqlite'),
+            'INCREMENTAL_FETCH': 'false',
+            'CONFIG_CHANGE_STREAM': 'false'
+        })
+        if not self.args.rate_limits:
+            # The stand-ins have no quota, so the client-side limits would only measure themselves
+            for prefix in ['OPENAI', 'OPENAI_IMAGE', 'FEEDLY']:
+                os.environ[f'{prefix}_REQUESTS_PER_MINUTE'] = '0'
+            os.environ['OPENAI_TOKENS_PER_MINUTE'] = '0'
+
+    def seedConfigs(self):
+        configs = self.mongo.get_database('InsightsAutomation').get_collection('config')
+        for user in range(self.args.users):
+            configs.insert_one({
+                "userId": f'bench-user-{user}',
+                "feedly": {
+                    "user": f'bench-user-{user}',
+                    "accessToken": f'bench-feedly-token-{user}',
+                    "folders": ', '.join(f'user/bench-user-{user}/category/folder-{folder}' for folder in range(self.args.folders))
+                },
+                "openai": {"apiKey": f'sk-bench-{user}'},
+                "google": {"emailUsername": 'bench@example.com', "emailPassword": 'bench', "emailRecipient": 'one@example.com, two@example.com'},
+                "keywords": ['automation', 'compliance']
+            })
+
+    def userId(self, request):
+        return f'bench-user-{request % self.args.users}'
+
+    def mainInsights(self, request):
+        from main import Main
+        results = Main(useCache=False).generateInsights(days=1, userId=self.userId(request))
+        return results != 'no-config-found' and all(result.get('status') in ['OK', 'no-articles-found'] for result in results)
+
+    def mainLinkedInPost(self, request):
+        from main import Main
+        result = Main(useCache=False, pipelined=self.args.pipelined).generateLinkedInPost(userId=self.userId(request), days=1, insightIds=[], prompt_role='You are a marketing manager.', post_prompt='', image_prompt='Generate an image based on the following LinkedIn post:')
+        return isinstance(result, list)
+
+    def mainEmail(self, request):
+        from main import Main
+        main = Main(useCache=False)
+        if not main.getConfig(self.userId(request)):
+            return False
+        return all(result.get('status') in ['OK', 'no-articles-found'] for result in main.emailInsights())
+
+    def apiRequest(self, method, path, body):
+        async def send(session, request):
+            params = body(self.userId(request))
+            kwargs = {"params": params} if method == 'GET' else {"json": params}
+            async with session.request(method, f'{self.apiUrl}{path}', headers={'x-api-key': API_KEY}, **kwargs) as response:
+                await response.read()
+                return response.status == 200
+        send.api = True
+        return send
+
+    def startApi(self):
+        """
+        Serve the API with uvicorn in a background thread, as it is run in production
+        """
+        import uvicorn
+        from app import app
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        self.apiServer = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+        threading.Thread(target=self.apiServer.run, name='bench-api', daemon=True).start()
+        while not self.apiServer.started:
+            time.sleep(0.05)
+        self.apiUrl = f'http://127.0.0.1:{port}'
+
+    def runThreads(self, scenario, requests):
+        latencies = [None] * requests
+        def run(request):
+            started = time.perf_counter()
+            try:
+                ok = scenario(request)
+            except Exception as e:
+                logging.error(f'Request {request} failed: {e}')
+                ok = False
+            latencies[request] = (time.perf_counter() - started, ok)
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            list(executor.map(run, range(requests)))
+        return latencies
+
+    def runApi(self, scenario, requests):
+        import aiohttp
+        async def runAll():
+            slots = asyncio.Semaphore(self.args.concurrency)
+            timeout = aiohttp.ClientTimeout(total=600)
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async def run(request):
+                    async with slots:
+                        started = time.perf_counter()
+                        try:
+                            ok = await scenario(session, request)
+                        except Exception as e:
+                            logging.error(f'Request {request} failed: {e}')
+                            ok = False
+                        return time.perf_counter() - started, ok
+                return await asyncio.gather(*[run(request) for request in range(requests)])
+        return asyncio.run(runAll())
+
+    def measure(self, name):
+        scenario = self.scenarios[name]
+        api = getattr(scenario, 'api', False)
+        if api and not hasattr(self, 'apiServer'):
+            self.startApi()
+        runner = self.runApi if api else self.runThreads
+
+        if self.args.warmup > 0:
+            runner(scenario, self.args.warmup)
+
+        before = self.openai.stats()
+        feedlyBefore = self.feedly.stats()
+        emailsBefore = len(self.smtp.messages)
+        # Tracing allocations slows Python code down, so latencies are only comparable between runs with the same setting
+        if self.args.trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        results = runner(scenario, self.args.requests)
+        elapsed = time.perf_counter() - started
+        peak = None
+        if self.args.trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        after = self.openai.stats()
+        feedlyAfter = self.feedly.stats()
+        used = lambda stats, start, counter: (stats.get(counter, 0) - start.get(counter, 0)) / len(results)
+        latencies = np.array([latency for latency, _ in results]) * 1000
+        return {
+            "requests": len(results),
+            "errors": sum(1 for _, ok in results if not ok),
+            "concurrency": self.args.concurrency,
+            "seconds": round(elapsed, 3),
+            "throughput": round(len(results) / elapsed, 3),
+            "p50Ms": round(float(np.percentile(latencies, 50)), 1),
+            "p90Ms": round(float(np.percentile(latencies, 90)), 1),
+            "p95Ms": round(float(np.percentile(latencies, 95)), 1),
+            "p99Ms": round(float(np.percentile(latencies, 99)), 1),
+            "maxMs": round(float(latencies.max()), 1),
+            "peakMemoryMB": round(peak / 1024 / 1024, 2) if peak is not None else None,
+            "chatCallsPerRequest": round(used(after, before, 'chatRequests'), 2),
+            "promptTokensPerRequest": round(used(after, before, 'promptTokens'), 1),
+            "completionTokensPerRequest": round(used(after, before, 'completionTokens'), 1),
+            "imagesPerRequest": round(used(after, before, 'imageRequests'), 2),
+            "feedlyRequestsPerRequest": round(used(feedlyAfter, feedlyBefore, 'streamRequests') + used(feedlyAfter, feedlyBefore, 'entriesRequests'), 2),
+            "emailsPerRequest": round((len(self.smtp.messages) - emailsBefore) / len(results), 2)
+        }
+
+    def run(self):
+        report = {
+            "settings": {key: value for key, value in vars(self.args).items() if key not in ['baseline', 'output']},
+            "scenarios": {}
+        }
+        for name in self.args.scenarios.split(','):
+            logging.warning(f'Running scenario {name}')
+            report["scenarios"][name] = self.measure(name)
+        if hasattr(self, 'apiServer'):
+            self.apiServer.should_exit = True
+        return report
+
+def compare(report, baseline, tolerance):
+    """
+    Return the metrics that are worse than the baseline by more than the tolerance
+    """
+    regressions = []
+    for name, metrics in report["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        for metric, higherIsBetter in COMPARED.items():
+            old, new = previous.get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higherIsBetter else change) > tolerance:
+                regressions.append(f'{name} {metric}: {old} -> {new} ({change:+.0%})')
+    return regressions
+
+def printReport(report):
+    columns = ['requests', 'errors', 'throughput', 'p50Ms', 'p95Ms', 'p99Ms', 'peakMemoryMB', 'chatCallsPerRequest', 'promptTokensPerRequest', 'completionTokensPerRequest']
+    print(f'{"scenario":<22}' + ''.join(f'{column:>{len(column) + 2}}' for column in columns))
+    for name, metrics in report["scenarios"].items():
+        print(f'{name:<22}' + ''.join(f'{metrics[column] if metrics[column] is not None else "-":>{len(column) + 2}}' for column in columns))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline against local stand-ins for Feedly, OpenAI, SMTP and MongoDB')
+    parser.add_argument('--scenarios', default='main-insights,api-insights', help='Comma-separated list of main-insights, main-linkedinpost, main-email, api-insights, api-insights-stream, api-linkedinpost and api-history')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=1, help='Requests sent before measuring each scenario')
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--folders', type=int, default=2, help='Folders per user')
+    parser.add_argument('--articles', type=int, default=50, help='Articles per folder')
+    parser.add_argument('--words', type=int, default=600, help='Words per article')
+    parser.add_argument('--feedly-latency', type=float, default=0.05, help='Seconds per Feedly request')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='Seconds before the first token of a completion')
+    parser.add_argument('--tokens-per-second', type=float, default=200, help='Generation rate of the completions')
+    parser.add_argument('--completion-tokens', type=int, default=300)
+    parser.add_argument('--image-latency', type=float, default=1.0, help='Seconds per generated image')
+    parser.add_argument('--pipelined', action='store_true', help='Generate the image of the LinkedIn posts in parallel with the post')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false', help='Do not trace the memory peak, which slows the code down')
+    parser.add_argument('--rate-limits', action='store_true', help='Keep the client-side rate limits')
+    parser.add_argument('--output', help='Write the report to this JSON file')
+    parser.add_argument('--baseline', help='Compare with a previous JSON report and exit with an error on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative change tolerated before a metric counts as a regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = Benchmark(args).run()
+    printReport(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        sys.exit(1 if regressions else 0)
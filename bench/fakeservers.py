@@ -0,0 +1,234 @@
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from processing.packing import countTokens
+
+WORDS = (
+    'automation workflow firms clients legal accounting process data model pipeline insight adoption regulation '
+    'efficiency teams operations risk compliance platform cloud analytics productivity strategy governance talent '
+    'market growth invoice contract review research knowledge agents language generative tools security vendor '
+    'budget partners practice billing document matter service delivery transformation digital outcome quality'
+).split()
+
+# Smallest valid PNG, served as the downloaded image
+PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082'
+)
+
+def sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize() + '.'
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    HTTP server running in a background thread that counts the requests it serves
+    """
+    daemon_threads = True
+
+    def __init__(self, handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, **amounts):
+        with self.lock:
+            for name, amount in amounts.items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def readJSON(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+
+    def sendBody(self, body, contentType='application/json', status=200):
+        data = json.dumps(body).encode('utf-8') if contentType == 'application/json' else body
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class FeedlyHandler(JSONHandler):
+    def authorised(self):
+        if self.headers.get('authorization', '').removeprefix('OAuth ') in self.server.revoked:
+            self.server.count(unauthorised=1)
+            self.sendBody({"errorMessage": "token expired"}, status=401)
+            return False
+        return True
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path != '/v3/streams/ids':
+            return self.sendBody({"errorMessage": "not found"}, status=404)
+
+        if not self.authorised():
+            return
+        time.sleep(server.latency)
+        query = parse_qs(url.query)
+        streamId = query['streamId'][0]
+        count = int(query.get('count', ['20'])[0])
+        start = int(query.get('continuation', ['0'])[0])
+        newerThan = int(query.get('newerThan', ['0'])[0])
+        # Entries are ordered newest first, so the stream ends at the first entry older than newerThan
+        ids = [f'{streamId}#{index}' for index in range(start, min(server.articles, start + count)) if server.crawled(index) > newerThan]
+        body = {"ids": ids}
+        if len(ids) == count and start + count < server.articles:
+            body["continuation"] = str(start + count)
+        server.count(streamRequests=1)
+        self.sendBody(body)
+
+    def do_POST(self):
+        server = self.server
+        path = urlparse(self.path).path
+        if path == '/v3/auth/token':
+            return self.refreshToken()
+        if path != '/v3/entries/.mget':
+            return self.sendBody({"errorMessage": "not found"}, status=404)
+        if not self.authorised():
+            return
+
+        time.sleep(server.latency)
+        ids = self.readJSON()
+        server.count(entriesRequests=1, entries=len(ids))
+        self.sendBody([server.entry(id) for id in ids])
+
+    def refreshToken(self):
+        server = self.server
+        request = self.readJSON()
+        if request.get('grant_type') != 'refresh_token' or not request.get('refresh_token'):
+            return self.sendBody({"errorMessage": "invalid grant"}, status=400)
+        server.count(tokenRefreshes=1)
+        self.sendBody({"access_token": f'bench-token-{server.stats()["tokenRefreshes"]}', "expires_in": server.expiresIn, "token_type": "Bearer"})
+
+class FakeFeedly(FakeServer):
+    """
+    Serves the /v3/streams/ids and /v3/entries/.mget endpoints with a fixed number of generated articles per stream,
+    one minute apart, newest first. The articles are generated from their id, so every run sees the same content.
+    /v3/auth/token issues new tokens valid for `expiresIn` seconds, and requests with a token added to `revoked` get a 401.
+    """
+    def __init__(self, articles=50, words=600, latency=0.05, expiresIn=604800):
+        super().__init__(FeedlyHandler)
+        self.articles = articles
+        self.words = words
+        self.latency = latency
+        self.expiresIn = expiresIn
+        self.revoked = set()
+        self.now = int(time.time() * 1000)
+
+    def crawled(self, index):
+        return self.now - index * 60000
+
+    def entry(self, id):
+        streamId, _, index = id.rpartition('#')
+        rng = random.Random(id)
+        folder = streamId.rsplit('/', 1)[-1]
+        paragraphs = [f'<p>{" ".join(sentence(rng, rng.randint(8, 20)) for _ in range(4))}</p>' for _ in range(max(1, self.words // 56))]
+        return {
+            "id": id,
+            "alternate": [{"href": f'https://news.example.com/{folder}/{index}-{rng.choice(WORDS)}', "type": "text/html"}],
+            "title": sentence(rng, 8)[:-1],
+            "summary": {"content": f'<p>{sentence(rng, 30)}</p>'},
+            "fullContent": f'<div><nav>Home | News</nav><script>track("{id}")</script>{"".join(paragraphs)}<footer>Subscribe</footer></div>',
+            "crawled": self.crawled(int(index))
+        }
+
+class OpenAIHandler(JSONHandler):
+    def do_POST(self):
+        server = self.server
+        path = urlparse(self.path).path
+        request = self.readJSON()
+        if path.endswith('/chat/completions'):
+            return self.chat(server, request)
+        if path.endswith('/images/generations'):
+            time.sleep(server.imageLatency)
+            server.count(imageRequests=1)
+            return self.sendBody({"created": int(time.time()), "data": [{"url": f'{server.url}/images/{server.nextImage()}.png'}]})
+        self.sendBody({"error": {"message": "not found", "type": "invalid_request_error"}}, status=404)
+
+    def do_GET(self):
+        if self.path.startswith('/images/'):
+            return self.sendBody(PNG, contentType='image/png')
+        self.sendBody({"error": {"message": "not found", "type": "invalid_request_error"}}, status=404)
+
+    def chat(self, server, request):
+        promptTokens = sum(countTokens(message['content']) for message in request['messages'])
+        pieces = server.completion()
+        server.count(chatRequests=1, promptTokens=promptTokens, completionTokens=len(pieces))
+        time.sleep(server.latency)
+
+        if not request.get('stream'):
+            time.sleep(len(pieces) / server.tokensPerSecond)
+            return self.sendBody({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request['model'],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ''.join(pieces)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": promptTokens, "completion_tokens": len(pieces), "total_tokens": promptTokens + len(pieces)}
+            })
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        # A few tokens per event, at the configured generation rate
+        for start in range(0, len(pieces), 5):
+            piece = ''.join(pieces[start:start + 5])
+            time.sleep(len(pieces[start:start + 5]) / server.tokensPerSecond)
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": request['model'], "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            self.wfile.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+
+class FakeOpenAI(FakeServer):
+    """
+    Serves the chat completion, streaming chat completion and image generation endpoints. A completion starts after
+    `latency` seconds and is generated at `tokens_per_second`. Set openai.api_base to f'{url}/v1' to use it.
+    """
+    def __init__(self, latency=0.3, tokens_per_second=80, completion_tokens=400, image_latency=2.0):
+        super().__init__(OpenAIHandler)
+        self.latency = latency
+        self.tokensPerSecond = tokens_per_second
+        self.completionTokens = completion_tokens
+        self.imageLatency = image_latency
+        self.images = 0
+
+    def nextImage(self):
+        with self.lock:
+            self.images += 1
+            return self.images
+
+    def completion(self):
+        """
+        Return the completion as one word per token
+        """
+        rng = random.Random(self.completionTokens)
+        return [f' {rng.choice(WORDS)}' for _ in range(self.completionTokens)]
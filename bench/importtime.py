@@ -0,0 +1,67 @@
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Client libraries only imported when first used, see clients/lazy.py
+DEFERRED = ['openai', 'tiktoken', 'requests', 'numpy', 'aiohttp', 'pymongo', 'motor']
+
+def measure(module):
+    """
+    Import a module in a fresh interpreter with -X importtime, and return the cumulative import time
+    in milliseconds of every module it imported, in import order
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Could not import {module}:\n{result.stderr}')
+
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # The nesting of an import is shown by the indentation of its name
+        modules.append((name.strip(), int(cumulative) / 1000, len(name) - len(name.lstrip()) == 1))
+    return modules
+
+def report(module, runs, top):
+    samples = [measure(module) for _ in range(runs)]
+    totals = [sum(cumulative for _, cumulative, topLevel in modules if topLevel) for modules in samples]
+    # The run closest to the median total is reported, so one slow run does not skew the breakdown
+    median = statistics.median(totals)
+    modules = samples[min(range(runs), key=lambda index: abs(totals[index] - median))]
+    imported = {name for name, _, _ in modules}
+    return {
+        "module": module,
+        "runs": runs,
+        "totalMs": round(median, 1),
+        "minMs": round(min(totals), 1),
+        "maxMs": round(max(totals), 1),
+        "top": [{"module": name, "cumulativeMs": round(cumulative, 1)} for name, cumulative, _ in sorted(modules, key=lambda module: -module[1])[:top]],
+        "deferredImported": [name for name in DEFERRED if name in imported]
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the import time of the application in fresh interpreters')
+    parser.add_argument('--module', default='app', help='Module to import')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest modules to list')
+    parser.add_argument('--budget', type=float, help='Exit with an error when the median import time in milliseconds exceeds this budget')
+    parser.add_argument('--output', help='Write the report to this JSON file')
+    args = parser.parse_args()
+
+    result = report(args.module, args.runs, args.top)
+    print(f'import {result["module"]}: {result["totalMs"]}ms median of {result["runs"]} runs ({result["minMs"]}-{result["maxMs"]}ms)')
+    for module in result["top"]:
+        print(f'{module["cumulativeMs"]:>10.1f}ms  {module["module"]}')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    failures = [f'{name} is imported at start-up' for name in result["deferredImported"]]
+    if args.budget is not None and result["totalMs"] > args.budget:
+        failures.append(f'{result["totalMs"]}ms exceeds the budget of {args.budget}ms')
+    for failure in failures:
+        print(f'Over budget: {failure}')
+    sys.exit(1 if failures else 0)
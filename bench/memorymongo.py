@@ -0,0 +1,287 @@
+import copy
+import threading
+from types import SimpleNamespace
+from pymongo.collection import ObjectId
+from database.mongodb import MongoDB
+from database.asyncmongodb import AsyncMongoDB
+
+MISSING = object()
+
+def getField(document, path):
+    """
+    Return the value at a dotted path, or the values of the matching elements when the path goes through a list
+    """
+    value = document
+    for part in path.split('.'):
+        if isinstance(value, list):
+            values = [item.get(part, MISSING) for item in value if isinstance(item, dict)]
+            return [item for item in values if item is not MISSING] or MISSING
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+def compare(value, operator, operand):
+    if value is MISSING:
+        return operator == '$in' and None in operand
+    candidates = value if isinstance(value, list) else [value]
+    if operator == '$in':
+        return any(candidate in operand for candidate in candidates)
+    # Like MongoDB, range operators do not match null values
+    candidates = [candidate for candidate in candidates if candidate is not None] if operator != '$ne' else candidates
+    if operator == '$lt':
+        return any(candidate < operand for candidate in candidates)
+    if operator == '$lte':
+        return any(candidate <= operand for candidate in candidates)
+    if operator == '$gt':
+        return any(candidate > operand for candidate in candidates)
+    if operator == '$gte':
+        return any(candidate >= operand for candidate in candidates)
+    if operator == '$ne':
+        return operand not in candidates
+    raise NotImplementedError(f'Unsupported query operator: {operator}')
+
+def matchesOperator(value, operator, operand):
+    if operator == '$not':
+        return not all(compare(value, inner, innerOperand) for inner, innerOperand in operand.items())
+    return compare(value, operator, operand)
+
+def matches(document, query):
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(document, clause) for clause in condition):
+                return False
+            continue
+        value = getField(document, key)
+        if isinstance(condition, dict) and condition and all(operator.startswith('$') for operator in condition):
+            if not all(matchesOperator(value, operator, operand) for operator, operand in condition.items()):
+                return False
+        elif value is MISSING or (value != condition and not (isinstance(value, list) and condition in value)):
+            return False
+    return True
+
+def project(document, projection):
+    if not projection:
+        return copy.deepcopy(document)
+    projected = {"_id": document["_id"]} if projection.get("_id", 1) else {}
+    for path, include in projection.items():
+        if not include or path == '_id':
+            continue
+        source, target = document, projected
+        parts = path.split('.')
+        for part in parts[:-1]:
+            if not isinstance(source, dict) or part not in source:
+                break
+            source = source[part]
+            target = target.setdefault(part, {})
+        else:
+            if isinstance(source, dict) and parts[-1] in source:
+                target[parts[-1]] = copy.deepcopy(source[parts[-1]])
+    return projected
+
+def sortKey(document, field):
+    value = getField(document, field)
+    # Missing values sort first, as in MongoDB
+    return (0, None) if value is MISSING or value is None else (1, value)
+
+class Cursor():
+    def __init__(self, documents, projection):
+        self.documents = documents
+        self.projection = projection
+        self.limitCount = 0
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        # Sorting by the least significant key first keeps the order of the more significant ones
+        for field, order in reversed(keys):
+            self.documents.sort(key=lambda document: sortKey(document, field), reverse=order < 0)
+        return self
+
+    def limit(self, count):
+        self.limitCount = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def results(self):
+        documents = self.documents[:self.limitCount] if self.limitCount > 0 else self.documents
+        return [project(document, self.projection) for document in documents]
+
+    def __iter__(self):
+        return iter(self.results())
+
+    def __aiter__(self):
+        return self.aiterate()
+
+    async def aiterate(self):
+        for document in self.results():
+            yield document
+
+class Collection():
+    """
+    Subset of the pymongo collection API used by the MongoDB classes, kept in memory
+    """
+    def __init__(self, name):
+        self.name = name
+        self.documents = []
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def find(self, query=None, projection=None):
+        with self.lock:
+            return Cursor([document for document in self.documents if matches(document, query or {})], projection)
+
+    def find_one(self, query=None, projection=None, sort=None):
+        cursor = self.find(query, projection)
+        if sort:
+            cursor.sort(sort)
+        return next(iter(cursor.limit(1)), None)
+
+    def insert_one(self, document):
+        document.setdefault("_id", ObjectId())
+        with self.lock:
+            self.documents.append(copy.deepcopy(document))
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    def insert_many(self, documents):
+        return SimpleNamespace(inserted_ids=[self.insert_one(document).inserted_id for document in documents])
+
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            for document in self.documents:
+                if matches(document, query):
+                    self.apply(document, query, update)
+                    return SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+        if upsert:
+            document = {key: value for key, value in query.items() if not key.startswith('$') and not isinstance(value, dict)}
+            self.apply(document, query, update)
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=self.insert_one(document).inserted_id)
+        return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+
+    def find_one_and_update(self, query, update, return_document=False):
+        with self.lock:
+            for document in self.documents:
+                if matches(document, query):
+                    before = copy.deepcopy(document)
+                    self.apply(document, query, update)
+                    # ReturnDocument.AFTER is True
+                    return copy.deepcopy(document) if return_document else before
+        return None
+
+    def apply(self, document, query, update):
+        for path, value in update.get('$set', {}).items():
+            parts = path.split('.')
+            target = document
+            for index, part in enumerate(parts[:-1]):
+                if part == '$':
+                    # Positional operator: the first element of the array matched by the query
+                    field = '.'.join(parts[:index])
+                    condition = {key[len(field) + 1:]: operand for key, operand in query.items() if key.startswith(f'{field}.')}
+                    target = next(item for item in target if matches(item, condition))
+                else:
+                    target = target.setdefault(part, {})
+            target[parts[-1]] = copy.deepcopy(value)
+
+    def count_documents(self, query):
+        with self.lock:
+            return sum(1 for document in self.documents if matches(document, query))
+
+    def create_index(self, keys, name=None, **kwargs):
+        name = name or '_'.join(f'{field}_{order}' for field, order in keys)
+        self.indexes[name] = keys
+        return name
+
+class Database():
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def get_collection(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = Collection(name)
+            return self.collections[name]
+
+class Admin():
+    def command(self, name, *args, **kwargs):
+        return {"ok": 1.0}
+
+class MemoryClient():
+    """
+    In-memory stand-in for MongoClient, shared by the synchronous and asynchronous MongoDB classes
+    """
+    def __init__(self):
+        self.databases = {}
+        self.lock = threading.Lock()
+        self.admin = Admin()
+
+    def get_database(self, name):
+        with self.lock:
+            if name not in self.databases:
+                self.databases[name] = Database()
+            return self.databases[name]
+
+    def close(self):
+        pass
+
+class AsyncCollection():
+    """
+    Motor-style wrapper: the same collection, with awaitable methods and async cursors
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, query=None, projection=None):
+        return self.collection.find(query, projection)
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+    async def insert_one(self, document):
+        return self.collection.insert_one(document)
+
+    async def update_one(self, *args, **kwargs):
+        return self.collection.update_one(*args, **kwargs)
+
+    async def count_documents(self, query):
+        return self.collection.count_documents(query)
+
+    async def create_index(self, *args, **kwargs):
+        return self.collection.create_index(*args, **kwargs)
+
+class AsyncDatabase():
+    def __init__(self, database):
+        self.database = database
+
+    def get_collection(self, name):
+        return AsyncCollection(self.database.get_collection(name))
+
+class AsyncAdmin():
+    async def command(self, name, *args, **kwargs):
+        return {"ok": 1.0}
+
+class AsyncMemoryClient():
+    def __init__(self, client):
+        self.client = client
+        self.admin = AsyncAdmin()
+
+    def get_database(self, name):
+        return AsyncDatabase(self.client.get_database(name))
+
+    def close(self):
+        pass
+
+def install(client=None):
+    """
+    Point MongoDB and AsyncMongoDB at an in-memory client for the rest of the process, and return it
+    """
+    client = client or MemoryClient()
+    asyncClient = AsyncMemoryClient(client)
+    MongoDB.getClient = classmethod(lambda cls: client)
+    MongoDB.closeClient = classmethod(lambda cls: None)
+    MongoDB.poolStats = classmethod(lambda cls: {"connected": True, "inMemory": True})
+    AsyncMongoDB.getClient = classmethod(lambda cls: asyncClient)
+    AsyncMongoDB.closeClient = classmethod(lambda cls: None)
+    AsyncMongoDB.poolStats = classmethod(lambda cls: {"connected": True, "inMemory": True})
+    return client
@@ -0,0 +1,122 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+class ConfigCache():
+    """
+    In-process LRU cache of the user config documents with a TTL. Each entry also holds the API clients
+    built from the config so that repeated requests for the same user can reuse them.
+    """
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    def __init__(self, ttl=None, size=None):
+        self.ttl = int(ttl if ttl is not None else os.getenv('CONFIG_CACHE_TTL', 300))
+        self.size = int(size if size is not None else os.getenv('CONFIG_CACHE_SIZE', 256))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.watcher = None
+
+    @classmethod
+    def getInstance(cls):
+        if cls._instance is None:
+            with cls._instanceLock:
+                if cls._instance is None:
+                    cls._instance = ConfigCache()
+        return cls._instance
+
+    def get(self, userId):
+        """
+        Return the cached entry of the user, with its config and clients, or None
+        """
+        with self.lock:
+            entry = self.entries.get(userId)
+            if entry is not None and time.monotonic() - entry['cached'] > self.ttl:
+                del self.entries[userId]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(userId)
+            self.hits += 1
+            return entry
+
+    def put(self, userId, config):
+        entry = {
+            "config": config,
+            "clients": {},
+            "cached": time.monotonic()
+        }
+        with self.lock:
+            self.entries[userId] = entry
+            self.entries.move_to_end(userId)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, userId=None):
+        """
+        Remove the entry of a user, or every entry if no user is given
+        """
+        with self.lock:
+            if userId is None:
+                count = len(self.entries)
+                self.entries.clear()
+            else:
+                count = 1 if self.entries.pop(userId, None) is not None else 0
+        logging.info(f'Invalidated {count} cached config(s)')
+        return count
+
+    def invalidateDocument(self, documentId):
+        """
+        Remove the entry whose config document has the given _id
+        """
+        with self.lock:
+            userIds = [userId for userId, entry in self.entries.items() if entry['config'].get('_id') == documentId]
+        for userId in userIds:
+            self.invalidate(userId)
+        return len(userIds)
+
+    def startWatcher(self, mongo):
+        """
+        Invalidate the cached configs when the config collection changes. Requires a replica set, such as MongoDB Atlas.
+        """
+        if self.watcher is not None:
+            return
+
+        def watch():
+            try:
+                with mongo.watchConfig() as stream:
+                    for change in stream:
+                        document = change.get('fullDocument') or {}
+                        if 'userId' in document:
+                            self.invalidate(document['userId'])
+                        elif self.invalidateDocument(change['documentKey']['_id']) == 0 and change['operationType'] not in ['insert', 'delete']:
+                            self.invalidate()
+            except Exception as e:
+                logging.error(f'Config change stream stopped: \n{e}')
+            finally:
+                self.watcher = None
+
+        self.watcher = threading.Thread(target=watch, name='config-watcher', daemon=True)
+        self.watcher.start()
+        logging.info('Watching the config collection for changes')
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": round(self.hits / lookups, 4) if lookups > 0 else 0.0,
+                "entries": len(self.entries),
+                "size": self.size,
+                "ttl": self.ttl,
+                "watching": self.watcher is not None
+            }
@@ -0,0 +1,129 @@
+import os
+import time
+import json
+import hashlib
+import logging
+import sqlite3
+import threading
+
+class LLMCache():
+    """
+    Content-addressed cache of OpenAI responses backed by a local SQLite database
+    """
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    def __init__(self, path=None, ttl=None, image_ttl=None, max_bytes=None):
+        self.path = path or os.getenv('LLM_CACHE_PATH', '.cache/llm_cache.sqlite')
+        self.ttl = int(ttl if ttl is not None else os.getenv('LLM_CACHE_TTL', 7 * 24 * 3600))
+        # DALL-E image URLs expire after an hour, so they cannot be cached for as long as text
+        self.image_ttl = int(image_ttl if image_ttl is not None else os.getenv('LLM_CACHE_IMAGE_TTL', 3000))
+        self.max_bytes = int(max_bytes if max_bytes is not None else os.getenv('LLM_CACHE_MAX_BYTES', 100 * 1024 * 1024))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        ''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.connection.commit()
+
+    @classmethod
+    def getInstance(cls):
+        """
+        Return the process-wide cache, or None if caching is disabled
+        """
+        if os.getenv('LLM_CACHE_ENABLED', 'true').lower() != 'true':
+            return None
+        if cls._instance is None:
+            with cls._instanceLock:
+                if cls._instance is None:
+                    cls._instance = LLMCache()
+        return cls._instance
+
+    @staticmethod
+    def makeKey(kind, **params):
+        payload = json.dumps({"kind": kind, **params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key, kind='chat'):
+        ttl = self.image_ttl if kind == 'image' else self.ttl
+        now = time.time()
+
+        with self.lock:
+            row = self.connection.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and now - row[1] > ttl:
+                self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.connection.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value, kind='chat'):
+        now = time.time()
+        size = len(value.encode('utf-8'))
+
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (key, kind, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, kind, value, size, now, now)
+            )
+            self.evict(now)
+            self.connection.commit()
+
+    def evict(self, now):
+        """
+        Remove expired entries, then the least recently used ones until the cache fits in max_bytes
+        """
+        self.connection.execute('DELETE FROM responses WHERE kind = ? AND created < ?', ('image', now - self.image_ttl))
+        self.connection.execute('DELETE FROM responses WHERE kind != ? AND created < ?', ('image', now - self.ttl))
+
+        total = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evicted = 0
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed ASC').fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        logging.info(f'Evicted {evicted} entries from the LLM cache')
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM responses')
+            self.connection.commit()
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": round(self.hits / lookups, 4) if lookups > 0 else 0.0,
+                "entries": entries,
+                "bytes": size,
+                "maxBytes": self.max_bytes
+            }
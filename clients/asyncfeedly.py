@@ -0,0 +1,127 @@
+import os
+import json
+import logging
+import asyncio
+from collections import deque
+from clients.ratelimit import RateLimiter, RetryableError, raiseForRetry
+from clients.lazy import lazyImport
+
+aiohttp = lazyImport('aiohttp')
+
+class AsyncFeedly():
+    """
+    Asynchronous Feedly client. The underlying aiohttp session, and its pool of keep-alive
+    connections, is shared by every client created in the same event loop.
+    """
+    _session = None
+    _sessionLoop = None
+
+    def __init__(self, credentials, apiUrl):
+        self.apiUrl = apiUrl
+        self.credentials = credentials
+        self.limiter = RateLimiter.forKey('feedly', credentials.key)
+        self.pageSize = int(os.getenv('FEEDLY_PAGE_SIZE', 250))
+        self.batchSize = int(os.getenv('FEEDLY_MGET_BATCH_SIZE', 100))
+        self.concurrency = int(os.getenv('FEEDLY_MGET_CONCURRENCY', 4))
+        self.maxArticles = int(os.getenv('FEEDLY_MAX_ARTICLES', 1000))
+
+    @classmethod
+    def getSession(cls):
+        loop = asyncio.get_running_loop()
+        if cls._session is None or cls._session.closed or cls._sessionLoop is not loop:
+            cls._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=int(os.getenv('FEEDLY_MAX_CONNECTIONS', 20))),
+                timeout=aiohttp.ClientTimeout(total=int(os.getenv('FEEDLY_TIMEOUT', 60)))
+            )
+            cls._sessionLoop = loop
+        return cls._session
+
+    @classmethod
+    async def closeSession(cls):
+        if cls._session is not None and not cls._session.closed:
+            await cls._session.close()
+        cls._session = None
+        cls._sessionLoop = None
+
+    async def iterStreamIds(self, folder_id, newerThan):
+        """
+        Yield pages of entry ids, following the continuation token until the stream is exhausted
+        """
+        continuation = None
+        total = 0
+        while total < self.maxArticles:
+            params = {'streamId': folder_id, 'newerThan': newerThan, 'count': min(self.pageSize, self.maxArticles - total)}
+            if continuation is not None:
+                params['continuation'] = continuation
+
+            feedly_url = f'{self.apiUrl}/v3/streams/ids'
+            logging.info(f'Getting articles with Feedly URL: {feedly_url} and parameters: {params}')
+            try:
+                status, text = await self.request('GET', feedly_url, params=params)
+            except RetryableError as e:
+                logging.warning(f'Could not get articles: {e}')
+                return
+            if status != 200:
+                logging.warning(f'Could not get articles with status code: {status}. Details: \n{text}')
+                return
+            page = json.loads(text)
+
+            ids = page.get('ids', [])
+            total += len(ids)
+            logging.info(f'Retrieved {len(ids)} article ids ({total} in total).')
+            if ids:
+                yield ids
+
+            continuation = page.get('continuation')
+            if continuation is None or not ids:
+                return
+
+    async def request(self, method, url, **kwargs):
+        """
+        Send a request through the rate limiter of the access token, retrying 429 and 5xx responses.
+        A rejected token is refreshed and the request sent once more. Returns the status code and the body.
+        """
+        async def send(refreshed=False):
+            token = await self.token()
+            async with self.getSession().request(method, url, headers={'authorization': f'OAuth {token}'}, **kwargs) as response:
+                text = await response.text()
+                status = response.status
+                raiseForRetry(status, response.headers, text)
+            if status == 401 and not refreshed and await asyncio.to_thread(self.credentials.refresh, token):
+                return await send(refreshed=True)
+            return status, text
+        return await self.limiter.acall(send)
+
+    async def token(self):
+        # Refreshing an expired token blocks, so it is done in a thread. Tokens close to their expiry are refreshed in the background.
+        if self.credentials.hasExpired():
+            return await asyncio.to_thread(self.credentials.token)
+        return self.credentials.token()
+
+    async def getEntries(self, ids):
+        feedly_entries_url = f'{self.apiUrl}/v3/entries/.mget'
+        status, text = await self.request('POST', feedly_entries_url, json=ids)
+        if status != 200:
+            raise Exception(f'Could not get entries with status code: {status}. Details: \n{text}')
+        return json.loads(text)
+
+    async def iterEntries(self, folder_id, newerThan):
+        """
+        Yield the entries of a stream one at a time, fetching batches of ids concurrently as the pages arrive
+        """
+        pending = deque()
+        try:
+            async for ids in self.iterStreamIds(folder_id, newerThan):
+                for start in range(0, len(ids), self.batchSize):
+                    pending.append(asyncio.ensure_future(self.getEntries(ids[start:start + self.batchSize])))
+
+                    while len(pending) >= self.concurrency:
+                        for entry in await pending.popleft():
+                            yield entry
+
+            while pending:
+                for entry in await pending.popleft():
+                    yield entry
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,93 @@
+import os
+import json
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from clients.ratelimit import RateLimiter, RetryableError, raiseForRetry
+
+class Feedly():
+    """
+    Feedly client that pages through the ids of a stream and fetches their entries in bounded, concurrent batches
+    """
+    def __init__(self, session, apiUrl, limiter=None, credentials=None):
+        self.session = session
+        self.apiUrl = apiUrl
+        # Without credentials, the authorization header of the session is used
+        self.credentials = credentials
+        self.limiter = limiter if limiter is not None else RateLimiter.forKey('feedly', credentials.key if credentials is not None else session.headers.get('authorization'))
+        self.pageSize = int(os.getenv('FEEDLY_PAGE_SIZE', 250))
+        self.batchSize = int(os.getenv('FEEDLY_MGET_BATCH_SIZE', 100))
+        self.concurrency = int(os.getenv('FEEDLY_MGET_CONCURRENCY', 4))
+        self.maxArticles = int(os.getenv('FEEDLY_MAX_ARTICLES', 1000))
+
+    def iterStreamIds(self, folder_id, newerThan):
+        """
+        Yield pages of entry ids, following the continuation token until the stream is exhausted
+        """
+        continuation = None
+        total = 0
+        while total < self.maxArticles:
+            params = {'streamId': folder_id, 'newerThan': newerThan, 'count': min(self.pageSize, self.maxArticles - total)}
+            if continuation is not None:
+                params['continuation'] = continuation
+
+            feedly_url = f'{self.apiUrl}/v3/streams/ids'
+            logging.info(f'Getting articles with Feedly URL: {feedly_url} and parameters: {params}')
+            try:
+                response = self.request('GET', feedly_url, params=params)
+            except RetryableError as e:
+                logging.warning(f'Could not get articles: {e}')
+                return
+            if response.status_code != 200:
+                logging.warning(f'Could not get articles with status code: {response.status_code}. Details: \n{response.content}')
+                return
+
+            page = json.loads(response.text)
+            ids = page.get('ids', [])
+            total += len(ids)
+            logging.info(f'Retrieved {len(ids)} article ids ({total} in total).')
+            if ids:
+                yield ids
+
+            continuation = page.get('continuation')
+            if continuation is None or not ids:
+                return
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request through the rate limiter of the access token, retrying 429 and 5xx responses. The token is
+        refreshed ahead of its expiry, but if it is rejected anyway it is refreshed and the request is sent once more.
+        """
+        def send(refreshed=False):
+            token = self.credentials.token() if self.credentials is not None else None
+            headers = {'authorization': f'OAuth {token}'} if token is not None else None
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            if response.status_code == 401 and not refreshed and self.credentials is not None and self.credentials.refresh(token):
+                return send(refreshed=True)
+            raiseForRetry(response.status_code, response.headers, response.content)
+            return response
+        return self.limiter.call(send)
+
+    def getEntries(self, ids):
+        feedly_entries_url = f'{self.apiUrl}/v3/entries/.mget'
+        response = self.request('POST', feedly_entries_url, json=ids)
+        if response.status_code != 200:
+            raise Exception(f'Could not get entries with status code: {response.status_code}. Details: \n{response.content}')
+        return json.loads(response.text)
+
+    def iterEntries(self, folder_id, newerThan):
+        """
+        Yield the entries of a stream one at a time. Batches of ids are fetched concurrently as the pages
+        of ids arrive, with at most `concurrency` requests in flight, so only a few batches are held in memory.
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for ids in self.iterStreamIds(folder_id, newerThan):
+                for start in range(0, len(ids), self.batchSize):
+                    pending.append(executor.submit(self.getEntries, ids[start:start + self.batchSize]))
+
+                    while len(pending) >= self.concurrency:
+                        yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
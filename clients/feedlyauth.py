@@ -0,0 +1,253 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from clients.lazy import lazyImport
+
+requests = lazyImport('requests')
+
+# Tokens this close to their expiry are treated as expired, so they do not expire while a request is in flight
+EXPIRY_SKEW = 60
+
+def toTimestamp(expiresAt):
+    """
+    Convert the expiry stored in a config, a datetime or a timestamp in seconds or milliseconds, to a timestamp in seconds
+    """
+    if expiresAt is None or expiresAt == '':
+        return None
+    if isinstance(expiresAt, datetime):
+        # MongoDB returns naive datetimes in UTC
+        return (expiresAt if expiresAt.tzinfo is not None else expiresAt.replace(tzinfo=timezone.utc)).timestamp()
+    expiresAt = float(expiresAt)
+    return expiresAt / 1000 if expiresAt > 1e11 else expiresAt
+
+class FeedlyCredentials():
+    """
+    Access token of a Feedly user, refreshed with the refresh token before it expires. Once the token is within
+    FEEDLY_REFRESH_MARGIN seconds of its expiry a refresh is started in the background and requests keep using
+    the current token, so they only wait for a refresh when the token has already expired.
+    `load()` returns the stored feedly config of the user and `save(accessToken, expiresAt, refreshToken)` stores a new token.
+    """
+    def __init__(self, key, apiUrl, session, load=None, save=None):
+        self.key = key
+        self.apiUrl = apiUrl
+        self.session = session
+        self.load = load
+        self.save = save
+        self.margin = int(os.getenv('FEEDLY_REFRESH_MARGIN', 3600))
+        self.lock = threading.Lock()
+        self.refreshLock = threading.Lock()
+        self.accessToken = None
+        self.refreshToken = None
+        self.expiresAt = None
+        # Tokens replaced by a refresh, so that a config cached before the refresh does not bring them back
+        self.replaced = deque(maxlen=8)
+        self.refreshing = None
+        self.timer = None
+        self.refreshes = 0
+        self.failures = 0
+
+    def update(self, feedly):
+        """
+        Use the token of a feedly config, unless it is the current token or one that has been replaced
+        """
+        accessToken = feedly.get('accessToken')
+        with self.lock:
+            if accessToken is None or accessToken == self.accessToken or accessToken in self.replaced:
+                return
+            self.setToken(accessToken, feedly.get('refreshToken') or self.refreshToken, toTimestamp(feedly.get('expiresAt')))
+
+    def setToken(self, accessToken, refreshToken, expiresAt):
+        # Called with the lock held
+        if self.accessToken is not None and self.accessToken != accessToken:
+            self.replaced.append(self.accessToken)
+        self.accessToken = accessToken
+        self.refreshToken = refreshToken
+        self.expiresAt = expiresAt
+        self.schedule()
+
+    def schedule(self):
+        """
+        Start a timer refreshing the token ahead of its expiry, so that users without requests also keep a valid token
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.expiresAt is None or not self.canRefresh():
+            return
+        self.timer = threading.Timer(max(0, self.expiresAt - self.margin - time.time()), self.refreshInBackground)
+        self.timer.name = 'feedly-token-timer'
+        self.timer.daemon = True
+        self.timer.start()
+
+    def canRefresh(self):
+        return bool(self.refreshToken and os.getenv('FEEDLY_CLIENT_ID') and os.getenv('FEEDLY_CLIENT_SECRET'))
+
+    def hasExpired(self):
+        return self.expiresAt is not None and self.expiresAt - time.time() <= EXPIRY_SKEW
+
+    def token(self):
+        """
+        Return the access token, refreshing it first if it has expired
+        """
+        if self.expiresAt is not None and self.canRefresh():
+            if self.hasExpired():
+                self.refresh(self.accessToken)
+            elif self.expiresAt - time.time() <= self.margin:
+                self.refreshInBackground()
+        return self.accessToken
+
+    def refreshInBackground(self):
+        with self.lock:
+            if self.refreshing is not None:
+                return
+            expired = self.accessToken
+            self.refreshing = threading.Thread(target=self.backgroundRefresh, args=(expired,), name='feedly-token-refresh', daemon=True)
+        self.refreshing.start()
+
+    def backgroundRefresh(self, expired):
+        try:
+            self.refresh(expired)
+        finally:
+            with self.lock:
+                self.refreshing = None
+
+    def reload(self):
+        """
+        Use the stored token if another process has already refreshed it. Returns whether it was used.
+        """
+        if self.load is None:
+            return False
+        try:
+            feedly = self.load() or {}
+        except Exception as e:
+            logging.warning(f'Could not load the Feedly token of {self.key}: {e}')
+            return False
+
+        expiresAt = toTimestamp(feedly.get('expiresAt'))
+        if feedly.get('accessToken') in [None, self.accessToken] or expiresAt is None or expiresAt - time.time() <= self.margin:
+            return False
+        with self.lock:
+            self.setToken(feedly['accessToken'], feedly.get('refreshToken') or self.refreshToken, expiresAt)
+        logging.info(f'Using the Feedly token of {self.key} refreshed by another process')
+        return True
+
+    def refresh(self, expired):
+        """
+        Replace the token `expired` with a new one. Returns True once the token has been replaced, including when
+        another thread or process replaced it first, and False if it could not be refreshed.
+        """
+        with self.refreshLock:
+            if self.accessToken != expired:
+                return True
+            if not self.canRefresh():
+                logging.warning(f'Cannot refresh the Feedly token of {self.key}: FEEDLY_CLIENT_ID, FEEDLY_CLIENT_SECRET and a refresh token are required')
+                return False
+            if self.reload():
+                return True
+
+            try:
+                response = self.session.post(f'{self.apiUrl}/v3/auth/token', json={
+                    'refresh_token': self.refreshToken,
+                    'client_id': os.getenv('FEEDLY_CLIENT_ID'),
+                    'client_secret': os.getenv('FEEDLY_CLIENT_SECRET'),
+                    'grant_type': 'refresh_token'
+                }, timeout=int(os.getenv('FEEDLY_TIMEOUT', 60)))
+                if response.status_code != 200:
+                    raise Exception(f'status code: {response.status_code}. Details: \n{response.content}')
+                body = response.json()
+                accessToken = body['access_token']
+                expiresAt = time.time() + int(body.get('expires_in', 0)) if body.get('expires_in') else None
+                refreshToken = body.get('refresh_token') or self.refreshToken
+            except Exception as e:
+                self.failures += 1
+                logging.error(f'Could not refresh the Feedly token of {self.key} with {e}')
+                return False
+
+            # Stored first, so that a config loaded once the token is in use already holds it
+            if self.save is not None:
+                try:
+                    self.save(accessToken, expiresAt, refreshToken)
+                except Exception as e:
+                    logging.error(f'Could not save the Feedly token of {self.key}: \n{e}')
+            with self.lock:
+                self.setToken(accessToken, refreshToken, expiresAt)
+                self.refreshes += 1
+            logging.info(f'Refreshed the Feedly token of {self.key}')
+            return True
+
+    def stats(self):
+        return {
+            "expiresIn": round(self.expiresAt - time.time()) if self.expiresAt is not None else None,
+            "canRefresh": self.canRefresh(),
+            "refreshes": self.refreshes,
+            "failures": self.failures
+        }
+
+class FeedlyManager():
+    """
+    Process-wide Feedly credentials, one per user, and the HTTP session whose pool of keep-alive connections
+    is shared by the Feedly clients of every user
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def getInstance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = FeedlyManager()
+        return cls._instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.credentials = {}
+        self.session = None
+
+    def getSession(self):
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    session = requests.Session()
+                    # Retries are left to the rate limiter
+                    adapter = requests.adapters.HTTPAdapter(pool_maxsize=int(os.getenv('FEEDLY_MAX_CONNECTIONS', 20)), max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self.session = session
+        return self.session
+
+    def forUser(self, key, feedly, apiUrl, load=None, save=None):
+        """
+        Return the credentials of a user, identified by key, updated with the token of their feedly config
+        """
+        session = self.getSession()
+        with self.lock:
+            credentials = self.credentials.get(key)
+            if credentials is None:
+                credentials = self.credentials[key] = FeedlyCredentials(key, apiUrl, session, load, save)
+        credentials.update(feedly)
+        return credentials
+
+    def close(self):
+        with self.lock:
+            for credentials in self.credentials.values():
+                if credentials.timer is not None:
+                    credentials.timer.cancel()
+            self.credentials.clear()
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+
+    def stats(self):
+        with self.lock:
+            credentials = list(self.credentials.values())
+        stats = [entry.stats() for entry in credentials]
+        return {
+            "users": len(stats),
+            "refreshes": sum(entry["refreshes"] for entry in stats),
+            "failures": sum(entry["failures"] for entry in stats),
+            "expiringSoon": sum(1 for entry, credential in zip(stats, credentials) if entry["expiresIn"] is not None and entry["expiresIn"] <= credential.margin)
+        }
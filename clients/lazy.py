@@ -0,0 +1,33 @@
+import sys
+import importlib
+
+class LazyModule():
+    """
+    Stands in for a module that is only imported when one of its attributes is first used. The OpenAI, HTTP, MongoDB and
+    numpy libraries take most of the start-up time of the application, and many processes never use some of them.
+    """
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+
+    def _load(self):
+        # import_module is thread-safe, and only a dictionary lookup once the module is imported
+        return importlib.import_module(self._name)
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        return f'<lazy module {self._name}>'
+
+def lazyImport(name):
+    return sys.modules[name] if name in sys.modules else LazyModule(name)
+
+def isImported(name):
+    """
+    Whether a module has been imported. The exceptions of a library that was never imported cannot have been
+    raised, so they can be checked for without importing it.
+    """
+    return name in sys.modules
@@ -0,0 +1,287 @@
+import os
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import threading
+from clients.lazy import lazyImport, isImported
+
+openai = lazyImport('openai')
+requests = lazyImport('requests')
+aiohttp = lazyImport('aiohttp')
+
+# Default requests and tokens per minute of each service. OpenAI limits depend on the usage tier of the account.
+DEFAULT_LIMITS = {
+    'openai': (500, 150000),
+    'openai-image': (5, 0),
+    'feedly': (100, 0)
+}
+
+class RetryableError(Exception):
+    """
+    Raised for a response that is worth retrying, such as a 429 or a 5xx status code
+    """
+    def __init__(self, status, retryAfter=None, details=''):
+        super().__init__(f'Request failed with status code: {status}. Details: \n{details}')
+        self.status = status
+        self.retryAfter = retryAfter
+
+class CircuitOpenError(Exception):
+    pass
+
+def parseRetryAfter(headers):
+    """
+    Return the number of seconds to wait from the Retry-After header, or None. HTTP dates are not used by these APIs.
+    """
+    try:
+        value = (headers or {}).get('retry-after') or (headers or {}).get('Retry-After')
+        return max(0.0, float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def raiseForRetry(status, headers, details=''):
+    if status == 429 or status >= 500:
+        raise RetryableError(status, parseRetryAfter(headers), details)
+
+def classify(e):
+    """
+    Return whether an error is transient, the delay requested by the server, and whether it counts as a
+    failure of the service for the circuit breaker. Rate limits are expected and do not trip the breaker.
+    """
+    if isinstance(e, RetryableError):
+        return True, e.retryAfter, e.status >= 500
+    if isImported('openai'):
+        if isinstance(e, openai.error.RateLimitError):
+            # Running out of quota will not be fixed by waiting
+            if getattr(e, 'code', None) == 'insufficient_quota':
+                return False, None, False
+            return True, parseRetryAfter(e.headers), False
+        if isinstance(e, (openai.error.ServiceUnavailableError, openai.error.Timeout, openai.error.APIConnectionError, openai.error.TryAgain)):
+            return True, parseRetryAfter(getattr(e, 'headers', None)), True
+        if isinstance(e, openai.error.APIError) and (e.http_status or 0) >= 500:
+            return True, parseRetryAfter(e.headers), True
+    if isinstance(e, asyncio.TimeoutError):
+        return True, None, True
+    if isImported('requests') and isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True, None, True
+    if isImported('aiohttp') and isinstance(e, aiohttp.ClientConnectionError):
+        return True, None, True
+    return False, None, False
+
+class TokenBucket():
+    """
+    Token bucket refilled continuously up to a minute of quota. Callers reserve their cost up front and are told
+    how long to wait, which lets the level go negative so that waiting callers are served in order.
+    """
+    def __init__(self, perMinute):
+        self.capacity = float(perMinute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            # A single request larger than the bucket would otherwise never be served
+            self.level -= min(amount, self.capacity)
+            return -self.level / self.rate if self.level < 0 else 0.0
+
+    def adjust(self, amount):
+        """
+        Take more tokens from the bucket, or give some back if the amount is negative
+        """
+        with self.lock:
+            self.level = min(self.capacity, self.level - amount)
+
+class CircuitBreaker():
+    """
+    Fails fast after consecutive failures, then lets a single trial request through once the cooldown has passed
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.openedAt = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def state(self):
+        if self.openedAt is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.openedAt >= self.cooldown else 'open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state()
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.openedAt = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.openedAt = time.monotonic()
+            self.trial = False
+
+    def release(self):
+        """
+        End a trial request that neither succeeded nor failed, such as a rate limited one
+        """
+        with self.lock:
+            self.trial = False
+
+class RateLimiter():
+    """
+    Scheduler shared by every call made with the same API key. Requests wait for both the request and the token
+    buckets, are retried with jittered exponential backoff that honours Retry-After, and fail fast while the circuit is open.
+    """
+    _limiters = {}
+    _limitersLock = threading.Lock()
+
+    def __init__(self, name, requestsPerMinute=0, tokensPerMinute=0):
+        self.name = name
+        self.requests = TokenBucket(requestsPerMinute) if requestsPerMinute > 0 else None
+        self.tokens = TokenBucket(tokensPerMinute) if tokensPerMinute > 0 else None
+        self.breaker = CircuitBreaker(int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)), float(os.getenv('CIRCUIT_COOLDOWN', 30)))
+        self.maxAttempts = int(os.getenv('RETRY_MAX_ATTEMPTS', 5))
+        self.baseDelay = float(os.getenv('RETRY_BASE_DELAY', 1))
+        self.maxDelay = float(os.getenv('RETRY_MAX_DELAY', 60))
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.rejected = 0
+        self.waited = 0.0
+
+    @classmethod
+    def forKey(cls, service, apiKey):
+        """
+        Return the limiter of an API key for a service: openai, openai-image or feedly
+        """
+        keyHash = hashlib.sha256(str(apiKey).encode('utf-8')).hexdigest()[:12]
+        name = f'{service}:{keyHash}'
+        if name not in cls._limiters:
+            with cls._limitersLock:
+                if name not in cls._limiters:
+                    prefix = service.upper().replace('-', '_')
+                    requestsPerMinute, tokensPerMinute = DEFAULT_LIMITS.get(service, (0, 0))
+                    cls._limiters[name] = RateLimiter(
+                        name,
+                        requestsPerMinute=int(os.getenv(f'{prefix}_REQUESTS_PER_MINUTE', requestsPerMinute)),
+                        tokensPerMinute=int(os.getenv(f'{prefix}_TOKENS_PER_MINUTE', tokensPerMinute))
+                    )
+        return cls._limiters[name]
+
+    @classmethod
+    def allStats(cls):
+        with cls._limitersLock:
+            limiters = list(cls._limiters.values())
+        return {limiter.name: limiter.stats() for limiter in limiters}
+
+    def reserve(self, tokens):
+        """
+        Reserve a request and its tokens, and return how long to wait before sending it
+        """
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None and tokens > 0:
+            wait = max(wait, self.tokens.reserve(tokens))
+        if wait > 0:
+            with self.lock:
+                self.waited += wait
+            logging.debug(f'Waiting {wait:.2f}s for the {self.name} rate limit')
+        return wait
+
+    def settle(self, estimated, actual):
+        """
+        Correct the token bucket once the actual number of tokens used is known
+        """
+        if self.tokens is not None and actual is not None:
+            self.tokens.adjust(actual - estimated)
+
+    def backoff(self, attempt, retryAfter):
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+        return max(delay, retryAfter) if retryAfter is not None else delay
+
+    def check(self):
+        if not self.breaker.allow():
+            with self.lock:
+                self.rejected += 1
+            raise CircuitOpenError(f'Too many recent failures calling {self.name.split(":")[0]}. Try again later.')
+
+    def handle(self, e, attempt):
+        """
+        Record a failed attempt and return how long to wait before retrying, or raise the error if it should not be retried
+        """
+        retryable, retryAfter, failure = classify(e)
+        if failure:
+            self.breaker.failure()
+        else:
+            self.breaker.release()
+        if not retryable or attempt + 1 >= self.maxAttempts:
+            raise e
+
+        delay = self.backoff(attempt, retryAfter)
+        with self.lock:
+            self.retries += 1
+        logging.warning(f'Retrying {self.name.split(":")[0]} call in {delay:.2f}s after attempt {attempt + 1} failed: {e}')
+        return delay
+
+    def call(self, func, tokens=0):
+        with self.lock:
+            self.calls += 1
+        for attempt in range(self.maxAttempts):
+            self.check()
+            wait = self.reserve(tokens)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                result = func()
+            except Exception as e:
+                time.sleep(self.handle(e, attempt))
+                continue
+            self.breaker.success()
+            return result
+
+    async def acall(self, func, tokens=0):
+        """
+        Asynchronous variant of call. func returns a new awaitable for every attempt.
+        """
+        with self.lock:
+            self.calls += 1
+        for attempt in range(self.maxAttempts):
+            self.check()
+            wait = self.reserve(tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                result = await func()
+            except Exception as e:
+                await asyncio.sleep(self.handle(e, attempt))
+                continue
+            self.breaker.success()
+            return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "rejected": self.rejected,
+                "waitedSeconds": round(self.waited, 2),
+                "circuit": self.breaker.state()
+            }
@@ -0,0 +1,181 @@
+import os
+import queue
+import smtplib
+import logging
+import threading
+from concurrent.futures import Future
+from email.message import EmailMessage
+
+class SMTPSender():
+    """
+    Sends emails over a single authenticated SMTP connection from a background thread. Messages are queued
+    and delivered in order, the connection is reopened when it fails, and it is closed after being idle.
+    """
+    def __init__(self, username, password, host=None, port=None, starttls=None, idle_timeout=None, max_attempts=None):
+        self.username = username
+        self.password = password
+        self.host = host or os.getenv('SMTP_HOST', 'smtp.gmail.com')
+        self.port = int(port if port is not None else os.getenv('SMTP_PORT', 587))
+        self.starttls = starttls if starttls is not None else os.getenv('SMTP_STARTTLS', 'true').lower() == 'true'
+        self.idleTimeout = float(idle_timeout if idle_timeout is not None else os.getenv('SMTP_IDLE_TIMEOUT', 60))
+        self.maxAttempts = int(max_attempts if max_attempts is not None else os.getenv('SMTP_MAX_ATTEMPTS', 3))
+        self.queue = queue.Queue()
+        self.connection = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.connections = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name='smtp-sender', daemon=True)
+                self.thread.start()
+
+    def send(self, recipients, subject, body):
+        """
+        Queue an email to one or more recipients, given as a list or a comma-separated string.
+        Returns a future that completes once the email is delivered.
+        """
+        if isinstance(recipients, str):
+            recipients = [recipient.strip() for recipient in recipients.split(',') if recipient.strip()]
+
+        message = EmailMessage()
+        message['From'] = self.username
+        message['To'] = ', '.join(recipients)
+        message['Subject'] = subject
+        message.set_content(body)
+
+        future = Future()
+        self.start()
+        self.queue.put((message, recipients, future))
+        return future
+
+    def close(self):
+        """
+        Deliver the queued emails, then close the connection and stop the background thread
+        """
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            connection.ehlo()
+            if self.starttls:
+                connection.starttls()
+                connection.ehlo()
+            if self.username:
+                connection.login(self.username, self.password) # https://support.google.com/accounts/answer/185833
+        except Exception:
+            connection.close()
+            raise
+        self.connection = connection
+        self.connections += 1
+        logging.info(f'Connected to SMTP server {self.host}:{self.port}')
+
+    def disconnect(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except Exception:
+            self.drop()
+        self.connection = None
+
+    def drop(self):
+        """
+        Close the socket of a connection that can no longer be used, without talking to the server
+        """
+        if self.connection is None:
+            return
+        try:
+            self.connection.close()
+        except Exception as e:
+            logging.debug(f'Could not close the SMTP connection: {e}')
+        self.connection = None
+
+    def reset(self):
+        """
+        Abort the current transaction so the connection can be used for the next email
+        """
+        if self.connection is None:
+            return
+        try:
+            self.connection.rset()
+        except Exception:
+            self.drop()
+
+    def deliver(self, message, recipients):
+        for attempt in range(self.maxAttempts):
+            try:
+                if self.connection is None:
+                    self.connect()
+                self.connection.send_message(message, from_addr=self.username, to_addrs=recipients)
+                return
+            # The SMTP exceptions are OSErrors, so they are handled before the socket errors
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError) as e:
+                self.retryConnection(attempt, e)
+            except smtplib.SMTPRecipientsRefused:
+                # Every recipient was refused, so the email cannot be delivered
+                self.reset()
+                raise
+            except smtplib.SMTPResponseException as e:
+                # Temporary failures (4xx) are retried on the same connection, permanent ones are not
+                if e.smtp_code >= 500 or attempt + 1 >= self.maxAttempts:
+                    self.reset()
+                    raise
+            except OSError as e:
+                self.retryConnection(attempt, e)
+
+    def retryConnection(self, attempt, error):
+        """
+        Close a connection that is unusable so it is reopened for the next attempt, or raise after the last attempt
+        """
+        logging.warning(f'SMTP connection failed on attempt {attempt + 1}: {error}')
+        self.drop()
+        if attempt + 1 >= self.maxAttempts:
+            raise error
+
+    def work(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.idleTimeout)
+            except queue.Empty:
+                self.disconnect()
+                continue
+
+            if item is None:
+                self.disconnect()
+                return
+
+            message, recipients, future = item
+            try:
+                self.deliver(message, recipients)
+                self.sent += 1
+                logging.info(f'Email sent to {", ".join(recipients)}')
+                future.set_result(True)
+            except Exception as e:
+                self.failed += 1
+                logging.error(f'Error sending email: \n{e}')
+                future.set_exception(e)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "connections": self.connections,
+            "queued": self.queue.qsize()
+        }
@@ -0,0 +1,150 @@
+import sys
+import logging
+import argparse
+import threading
+import socket
+import socketserver
+from email import message_from_bytes, policy
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal SMTP dialogue: enough of EHLO, AUTH, MAIL, RCPT and DATA for smtplib to deliver a message
+    """
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode('utf-8'))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.clients.add(self.connection)
+        try:
+            self.converse(server)
+        finally:
+            with server.lock:
+                server.clients.discard(self.connection)
+
+    def converse(self, server):
+        sender = None
+        recipients = []
+        self.reply('220 localhost SMTP stand-in ready')
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb == 'EHLO':
+                self.wfile.write(b'250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+            elif verb == 'HELO':
+                self.reply('250 localhost')
+            elif verb == 'AUTH':
+                parts = command.split()
+                if parts[1].upper() == 'LOGIN':
+                    # Username and password prompts
+                    self.reply('334 VXNlcm5hbWU6')
+                    self.rfile.readline()
+                    self.reply('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                elif len(parts) == 2:
+                    self.reply('334 ')
+                    self.rfile.readline()
+                self.reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                sender = command.split(':', 1)[1].strip().split(' ')[0].strip('<>')
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip().split(' ')[0].strip('<>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                with server.lock:
+                    server.messages.append({
+                        "sender": sender,
+                        "recipients": recipients,
+                        "message": message_from_bytes(b''.join(data), policy=policy.default)
+                    })
+                self.reply('250 OK: queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for an SMTP server that keeps the messages it receives in memory, to test sending emails offline.
+    Use it with SMTP_HOST=localhost, SMTP_PORT set to its port and SMTP_STARTTLS=false.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), SMTPHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+        self.clients = set()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='smtp-stand-in', daemon=True)
+        self.thread.start()
+        return self
+
+    def dropConnections(self):
+        """
+        Close the open connections, as a server that times out idle clients would
+        """
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a local SMTP stand-in that prints the emails it receives')
+    parser.add_argument('--port', type=int, default=1025)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = LocalSMTPServer(port=args.port)
+    logging.info(f'SMTP stand-in listening on port {server.port}')
+    printed = 0
+
+    def watch():
+        global printed
+        while True:
+            threading.Event().wait(1)
+            with server.lock:
+                messages = server.messages[printed:]
+                printed = len(server.messages)
+            for received in messages:
+                print(f'From: {received["sender"]}\nTo: {", ".join(received["recipients"])}\n{received["message"]}\n', file=sys.stdout, flush=True)
+
+    threading.Thread(target=watch, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
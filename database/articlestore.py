@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+class ArticleStore():
+    """
+    Local SQLite store of the Feedly articles, keyed by entry id, with a high-water mark per user and folder
+    """
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    def __init__(self, path=None, retention_days=None):
+        self.path = path or os.getenv('ARTICLE_STORE_PATH', '.cache/articles.sqlite')
+        self.retention_days = int(retention_days if retention_days is not None else os.getenv('ARTICLE_STORE_RETENTION_DAYS', 31))
+        self.lock = threading.Lock()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS articles (
+                id TEXT PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                url TEXT,
+                title TEXT,
+                summary TEXT,
+                content TEXT,
+                stored REAL NOT NULL
+            )
+        ''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS folder_articles (
+                folder TEXT NOT NULL,
+                id TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                PRIMARY KEY (folder, id)
+            )
+        ''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS folder_articles_timestamp ON folder_articles (folder, timestamp)')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS watermarks (
+                userId TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (userId, folder)
+            )
+        ''')
+        self.connection.commit()
+
+    @classmethod
+    def getInstance(cls):
+        """
+        Return the process-wide store, or None if the store is disabled
+        """
+        if os.getenv('ARTICLE_STORE_ENABLED', 'true').lower() != 'true':
+            return None
+        if cls._instance is None:
+            with cls._instanceLock:
+                if cls._instance is None:
+                    cls._instance = ArticleStore()
+                    cls._instance.prune()
+        return cls._instance
+
+    def saveArticles(self, folder, articles):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO articles (id, timestamp, url, title, summary, content, stored) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(a['id'], a['timestamp'], a['url'], a['title'], a['summary'], a['content'], now) for a in articles]
+            )
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO folder_articles (folder, id, timestamp) VALUES (?, ?, ?)',
+                [(folder, a['id'], a['timestamp']) for a in articles]
+            )
+            self.connection.commit()
+
+    def iterArticles(self, folder, since, until=None):
+        """
+        Yield the stored articles of a folder newer than since (in ms), oldest first
+        """
+        query = '''
+            SELECT a.id, a.timestamp, a.url, a.title, a.summary, a.content
+            FROM folder_articles f JOIN articles a ON a.id = f.id
+            WHERE f.folder = ? AND f.timestamp > ?
+        '''
+        params = [folder, since]
+        if until is not None:
+            query += ' AND f.timestamp <= ?'
+            params.append(until)
+        query += ' ORDER BY f.timestamp ASC'
+
+        with self.lock:
+            rows = self.connection.execute(query, params).fetchall()
+
+        for id, timestamp, url, title, summary, content in rows:
+            yield {
+                'id': id,
+                'timestamp': timestamp,
+                'url': url,
+                'title': title,
+                'summary': summary,
+                'content': content
+            }
+
+    def getWatermark(self, userId, folder):
+        with self.lock:
+            row = self.connection.execute('SELECT timestamp FROM watermarks WHERE userId = ? AND folder = ?', (userId, folder)).fetchone()
+        return row[0] if row is not None else None
+
+    def setWatermark(self, userId, folder, timestamp):
+        """
+        Move the high-water mark forward. It never moves backwards.
+        """
+        with self.lock:
+            self.connection.execute('''
+                INSERT INTO watermarks (userId, folder, timestamp, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT (userId, folder) DO UPDATE SET timestamp = MAX(timestamp, excluded.timestamp), updated = excluded.updated
+            ''', (userId, folder, timestamp, time.time()))
+            self.connection.commit()
+        logging.info(f'Set the high-water mark of folder {folder} for user {userId} to {timestamp}')
+
+    def prune(self):
+        """
+        Remove articles older than the retention period
+        """
+        cutoff = int((time.time() - self.retention_days * 24 * 3600) * 1000)
+        with self.lock:
+            self.connection.execute('DELETE FROM folder_articles WHERE timestamp < ?', (cutoff,))
+            self.connection.execute('DELETE FROM articles WHERE timestamp < ?', (cutoff,))
+            self.connection.commit()
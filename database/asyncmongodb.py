@@ -0,0 +1,178 @@
+import os
+import logging
+import asyncio
+from datetime import datetime
+from clients.lazy import lazyImport
+from database.mongodb import MongoDB, newPoolListener
+from monitoring.metrics import traced
+
+motor = lazyImport('motor.motor_asyncio')
+pymongo = lazyImport('pymongo')
+bson = lazyImport('bson')
+
+class AsyncMongoDB():
+    """
+    Asynchronous counterpart of MongoDB built on the Motor driver
+    """
+    # Motor clients are bound to the event loop they were created in, so one client is shared per loop
+    _client = None
+    _clientLoop = None
+    _poolListener = None
+
+    def __init__(self):
+        self.client = AsyncMongoDB.getClient()
+
+    @classmethod
+    def getClient(cls):
+        loop = asyncio.get_running_loop()
+        if cls._client is None or cls._clientLoop is not loop:
+            cls._poolListener = newPoolListener()
+            cls._client = motor.AsyncIOMotorClient(
+                MongoDB.getUri(),
+                maxPoolSize=int(os.getenv('MONGODB_MAX_POOL_SIZE', 50)),
+                minPoolSize=int(os.getenv('MONGODB_MIN_POOL_SIZE', 0)),
+                maxIdleTimeMS=int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', 300000)),
+                event_listeners=[cls._poolListener]
+            )
+            cls._clientLoop = loop
+            logging.info('Created async MongoDB client')
+        return cls._client
+
+    @classmethod
+    def closeClient(cls):
+        if cls._client is not None:
+            cls._client.close()
+            logging.info('Closed async MongoDB client')
+        cls._client = None
+        cls._clientLoop = None
+
+    @classmethod
+    def poolStats(cls):
+        if cls._client is None or cls._poolListener is None:
+            return {"connected": False}
+
+        stats = cls._poolListener.stats()
+        stats["connected"] = True
+        return stats
+
+    @traced('mongodb')
+    async def ping(self):
+        return await self.client.admin.command('ping')
+
+    @traced('mongodb')
+    async def findConfigForUser(self, userId):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('config')
+            config = await coll.find_one({"userId": userId})
+            logging.info(f'Found config for user {userId}')
+            return config
+        except Exception as e:
+            logging.error(f'Error getting config for user {userId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    async def findInsightById(self, insightId):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('insight')
+            insight = await coll.find_one({"_id": bson.ObjectId(insightId)})
+            logging.info(f'Found insight for ID: {insightId}')
+            return insight
+        except Exception as e:
+            logging.error(f'Error getting insight for ID {insightId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    async def findInsightsByIds(self, insightIds):
+        """
+        Return the insights and URLs of several insights in a single query, in the order of the ids
+        """
+        try:
+            objectIds = [bson.ObjectId(insightId) for insightId in insightIds if bson.ObjectId.is_valid(insightId)]
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('insight')
+            found = {str(insight['_id']): insight async for insight in coll.find({"_id": {"$in": objectIds}}, {"insights": 1, "urls": 1})}
+            logging.info(f'Found {len(found)} insights for {len(insightIds)} IDs')
+            return [found[str(objectId)] for objectId in objectIds if str(objectId) in found]
+        except Exception as e:
+            logging.error(f'Error getting insights for IDs {insightIds}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    async def iterHistory(self, collection, userId, fields, limit, before=None):
+        """
+        Yield the documents of a user newest first, one page at a time. before is the cursor returned
+        with the last document of the previous page, as timestamp_id.
+        """
+        query = {"userId": userId}
+        if before is not None:
+            timestamp, _, id = before.partition('_')
+            query["$or"] = [
+                {"timestamp": {"$lt": int(timestamp)}},
+                {"timestamp": int(timestamp), "_id": {"$lt": bson.ObjectId(id)}}
+            ]
+
+        db = self.client.get_database(name='InsightsAutomation')
+        coll = db.get_collection(collection)
+        cursor = coll.find(query, {field: 1 for field in fields + ["timestamp"]})
+        cursor = cursor.sort([("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]).limit(limit).batch_size(min(limit, 100))
+        async for document in cursor:
+            yield document
+
+    @traced('mongodb')
+    async def insertInsights(self, userId, insights, urls, folder=None, since=None, until=None):
+        # since and until are the window of the articles in ms, used to reuse the insights in digests
+        insight_document = {
+            "userId": userId,
+            "insights": insights,
+            "urls": urls,
+            "folder": folder,
+            "since": since,
+            "until": until,
+            "timestamp": int(datetime.now().timestamp())
+        }
+
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('insight')
+            result = await coll.insert_one(insight_document)
+            logging.info(f'Inserted document in insights collection for user {userId}')
+            return str(result.inserted_id)
+        except Exception as e:
+            logging.error(f'Error inserting insights document for user {userId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    async def insertPost(self, userId, post, image, insightIds, urls = [], imagePath=None):
+        insight_document = {
+            "userId": userId,
+            "insightIds": insightIds,
+            "post": post,
+            "image": image,
+            "imagePath": imagePath,
+            "urls": urls,
+            "timestamp": int(datetime.now().timestamp())
+        }
+
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('linkedin_post')
+            result = await coll.insert_one(insight_document)
+            logging.info(f'Inserted document in post collection for user {userId} from insights: {insightIds}')
+            return str(result.inserted_id)
+        except Exception as e:
+            logging.error(f'Error inserting post document for user {userId} from insights: {insightIds}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    async def updatePostImage(self, postId, image, imagePath=None):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('linkedin_post')
+            await coll.update_one({"_id": bson.ObjectId(postId)}, {"$set": {"image": image, "imagePath": imagePath}})
+            logging.info(f'Added image to post {postId}')
+            return True
+        except Exception as e:
+            logging.error(f'Error adding image to post {postId}: \n{e}')
+            raise Exception(e)
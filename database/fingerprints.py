@@ -0,0 +1,156 @@
+import os
+import time
+import sqlite3
+import threading
+
+BANDS = 4
+BAND_BITS = 16
+
+def toSigned(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def toUnsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+def bands(fingerprint):
+    mask = (1 << BAND_BITS) - 1
+    return [(fingerprint >> (band * BAND_BITS)) & mask for band in range(BANDS)]
+
+class FingerprintIndex():
+    """
+    Persistent SQLite index of the article fingerprints, shared by every user, which maps each article
+    to the cluster of copies of the same story. The SimHash is split into bands so that candidates
+    within a small Hamming distance are found with indexed lookups. The clusters seen by each user and
+    folder are recorded separately, so that a story is only known to be old for those who have seen it.
+    """
+    _instance = None
+    _instanceLock = threading.Lock()
+
+    def __init__(self, path=None, retention_days=None):
+        self.path = path or os.getenv('DEDUP_INDEX_PATH', '.cache/fingerprints.sqlite')
+        self.retention_days = int(retention_days if retention_days is not None else os.getenv('DEDUP_RETENTION_DAYS', 31))
+        self.lock = threading.Lock()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                id TEXT PRIMARY KEY,
+                cluster TEXT NOT NULL,
+                first INTEGER NOT NULL,
+                canonical TEXT,
+                fingerprint INTEGER,
+                band0 INTEGER,
+                band1 INTEGER,
+                band2 INTEGER,
+                band3 INTEGER,
+                timestamp INTEGER NOT NULL
+            )
+        ''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS sightings (
+                scope TEXT NOT NULL,
+                cluster TEXT NOT NULL,
+                first INTEGER NOT NULL,
+                PRIMARY KEY (scope, cluster)
+            )
+        ''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS fingerprints_canonical ON fingerprints (canonical)')
+        for band in range(BANDS):
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS fingerprints_band{band} ON fingerprints (band{band})')
+        self.connection.commit()
+
+    @classmethod
+    def getInstance(cls):
+        """
+        Return the process-wide index, or None if it is disabled
+        """
+        if os.getenv('DEDUP_INDEX_ENABLED', 'true').lower() != 'true':
+            return None
+        if cls._instance is None:
+            with cls._instanceLock:
+                if cls._instance is None:
+                    cls._instance = FingerprintIndex()
+                    cls._instance.prune()
+        return cls._instance
+
+    def findById(self, id):
+        """
+        Return the cluster of an article seen before and the timestamp of the first article of the cluster
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT cluster, first FROM fingerprints WHERE id = ?', (id,)).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def findMatch(self, canonical, fingerprint, distance):
+        """
+        Return the cluster and first timestamp of an article with the same canonical URL,
+        or else with a fingerprint within the given Hamming distance
+        """
+        with self.lock:
+            if canonical is not None:
+                row = self.connection.execute('SELECT cluster, first FROM fingerprints WHERE canonical = ? LIMIT 1', (canonical,)).fetchone()
+                if row is not None:
+                    return (row[0], row[1])
+            if fingerprint is None:
+                return None
+
+            query = ' UNION '.join(f'SELECT cluster, first, fingerprint FROM fingerprints WHERE band{band} = ?' for band in range(BANDS))
+            rows = self.connection.execute(query, bands(fingerprint)).fetchall()
+
+        best = None
+        for cluster, first, candidate in rows:
+            if candidate is None:
+                continue
+            bits = (toUnsigned(candidate) ^ fingerprint).bit_count()
+            if bits <= distance and (best is None or bits < best[0]):
+                best = (bits, cluster, first)
+        return (best[1], best[2]) if best is not None else None
+
+    def addArticles(self, entries):
+        """
+        Save a list of (id, cluster, first, canonical, fingerprint, timestamp) entries
+        """
+        rows = []
+        for id, cluster, first, canonical, fingerprint, timestamp in entries:
+            row_bands = bands(fingerprint) if fingerprint is not None else [None] * BANDS
+            rows.append((id, cluster, first, canonical, toSigned(fingerprint) if fingerprint is not None else None, *row_bands, timestamp))
+
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO fingerprints (id, cluster, first, canonical, fingerprint, band0, band1, band2, band3, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            self.connection.commit()
+
+    def firstSeen(self, scope, cluster):
+        """
+        Return the timestamp of the oldest article of a cluster seen in a scope, such as a user and folder, or None
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT first FROM sightings WHERE scope = ? AND cluster = ?', (scope, cluster)).fetchone()
+        return row[0] if row is not None else None
+
+    def addSightings(self, scope, sightings):
+        """
+        Record a list of (cluster, timestamp) articles seen in a scope, keeping the oldest timestamp of each cluster
+        """
+        with self.lock:
+            self.connection.executemany(
+                'INSERT INTO sightings (scope, cluster, first) VALUES (?, ?, ?) ON CONFLICT (scope, cluster) DO UPDATE SET first = MIN(first, excluded.first)',
+                [(scope, cluster, timestamp) for cluster, timestamp in sightings]
+            )
+            self.connection.commit()
+
+    def prune(self):
+        """
+        Remove fingerprints older than the retention period
+        """
+        cutoff = int((time.time() - self.retention_days * 24 * 3600) * 1000)
+        with self.lock:
+            self.connection.execute('DELETE FROM fingerprints WHERE timestamp < ?', (cutoff,))
+            self.connection.execute('DELETE FROM sightings WHERE first < ?', (cutoff,))
+            self.connection.commit()
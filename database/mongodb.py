@@ -1,21 +1,166 @@
 import os
 import logging
 import json
-from datetime import datetime
+import threading
+import functools
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from pymongo.mongo_client import MongoClient
-from pymongo.collection import ObjectId
+from clients.lazy import lazyImport
+from monitoring.metrics import traced
+from monitoring.logs import configureLogging
+
+pymongo = lazyImport('pymongo')
+bson = lazyImport('bson')
+
+class PoolStatsListener():
+    """
+    Keeps running counters of the connection pool events so they can be exposed for monitoring.
+    Create it with newPoolListener, as pymongo only accepts subclasses of its listener classes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "poolsCreated": 0,
+            "poolsCleared": 0,
+            "connectionsCreated": 0,
+            "connectionsClosed": 0,
+            "checkOutsStarted": 0,
+            "checkOutsFailed": 0,
+            "checkedOut": 0,
+            "checkedIn": 0
+        }
+
+    def increment(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["openConnections"] = stats["connectionsCreated"] - stats["connectionsClosed"]
+        stats["inUse"] = stats["checkedOut"] - stats["checkedIn"]
+        return stats
+
+    def pool_created(self, event):
+        self.increment("poolsCreated")
+
+    def pool_cleared(self, event):
+        self.increment("poolsCleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.increment("connectionsCreated")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.increment("connectionsClosed")
+
+    def connection_check_out_started(self, event):
+        self.increment("checkOutsStarted")
+
+    def connection_check_out_failed(self, event):
+        self.increment("checkOutsFailed")
+
+    def connection_checked_out(self, event):
+        self.increment("checkedOut")
+
+    def connection_checked_in(self, event):
+        self.increment("checkedIn")
+
+@functools.cache
+def poolListenerClass():
+    # Built on first use so that pymongo is only imported with the first client
+    return type('PoolStatsListener', (PoolStatsListener, pymongo.monitoring.ConnectionPoolListener), {})
+
+def newPoolListener():
+    return poolListenerClass()()
 
 class MongoDB():
     load_dotenv()
 
+    # A single MongoClient is shared by every MongoDB instance in the process. MongoClient is thread-safe
+    # and maintains its own connection pool, so creating one per request only adds SRV lookups and TLS handshakes.
+    # Each uvicorn worker process lazily creates its own client after forking.
+    _client = None
+    _clientPid = None
+    _clientLock = threading.Lock()
+    _poolListener = None
+
     def __init__(self):
-        logging.basicConfig(level=logging.DEBUG)
-        self.uri = f"mongodb+srv://{os.getenv('MONGODB_USERNAME')}:{os.getenv('MONGODB_PASSWORD')}@{os.getenv('MONGODB_URL', 'insightsautomation.to3so7y.mongodb.net')}/?retryWrites=true&w=majority"
+        configureLogging()
+        self.client = MongoDB.getClient()
+
+    @staticmethod
+    def getUri():
+        return f"mongodb+srv://{os.getenv('MONGODB_USERNAME')}:{os.getenv('MONGODB_PASSWORD')}@{os.getenv('MONGODB_URL', 'insightsautomation.to3so7y.mongodb.net')}/?retryWrites=true&w=majority"
+
+    @classmethod
+    def getClient(cls):
+        """
+        Return the process-wide client, creating it on first use
+        """
+        if cls._client is None or cls._clientPid != os.getpid():
+            with cls._clientLock:
+                if cls._client is None or cls._clientPid != os.getpid():
+                    cls._poolListener = newPoolListener()
+                    # Create a new client and connect to the server
+                    cls._client = pymongo.MongoClient(
+                        cls.getUri(),
+                        maxPoolSize=int(os.getenv('MONGODB_MAX_POOL_SIZE', 50)),
+                        minPoolSize=int(os.getenv('MONGODB_MIN_POOL_SIZE', 0)),
+                        maxIdleTimeMS=int(os.getenv('MONGODB_MAX_IDLE_TIME_MS', 300000)),
+                        event_listeners=[cls._poolListener]
+                    )
+                    cls._clientPid = os.getpid()
+                    logging.info(f'Created MongoDB client for process {cls._clientPid}')
+        return cls._client
+
+    @classmethod
+    def closeClient(cls):
+        """
+        Close the process-wide client and its pooled connections
+        """
+        with cls._clientLock:
+            if cls._client is not None:
+                cls._client.close()
+                logging.info('Closed MongoDB client')
+            cls._client = None
+            cls._clientPid = None
+
+    @classmethod
+    def poolStats(cls):
+        """
+        Return the connection pool statistics of the process-wide client
+        """
+        if cls._client is None or cls._poolListener is None:
+            return {"connected": False}
+
+        stats = cls._poolListener.stats()
+        stats["connected"] = True
+        stats["pid"] = cls._clientPid
+        stats["maxPoolSize"] = cls._client.options.pool_options.max_pool_size
+        stats["minPoolSize"] = cls._client.options.pool_options.min_pool_size
+        stats["nodes"] = [f'{host}:{port}' for host, port in cls._client.nodes]
+        return stats
 
-        # Create a new client and connect to the server
-        self.client = MongoClient(self.uri)
+    @traced('mongodb')
+    def ensureIndexes(self):
+        """
+        Create the indexes used to list the history of a user, newest first, and to find the insights and roll-ups
+        of the digests. Existing indexes are left as they are.
+        """
+        db = self.client.get_database(name='InsightsAutomation')
+        for collection in ['insight', 'linkedin_post']:
+            db.get_collection(collection).create_index([("userId", 1), ("timestamp", -1), ("_id", -1)], name='userId_timestamp')
+        db.get_collection('insight').create_index([("userId", 1), ("folder", 1), ("since", 1)], name='userId_folder_since')
+        db.get_collection('digest').create_index([("userId", 1), ("folder", 1), ("period", 1), ("start", 1)], name='userId_folder_period_start', unique=True)
+        logging.info('Ensured the MongoDB indexes')
 
+    @traced('mongodb')
     def testConnection(self):
         # Send a ping to confirm a successful connection
         try:
@@ -24,6 +169,14 @@ class MongoDB():
         except Exception as e:
             logging.error(f'Error pinging MongoDB: {e}')
 
+    @traced('mongodb')
+    def ping(self):
+        """
+        Ping the deployment, raising if it cannot be reached. Used to open a pooled connection ahead of the first request.
+        """
+        return self.client.admin.command('ping')
+
+    @traced('mongodb')
     def findConfigForUser(self, userId):
         try:
             db = self.client.get_database(name='InsightsAutomation')
@@ -35,41 +188,153 @@ class MongoDB():
             logging.error(f'Error getting config for user {userId}: \n{e}')
             raise Exception(e)
         
+    @traced('mongodb')
+    def findFeedlyToken(self, userId):
+        """
+        Return the feedly section of the config of a user, with the current access token
+        """
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('config')
+            config = coll.find_one({"userId": userId}, {"feedly": 1})
+            return config['feedly'] if config is not None else None
+        except Exception as e:
+            logging.error(f'Error getting the Feedly token of user {userId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def updateFeedlyToken(self, userId, accessToken, expiresAt, refreshToken=None):
+        """
+        Save a refreshed Feedly access token, and its expiry as a timestamp in seconds, in the config of a user
+        """
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('config')
+            fields = {
+                "feedly.accessToken": accessToken,
+                "feedly.expiresAt": datetime.fromtimestamp(expiresAt, timezone.utc) if expiresAt is not None else None
+            }
+            if refreshToken is not None:
+                fields["feedly.refreshToken"] = refreshToken
+            coll.update_one({"userId": userId}, {"$set": fields})
+            logging.info(f'Updated the Feedly token of user {userId}')
+            return True
+        except Exception as e:
+            logging.error(f'Error updating the Feedly token of user {userId}: \n{e}')
+            raise Exception(e)
+
+    def watchConfig(self):
+        """
+        Open a change stream on the config collection
+        """
+        db = self.client.get_database(name='InsightsAutomation')
+        coll = db.get_collection('config')
+        return coll.watch(full_document='updateLookup')
+
+    @traced('mongodb')
     def findInsightById(self, insightId): 
         try:
             db = self.client.get_database(name='InsightsAutomation')
             coll = db.get_collection('insight')
-            insight = coll.find_one({"_id": ObjectId(insightId)})
+            insight = coll.find_one({"_id": bson.ObjectId(insightId)})
             logging.info(f'Found insight for ID: {insightId}')
             return insight
         except Exception as e:
             logging.error(f'Error getting insight for ID {insightId}: \n{e}')
             raise Exception(e)
 
-    def insertInsights(self, userId, insights, urls):
+    @traced('mongodb')
+    def findInsightsByIds(self, insightIds):
+        """
+        Return the insights and URLs of several insights in a single query, in the order of the ids
+        """
+        try:
+            objectIds = [bson.ObjectId(insightId) for insightId in insightIds if bson.ObjectId.is_valid(insightId)]
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('insight')
+            found = {str(insight['_id']): insight for insight in coll.find({"_id": {"$in": objectIds}}, {"insights": 1, "urls": 1})}
+            logging.info(f'Found {len(found)} insights for {len(insightIds)} IDs')
+            return [found[str(objectId)] for objectId in objectIds if str(objectId) in found]
+        except Exception as e:
+            logging.error(f'Error getting insights for IDs {insightIds}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def insertInsights(self, userId, insights, urls, folder=None, since=None, until=None):
+        # since and until are the window of the articles in ms, used to reuse the insights in digests
         insight_document = {
             "userId": userId,
             "insights": insights,
             "urls": urls,
+            "folder": folder,
+            "since": since,
+            "until": until,
             "timestamp": int(datetime.now().timestamp())
         }
 
         try:
             db = self.client.get_database(name='InsightsAutomation')
             coll = db.get_collection('insight')
-            coll.insert_one(insight_document)
+            result = coll.insert_one(insight_document)
             logging.info(f'Inserted document in insights collection for user {userId}')
-            return True
+            return str(result.inserted_id)
         except Exception as e:
             logging.error(f'Error inserting insights document for user {userId}: \n{e}')
             raise Exception(e)
         
-    def insertPost(self, userId, post, image, insightIds, urls = []):
+    @traced('mongodb')
+    def findInsightsInWindow(self, userId, folder, since, until):
+        """
+        Return the insights of a folder generated from articles between since and until, in ms
+        """
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('insight')
+            query = {"userId": userId, "folder": folder, "since": {"$gte": since}, "until": {"$lte": until}}
+            insights = list(coll.find(query, {"insights": 1, "urls": 1, "since": 1, "until": 1, "timestamp": 1}))
+            logging.info(f'Found {len(insights)} insights in the window for folder {folder}')
+            return insights
+        except Exception as e:
+            logging.error(f'Error getting the insights of folder {folder} for user {userId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def findDigests(self, userId, folder, first, last):
+        """
+        Return the cached roll-ups and empty days of a folder starting between the first and last days, as ISO dates
+        """
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('digest')
+            return list(coll.find({"userId": userId, "folder": folder, "start": {"$gte": first, "$lte": last}}))
+        except Exception as e:
+            logging.error(f'Error getting the digests of folder {folder} for user {userId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def saveDigest(self, userId, folder, period, start, end, insights, urls):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('digest')
+            coll.update_one(
+                {"userId": userId, "folder": folder, "period": period, "start": start},
+                {"$set": {"end": end, "insights": insights, "urls": urls, "timestamp": int(datetime.now().timestamp())}},
+                upsert=True
+            )
+            logging.info(f'Saved the {period} digest of folder {folder} from {start} for user {userId}')
+            return True
+        except Exception as e:
+            logging.error(f'Error saving the {period} digest of folder {folder} for user {userId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def insertPost(self, userId, post, image, insightIds, urls = [], imagePath=None):
         insight_document = {
             "userId": userId,
             "insightIds": insightIds,
             "post": post,
             "image": image,
+            "imagePath": imagePath,
             "urls": urls,
             "timestamp": int(datetime.now().timestamp())
         }
@@ -77,10 +342,168 @@ class MongoDB():
         try:
             db = self.client.get_database(name='InsightsAutomation')
             coll = db.get_collection('linkedin_post')
-            coll.insert_one(insight_document)
+            result = coll.insert_one(insight_document)
             logging.info(f'Inserted document in post collection for user {userId} from insights: {insightIds}')
-            return True
+            return str(result.inserted_id)
         except Exception as e:
             logging.error(f'Error inserting post document for user {userId} from insights: {insightIds}: \n{e}')
             raise Exception(e)
-        
\ No newline at end of file
+
+    @traced('mongodb')
+    def updatePostImage(self, postId, image, imagePath=None):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('linkedin_post')
+            coll.update_one({"_id": bson.ObjectId(postId)}, {"$set": {"image": image, "imagePath": imagePath}})
+            logging.info(f'Added image to post {postId}')
+            return True
+        except Exception as e:
+            logging.error(f'Error adding image to post {postId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def insertJob(self, kind, params):
+        job_document = {
+            "kind": kind,
+            "params": params,
+            "status": "queued",
+            "result": None,
+            "error": None,
+            "createdAt": int(datetime.now().timestamp())
+        }
+
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('job')
+            result = coll.insert_one(job_document)
+            logging.info(f'Inserted {kind} job {result.inserted_id}')
+            return str(result.inserted_id)
+        except Exception as e:
+            logging.error(f'Error inserting {kind} job: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def updateJob(self, jobId, fields, owner=None):
+        """
+        Update a job. With an owner, the job is only updated while that process still holds it.
+        Returns whether the job was updated.
+        """
+        query = {"_id": bson.ObjectId(jobId)}
+        if owner is not None:
+            query["owner"] = owner
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('job')
+            return coll.update_one(query, {"$set": fields}).matched_count > 0
+        except Exception as e:
+            logging.error(f'Error updating job {jobId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def findJobById(self, jobId):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('job')
+            return coll.find_one({"_id": bson.ObjectId(jobId)})
+        except Exception as e:
+            logging.error(f'Error getting job for ID {jobId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def claimJob(self, jobId, owner, leaseUntil):
+        """
+        Atomically take a queued job, or a running job whose lease has expired, for an owner until leaseUntil.
+        Returns the job, or None if another process holds it or it has finished.
+        """
+        now = int(datetime.now().timestamp())
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('job')
+            return coll.find_one_and_update(
+                {"_id": bson.ObjectId(jobId), "$or": [{"status": "queued"}, {"status": "running", "leaseUntil": {"$not": {"$gte": now}}}]},
+                {"$set": {"status": "running", "owner": owner, "leaseUntil": leaseUntil, "startedAt": now}},
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        except Exception as e:
+            logging.error(f'Error claiming job {jobId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def findUnfinishedJobs(self, kinds):
+        """
+        Return the queued jobs and the running jobs whose lease has expired, as the process running them has stopped
+        """
+        now = int(datetime.now().timestamp())
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('job')
+            return list(coll.find({"kind": {"$in": kinds}, "$or": [{"status": "queued"}, {"status": "running", "leaseUntil": {"$not": {"$gte": now}}}]}).sort("createdAt", 1))
+        except Exception as e:
+            logging.error(f'Error getting unfinished jobs: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def findAllConfigs(self):
+        """
+        Yield the user config documents, with only the fields needed to plan a batch run
+        """
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('config')
+            yield from coll.find({}, {"userId": 1, "feedly.folders": 1, "batch": 1}).sort("userId", 1)
+        except Exception as e:
+            logging.error(f'Error getting the user configs: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def insertBatchRun(self, kinds, days, tasks):
+        batch_document = {
+            "kinds": kinds,
+            "days": days,
+            "tasks": tasks,
+            "status": "running",
+            "report": None,
+            "startedAt": int(datetime.now().timestamp())
+        }
+
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('batch')
+            result = coll.insert_one(batch_document)
+            logging.info(f'Inserted batch run {result.inserted_id} with {len(tasks)} tasks')
+            return str(result.inserted_id)
+        except Exception as e:
+            logging.error(f'Error inserting batch run: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def findUnfinishedBatchRun(self):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('batch')
+            return coll.find_one({"status": "running"}, sort=[("startedAt", -1)])
+        except Exception as e:
+            logging.error(f'Error getting the unfinished batch run: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def updateBatchTask(self, runId, taskId, fields):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('batch')
+            coll.update_one({"_id": bson.ObjectId(runId), "tasks.id": taskId}, {"$set": {f'tasks.$.{field}': value for field, value in fields.items()}})
+            return True
+        except Exception as e:
+            logging.error(f'Error updating task {taskId} of batch run {runId}: \n{e}')
+            raise Exception(e)
+
+    @traced('mongodb')
+    def updateBatchRun(self, runId, fields):
+        try:
+            db = self.client.get_database(name='InsightsAutomation')
+            coll = db.get_collection('batch')
+            coll.update_one({"_id": bson.ObjectId(runId)}, {"$set": fields})
+            return True
+        except Exception as e:
+            logging.error(f'Error updating batch run {runId}: \n{e}')
+            raise Exception(e)
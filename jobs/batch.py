@@ -0,0 +1,203 @@
+import os
+import time
+import json
+import logging
+import argparse
+import threading
+import traceback
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from main import Main
+from database.mongodb import MongoDB
+from monitoring.context import requestContext
+from monitoring.logs import configureLogging
+
+DEFAULT_POST_ROLE = 'You are a marketing manager working for a consultancy called ProfessionalPulse.'
+DEFAULT_IMAGE_PROMPT = 'Generate an image based on the following LinkedIn post:'
+
+class BatchRunner():
+    """
+    Runs the insights and LinkedIn posts of every user in the config collection through a bounded worker pool.
+    Tenants are served in turn with at most a few tasks each in flight, so a user with many folders cannot hold
+    up the others or exceed the OpenAI quota of its key. Each task is checkpointed in the batch collection, so a
+    run that was interrupted resumes with the tasks that had not completed.
+    """
+    def __init__(self, kinds=None, days=1, workers=None, tenant_concurrency=None):
+        self.kinds = kinds or ['insights']
+        self.days = days
+        self.workers = int(workers if workers is not None else os.getenv('BATCH_WORKERS', 8))
+        self.tenantConcurrency = int(tenant_concurrency if tenant_concurrency is not None else os.getenv('BATCH_TENANT_CONCURRENCY', 2))
+        self.mongo = MongoDB()
+        self.lock = threading.Lock()
+
+    def plan(self):
+        """
+        Return the tasks of a new run: one per folder for the insights and one per user for the LinkedIn post
+        """
+        tasks = []
+        for config in self.mongo.findAllConfigs():
+            settings = config.get('batch') or {}
+            if settings.get('enabled', True) is False:
+                continue
+
+            userId = config['userId']
+            folders = [folder for folder in str(config.get('feedly', {}).get('folders', '')).split(', ') if folder != '']
+            if 'insights' in self.kinds:
+                tasks += [{"id": f'{userId}/insights/{folder}', "userId": userId, "kind": "insights", "folder": folder, "status": "pending"} for folder in folders]
+            if 'linkedinpost' in self.kinds and folders:
+                tasks.append({"id": f'{userId}/linkedinpost', "userId": userId, "kind": "linkedinpost", "folder": None, "status": "pending"})
+        return tasks
+
+    def start(self, resume=True):
+        """
+        Resume the last unfinished run, or plan a new one, and run it to completion. Returns the report.
+        """
+        run = self.mongo.findUnfinishedBatchRun() if resume else None
+        if run is not None:
+            self.runId = str(run['_id'])
+            self.kinds = run['kinds']
+            self.days = run['days']
+            tasks = [task for task in run['tasks'] if task['status'] != 'completed']
+            logging.info(f'Resuming batch run {self.runId} with {len(tasks)} of {len(run["tasks"])} tasks left')
+        else:
+            tasks = self.plan()
+            self.runId = self.mongo.insertBatchRun(kinds=self.kinds, days=self.days, tasks=tasks)
+
+        report = self.run(tasks)
+        self.mongo.updateBatchRun(self.runId, {"status": "completed", "report": report, "finishedAt": int(datetime.now().timestamp())})
+        return report
+
+    def tenantLimit(self, userId):
+        # A limit below 1 would leave the tasks of the tenant queued forever
+        return max(1, self.limits.get(userId, self.tenantConcurrency))
+
+    def nextTask(self):
+        """
+        Return the next task in round-robin order among the tenants below their concurrency limit
+        """
+        for _ in range(len(self.order)):
+            userId = self.order[0]
+            self.order.rotate(-1)
+            if self.queues[userId] and self.running[userId] < self.tenantLimit(userId):
+                return self.queues[userId].popleft()
+        return None
+
+    def run(self, tasks):
+        self.queues = defaultdict(deque)
+        self.running = defaultdict(int)
+        self.limits = {}
+        self.stats = defaultdict(lambda: {"tasks": 0, "completed": 0, "failed": 0, "articles": 0, "seconds": 0.0, "firstStarted": None, "lastFinished": None})
+        for task in tasks:
+            self.queues[task['userId']].append(task)
+        self.order = deque(self.queues.keys())
+        for config in self.mongo.findAllConfigs():
+            concurrency = (config.get('batch') or {}).get('concurrency')
+            if concurrency is not None:
+                self.limits[config['userId']] = int(concurrency)
+
+        logging.info(f'Running {len(tasks)} tasks for {len(self.order)} users with {self.workers} workers')
+        started = time.monotonic()
+        inflight = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch-worker') as executor:
+            while inflight or any(self.queues.values()):
+                while len(inflight) < self.workers:
+                    task = self.nextTask()
+                    if task is None:
+                        break
+                    self.running[task['userId']] += 1
+                    inflight[executor.submit(self.runTask, task)] = task
+
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = inflight.pop(future)
+                    self.running[task['userId']] -= 1
+                    if future.exception() is not None:
+                        logging.error(f'Could not checkpoint batch task {task["id"]}: \n{future.exception()}')
+
+        return self.report(time.monotonic() - started)
+
+    def runTask(self, task):
+        # Log lines and spans of the task are tagged with the run and the task
+        with requestContext(f'batch-{self.runId}-{task["id"]}'):
+            stats = self.stats[task['userId']]
+            started = time.monotonic()
+            with self.lock:
+                stats["tasks"] += 1
+                stats["firstStarted"] = started if stats["firstStarted"] is None else stats["firstStarted"]
+            self.mongo.updateBatchTask(self.runId, task['id'], {"status": "running", "startedAt": int(datetime.now().timestamp())})
+
+            status = 'failed'
+            articles = 0
+            error = None
+            try:
+                result = self.execute(task)
+                status = 'completed' if result.get('status') in ['OK', 'no-articles-found'] else 'failed'
+                articles = result.get('articles', 0)
+                error = result.get('message')
+            except Exception as e:
+                logging.error(f'Error running batch task {task["id"]}: \n{traceback.format_exc()}')
+                error = str(e)
+
+            duration = time.monotonic() - started
+            with self.lock:
+                stats["completed" if status == 'completed' else "failed"] += 1
+                stats["articles"] += articles
+                stats["seconds"] += duration
+                stats["lastFinished"] = time.monotonic()
+            self.mongo.updateBatchTask(self.runId, task['id'], {"status": status, "error": error, "articles": articles, "duration": round(duration, 3)})
+            logging.info(f'Batch task {task["id"]} {status} in {duration:.1f}s')
+
+    def execute(self, task):
+        main = Main()
+        if task['kind'] == 'insights':
+            if not main.getConfig(task['userId']):
+                return {"status": "no-config-found"}
+            result = main.generateFolderInsights(userId=task['userId'], folder_id=task['folder'], days=self.days)
+            result['articles'] = len(result.get('urls', []))
+            return result
+
+        post = main.generateLinkedInPost(userId=task['userId'], days=self.days, insightIds=[], prompt_role=DEFAULT_POST_ROLE, post_prompt='', image_prompt=DEFAULT_IMAGE_PROMPT)
+        if isinstance(post, str):
+            return {"status": post}
+        return {"status": "OK", "articles": len(post[1])}
+
+    def report(self, elapsed):
+        """
+        Per-tenant duration and throughput of the run
+        """
+        tenants = {}
+        for userId, stats in self.stats.items():
+            wall = (stats["lastFinished"] or 0) - (stats["firstStarted"] or 0)
+            tenants[userId] = {
+                "tasks": stats["tasks"],
+                "completed": stats["completed"],
+                "failed": stats["failed"],
+                "articles": stats["articles"],
+                "busySeconds": round(stats["seconds"], 2),
+                "wallSeconds": round(max(wall, 0), 2),
+                "tasksPerMinute": round(stats["tasks"] * 60 / wall, 2) if wall > 0 else None,
+                "articlesPerSecond": round(stats["articles"] / stats["seconds"], 2) if stats["seconds"] > 0 else None
+            }
+
+        report = {
+            "runId": self.runId,
+            "seconds": round(elapsed, 2),
+            "tasks": sum(tenant["tasks"] for tenant in tenants.values()),
+            "failed": sum(tenant["failed"] for tenant in tenants.values()),
+            "tenants": tenants
+        }
+        logging.info(f'Batch run {self.runId} finished in {elapsed:.1f}s: {report["tasks"]} tasks, {report["failed"]} failed')
+        return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the insights and LinkedIn posts of every user')
+    parser.add_argument('--kinds', default='insights', help='Comma-separated list of insights and linkedinpost')
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--new', action='store_true', help='Start a new run instead of resuming the last unfinished one')
+    args = parser.parse_args()
+
+    configureLogging()
+    runner = BatchRunner(kinds=args.kinds.split(','), days=args.days, workers=args.workers)
+    print(json.dumps(runner.start(resume=not args.new), indent=2))
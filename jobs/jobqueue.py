@@ -0,0 +1,146 @@
+import os
+import time
+import uuid
+import queue
+import socket
+import logging
+import threading
+import traceback
+from datetime import datetime
+from database.mongodb import MongoDB
+from monitoring.context import requestContext
+
+class JobQueue():
+    """
+    In-process bounded queue of background jobs executed by a pool of worker threads.
+    Jobs are persisted in the job collection so that queued and interrupted jobs are resumed after a restart.
+    Several processes share the collection, so a job is claimed atomically before it runs and the process running
+    it renews a lease on it. A running job is only resumed elsewhere once its lease has expired.
+    """
+    def __init__(self, handlers, workers=None, size=None, lease=None):
+        self.handlers = handlers
+        self.workers = int(workers if workers is not None else os.getenv('JOB_WORKERS', 4))
+        self.queue = queue.Queue(maxsize=int(size if size is not None else os.getenv('JOB_QUEUE_SIZE', 100)))
+        self.lease = int(lease if lease is not None else os.getenv('JOB_LEASE_SECONDS', 300))
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def start(self):
+        """
+        Start the workers, and resume the unfinished jobs from a background thread so that start-up does not wait for MongoDB
+        """
+        if self.threads:
+            return
+
+        self.stopping.clear()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logging.info(f'Started {self.workers} job workers')
+
+        threading.Thread(target=self.resume, name='job-resume', daemon=True).start()
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+        self.threads = []
+        logging.info('Stopped job workers')
+
+    def resume(self):
+        """
+        Requeue the queued jobs, and the running jobs whose process stopped before their lease expired. Jobs queued
+        by another live process may be requeued here too, but only the process that claims a job first runs it.
+        """
+        try:
+            jobs = MongoDB().findUnfinishedJobs(kinds=list(self.handlers.keys()))
+        except Exception as e:
+            logging.error(f'Could not resume unfinished jobs: \n{e}')
+            return
+
+        for job in jobs:
+            jobId = str(job['_id'])
+            try:
+                self.queue.put_nowait(jobId)
+                logging.info(f'Resumed job {jobId}')
+            except queue.Full:
+                logging.warning(f'Job queue is full, job {jobId} will be resumed on the next restart')
+                break
+
+    def submit(self, kind, params):
+        """
+        Persist and enqueue a job. Returns the job ID, or None if the queue is full.
+        """
+        if kind not in self.handlers:
+            raise Exception(f'Unknown job type: {kind}')
+        if self.queue.full():
+            return None
+
+        mongo = MongoDB()
+        jobId = mongo.insertJob(kind=kind, params=params)
+        try:
+            self.queue.put_nowait(jobId)
+        except queue.Full:
+            mongo.updateJob(jobId, {"status": "rejected"})
+            return None
+
+        logging.info(f'Queued {kind} job {jobId}')
+        return jobId
+
+    def getJob(self, jobId):
+        return MongoDB().findJobById(jobId)
+
+    def work(self):
+        while not self.stopping.is_set():
+            try:
+                jobId = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            try:
+                with requestContext(f'job-{jobId}'):
+                    self.run(jobId)
+            finally:
+                self.queue.task_done()
+
+    def run(self, jobId):
+        mongo = MongoDB()
+        job = mongo.claimJob(jobId, self.owner, int(time.time()) + self.lease)
+        if job is None:
+            logging.info(f'Job {jobId} is already running or finished')
+            return
+
+        logging.info(f'Running {job["kind"]} job {jobId}')
+        renewing = threading.Event()
+        threading.Thread(target=self.renewLease, args=(jobId, renewing), name=f'job-lease-{jobId}', daemon=True).start()
+        try:
+            result = self.handlers[job['kind']](job['params'])
+            fields = {"status": "completed", "result": result}
+            logging.info(f'Completed {job["kind"]} job {jobId}')
+        except Exception as e:
+            logging.error(f'Error running {job["kind"]} job {jobId}: \n{traceback.format_exc()}')
+            fields = {"status": "failed", "error": str(e)}
+        finally:
+            renewing.set()
+
+        if not mongo.updateJob(jobId, dict(fields, finishedAt=int(datetime.now().timestamp()), leaseUntil=None), owner=self.owner):
+            logging.warning(f'Job {jobId} was taken over by another process after its lease expired')
+
+    def renewLease(self, jobId, done):
+        """
+        Extend the lease of a running job a few times per lease period until it finishes
+        """
+        while not done.wait(self.lease / 3):
+            try:
+                MongoDB().updateJob(jobId, {"leaseUntil": int(time.time()) + self.lease}, owner=self.owner)
+            except Exception as e:
+                logging.warning(f'Could not renew the lease of job {jobId}: {e}')
+
+    def stats(self):
+        return {
+            "workers": len(self.threads),
+            "queued": self.queue.qsize(),
+            "capacity": self.queue.maxsize
+        }
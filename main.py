@@ -1,29 +1,80 @@
 import os
+import hashlib
 from dotenv import load_dotenv
-import requests
-import json
 from datetime import datetime, timedelta
-import openai
-import smtplib
-import tiktoken
 import sys
 import logging
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from database.mongodb import MongoDB
+from database.articlestore import ArticleStore
+from database.fingerprints import FingerprintIndex
+from clients.feedly import Feedly
+from clients.feedlyauth import FeedlyManager
+from clients.ratelimit import RateLimiter
+from clients.lazy import lazyImport
+from clients.smtppool import SMTPSender
+from cache.llmcache import LLMCache
+from cache.configcache import ConfigCache
+from processing.packing import PromptPacker, countTokens, truncateToTokens
+from processing.cleaning import cleanArticles
+from processing.dedup import dedupeArticles
+from processing.ranking import rankArticles
+from processing.digest import DAY_MS, MAX_SOURCE_MS, dayStart, completeDays, segmentDays, childSegments, segmentLabel, coverDay, splitByDay
+from monitoring.context import requestContext, bind
+from monitoring.metrics import span, traceIter, chatCost, imageCost
+from monitoring.logs import configureLogging
+
+# Imported on first use to keep the start-up of the application fast
+openai = lazyImport('openai')
+requests = lazyImport('requests')
 
 class Main():
-  def __init__(self):
-    logging.basicConfig(level=logging.DEBUG)
+  def __init__(self, useCache=True, incremental=None, fromStore=False, pipelined=None):
+    configureLogging()
+    self.cache = LLMCache.getInstance() if useCache else None
+    self.store = ArticleStore.getInstance()
+    # Incremental runs only fetch the articles newer than the high-water mark of the previous run
+    self.incremental = incremental if incremental is not None else os.getenv('INCREMENTAL_FETCH', 'false').lower() == 'true'
+    # Rebuild the articles of the window from the local store without calling Feedly
+    self.fromStore = fromStore
+    # Generate the image from a brief of the post while the post is written, instead of from the post afterwards
+    self.pipelined = pipelined if pipelined is not None else os.getenv('IMAGE_PIPELINE', 'false').lower() == 'true'
+    self.watermarks = {}
+    # Window of the articles fetched for each folder, saved with the insights so that digests can reuse them
+    self.windows = {}
+    self.userId = None
+    self.mongo = None
+    self.OPENAI_API_KEY = None
 
     self.FEEDLY_API_URL = os.getenv('FEEDLY_API_URL', 'https://cloud.feedly.com')
     self.MODEL = 'gpt-4-1106-preview'
     self.MAX_TOKENS = 128000
+    # Token budget for the articles sent in a single prompt. Folders that do not fit are summarised in chunks first.
+    self.PROMPT_TOKEN_BUDGET = min(int(os.getenv('PROMPT_TOKEN_BUDGET', 32000)), self.MAX_TOKENS)
+    self.SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', 4))
+    self.FOLDER_WORKERS = int(os.getenv('FOLDER_WORKERS', 4))
+    # Expected length of a completion, reserved from the token rate limit until the actual usage is known
+    self.COMPLETION_TOKENS = int(os.getenv('OPENAI_COMPLETION_TOKENS', 1000))
+    self.IMAGE_BRIEF_TOKENS = int(os.getenv('IMAGE_BRIEF_TOKENS', 200))
+    # DALL-E image URLs expire after an hour, so the images can be downloaded to this directory
+    self.IMAGE_STORE_DIR = os.getenv('IMAGE_STORE_DIR')
+    # Only the articles most relevant to the keywords or the post prompt are sent, up to RANK_TOP_K and the token budget
+    self.RANK_TOP_K = int(os.getenv('RANK_TOP_K', 0))
+    self.RANK_TOKEN_BUDGET = int(os.getenv('RANK_TOKEN_BUDGET', self.PROMPT_TOKEN_BUDGET))
+    self.KEYWORDS = ''
+    # SMTP sender shared by the emails of a run
+    self.mailer = None
 
   def getLocalConfig(self):
     # Load environment variables
     logging.info('Loading environment variables...')
     load_dotenv()
     self.FEEDLY_USER_ID = os.getenv('FEEDLY_USER_ID')
+    self.userId = self.FEEDLY_USER_ID
     self.FEEDLY_ACCESS_TOKEN = os.getenv('FEEDLY_ACCESS_TOKEN')
+    self.FEEDLY_CONFIG = {'accessToken': self.FEEDLY_ACCESS_TOKEN, 'refreshToken': os.getenv('FEEDLY_REFRESH_TOKEN')}
     self.FEEDLY_FOLDERS = os.getenv('FEEDLY_FOLDERS')
     if self.FEEDLY_FOLDERS is not None:
       self.FEEDLY_FOLDERS_LIST = str(self.FEEDLY_FOLDERS).split(',')
@@ -31,6 +82,7 @@ class Main():
     self.EMAIL_USERNAME = os.getenv('EMAIL_USERNAME')
     self.EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
     self.EMAIL_RECIPIENT = os.getenv('EMAIL_RECIPIENT')
+    self.KEYWORDS = os.getenv('KEYWORDS', '')
 
     if(self.FEEDLY_ACCESS_TOKEN is not None):
       self.setupClients()
@@ -38,104 +90,519 @@ class Main():
   def getConfig(self, userId):
     logging.info(f'Get config for user {userId}')
     self.mongo = MongoDB()
-    config = self.mongo.findConfigForUser(userId=userId)
-    if config is not None:
-      self.FEEDLY_USER_ID = config['feedly']['user']
-      self.FEEDLY_ACCESS_TOKEN = config['feedly']['accessToken']
-      self.FEEDLY_FOLDERS_LIST = str(config['feedly']['folders']).split(', ')
-      self.OPENAI_API_KEY = config['openai']['apiKey']
-      self.EMAIL_USERNAME = config['google']['emailUsername']
-      self.EMAIL_PASSWORD = config['google']['emailPassword']
-      self.EMAIL_RECIPIENT = config['google']['emailRecipient']
-
-      self.setupClients()
-      return True
-    else:
-      return False
+    cache = ConfigCache.getInstance()
+    entry = cache.get(userId)
+    if entry is None:
+      config = self.mongo.findConfigForUser(userId=userId)
+      if config is None:
+        return False
+      entry = cache.put(userId, config)
+
+    self.userId = userId
+    self.applyConfig(entry['config'], entry['clients'])
+    return True
+
+  def applyConfig(self, config, clients=None):
+    self.FEEDLY_USER_ID = config['feedly']['user']
+    self.FEEDLY_ACCESS_TOKEN = config['feedly']['accessToken']
+    self.FEEDLY_CONFIG = config['feedly']
+    self.FEEDLY_FOLDERS_LIST = str(config['feedly']['folders']).split(', ')
+    self.OPENAI_API_KEY = config['openai']['apiKey']
+    self.EMAIL_USERNAME = config['google']['emailUsername']
+    self.EMAIL_PASSWORD = config['google']['emailPassword']
+    self.EMAIL_RECIPIENT = config['google']['emailRecipient']
+    keywords = config.get('keywords', '')
+    self.KEYWORDS = ', '.join(keywords) if isinstance(keywords, list) else str(keywords)
+
+    self.setupClients(clients)
+
+  def setupClients(self, clients=None):
+    """
+    Setup the clients, reusing the ones cached with the user config if there are any
+    """
+    if clients is not None and 'feedly' in clients:
+      self.feedly = clients['feedly']
+      return
 
-  def setupClients(self):
-    # Setup clients
     logging.info('Setting up the API clients...')
-    self.feedly = requests.Session()
-    self.feedly.headers = {'authorization': f'OAuth {self.FEEDLY_ACCESS_TOKEN}'}
+    credentials = self.getFeedlyCredentials()
+    self.feedly = Feedly(FeedlyManager.getInstance().getSession(), self.FEEDLY_API_URL, limiter=RateLimiter.forKey('feedly', credentials.key), credentials=credentials)
     openai.api_key = self.OPENAI_API_KEY
 
+    if clients is not None:
+      clients['feedly'] = self.feedly
+
+  def getFeedlyCredentials(self):
+    """
+    Return the Feedly credentials of the user, shared by every request of the process. The tokens of the users
+    of the config collection are saved back to it when they are refreshed.
+    """
+    load = save = None
+    if self.mongo is not None:
+      userId = self.userId
+      # The tokens are refreshed in background threads, so the synchronous client is used for both pipelines
+      load = lambda: MongoDB().findFeedlyToken(userId=userId)
+      save = lambda accessToken, expiresAt, refreshToken: Main.saveFeedlyToken(userId, accessToken, expiresAt, refreshToken)
+    return FeedlyManager.getInstance().forUser(self.userId or self.FEEDLY_ACCESS_TOKEN, self.FEEDLY_CONFIG, self.FEEDLY_API_URL, load=load, save=save)
+
+  @staticmethod
+  def saveFeedlyToken(userId, accessToken, expiresAt, refreshToken):
+    MongoDB().updateFeedlyToken(userId=userId, accessToken=accessToken, expiresAt=expiresAt, refreshToken=refreshToken)
+    # The cached config still holds the previous token
+    ConfigCache.getInstance().invalidate(userId)
+
   def count_tokens(self, text):
-      enc = tiktoken.get_encoding("cl100k_base")
-      token_count = enc.encode(text)
-      
-      return len(token_count)
+      return countTokens(text)
+
+  def summariseArticles(self, article_prompts):
+    """
+    Summarise a chunk of articles, keeping the source of each insight
+    """
+    role = 'You are a research analyst.'
+    return self.callOpenAIChat(role, self.buildSummaryPrompt(article_prompts))
+
+  def buildSummaryPrompt(self, article_prompts):
+    prompt = f'Summarise the key insights & trends in UK English from these {len(article_prompts)} articles and highlight any resources worth checking. For each key insight, keep the URL and title of the source article:\n'
+    prompt += ''.join(article_prompts)
+    return prompt
+
+  def condenseArticles(self, article_prompts, instructions=''):
+    """
+    Fit the article prompts in the token budget left after the instructions.
+    If the articles do not fit, chunks of articles are summarised in parallel (map) and the summaries
+    are returned in their place so that they can be combined in the final prompt (reduce). The summaries
+    are summarised again until they fit, as long as each round leaves fewer chunks.
+    The article prompts can be a generator, in which case the first chunks are summarised while
+    the remaining articles are still being fetched. Articles ranked against keywords or a query are
+    only yielded once the whole window has been fetched, see rankArticles.
+    """
+    with span('prompt'):
+      packer = PromptPacker(self.PROMPT_TOKEN_BUDGET)
+      reserved = self.count_tokens(instructions)
+      chunks = packer.iterPack(article_prompts, reserved=reserved)
+
+      first = next(chunks, None)
+      second = next(chunks, None) if first is not None else None
+      if second is None:
+        return ''.join(first) if first is not None else ''
+
+      texts = self.summariseChunks(itertools.chain([first, second], chunks))
+      while True:
+        chunks = packer.pack(texts, reserved=reserved)
+        if len(chunks) == 1:
+          return ''.join(chunks[0])
+        if len(chunks) >= len(texts):
+          return self.truncateChunks(chunks)
+        texts = self.summariseChunks(chunks)
+
+  def truncateChunks(self, chunks):
+    """
+    Keep the first chunk when summarising no longer reduces the number of chunks, as the summaries are too long to combine
+    """
+    dropped = sum(len(chunk) for chunk in chunks[1:])
+    logging.warning(f'Summaries do not fit in the prompt: dropping {len(chunks) - 1} of {len(chunks)} chunks ({dropped} summaries)')
+    return ''.join(chunks[0])
+
+  def summariseChunks(self, chunks):
+    """
+    Summarise the chunks in parallel as they are packed, with a bounded number of chunks waiting for a worker
+    """
+    slots = threading.BoundedSemaphore(self.SUMMARY_WORKERS * 2)
+    futures = []
+    with ThreadPoolExecutor(max_workers=self.SUMMARY_WORKERS) as executor:
+      for chunk in chunks:
+        slots.acquire()
+        future = executor.submit(bind(self.summariseArticles), chunk)
+        future.add_done_callback(lambda future: slots.release())
+        futures.append(future)
+      logging.info(f'Summarising {len(futures)} chunks of articles')
+
+    return [f'\n{future.result()}\n' for future in futures]
+
+  def trackArticles(self, articles, urls, titles=None):
+    """
+    Yield the articles, recording their URLs, and optionally their titles, as they stream past
+    """
+    for article in articles:
+      urls.append(article['url'])
+      if titles is not None:
+        titles.append(article['title'])
+      yield article
+
+  def buildArticlePrompts(self, articles):
+    for a in articles:
+      prompt = f'\nURL: {a["url"]}\n'
+      if a.get('absorbedUrls'):
+        prompt += f'Also published at: {", ".join(a["absorbedUrls"])}\n'
+      yield prompt + f'Title: {a["title"]}\nSummary: {a["summary"]}\nContent: {a["content"]}\n'
+
+  def processFolders(self, process):
+    """
+    Run process(folder_id) for every configured folder in a bounded pool of workers.
+    Returns one result per folder, in the order of the folders list.
+    """
+    folders = [folder_id for folder_id in self.FEEDLY_FOLDERS_LIST if folder_id != '']
+    if len(folders) == 0:
+      return []
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(self.FOLDER_WORKERS, len(folders)))) as executor:
+      futures = [executor.submit(bind(process), folder_id) for folder_id in folders]
+      for folder_id, future in zip(folders, futures):
+        try:
+          results.append(future.result())
+        except Exception as e:
+          logging.error(f'Error processing folder {folder_id}: \n{e}')
+          results.append({"folder": folder_id, "status": "error", "message": str(e)})
+
+    return results
+
+  def readCache(self, kind, **params):
+    """
+    Return the cache key of the request and the cached response, if any
+    """
+    key = LLMCache.makeKey(kind, **params)
+    if self.cache is None:
+      return key, None
+
+    cached = self.cache.get(key, kind=kind)
+    if cached is not None:
+      logging.info(f'Returning cached {kind} response {key[:12]}')
+    return key, cached
+
+  def writeCache(self, key, value, kind):
+    if self.cache is not None:
+      self.cache.set(key, value, kind=kind)
 
   def callOpenAIChat(self, role, prompt):
-    response = openai.ChatCompletion.create(
-      model=self.MODEL, 
-      temperature=0.2,
-      n=1,
-      messages=[
-        {'role': 'system', 'content': role}, 
-        {'role': 'user', 'content': prompt}
-      ]
+    with span('openai.chat', model=self.MODEL) as chat:
+      temperature = 0.2
+      key, cached = self.readCache('chat', model=self.MODEL, temperature=temperature, role=role, prompt=prompt)
+      if cached is not None:
+        chat.set(cached=True)
+        return cached
+
+      limiter = RateLimiter.forKey('openai', self.OPENAI_API_KEY)
+      tokens = self.count_tokens(role) + self.count_tokens(prompt) + self.COMPLETION_TOKENS
+      response = limiter.call(lambda: openai.ChatCompletion.create(
+        api_key=self.OPENAI_API_KEY,
+        model=self.MODEL, 
+        temperature=temperature,
+        n=1,
+        messages=[
+          {'role': 'system', 'content': role}, 
+          {'role': 'user', 'content': prompt}
+        ]
+      ), tokens=tokens)
+      limiter.settle(tokens, response.get('usage', {}).get('total_tokens'))
+      content = response['choices'][0]['message']['content']
+      self.recordUsage(chat, role, prompt, content, response.get('usage'))
+
+      self.writeCache(key, content, kind='chat')
+      return content
+
+  def recordUsage(self, chat, role, prompt, content, usage=None):
+    """
+    Add the size, tokens and cost of a completion to its span. Tokens are estimated when the usage is not reported.
+    """
+    usage = usage or {}
+    promptTokens = usage.get('prompt_tokens') or self.count_tokens(role) + self.count_tokens(prompt)
+    completionTokens = usage.get('completion_tokens') or self.count_tokens(content)
+    chat.set(
+      bytes=len(role.encode('utf-8')) + len(prompt.encode('utf-8')) + len(content.encode('utf-8')),
+      promptTokens=promptTokens,
+      completionTokens=completionTokens,
+      cost=chatCost(self.MODEL, promptTokens, completionTokens)
     )
-    return response['choices'][0]['message']['content']
 
   def callOpenAIImage(self, prompt):
-    response = openai.Image.create(
-      model="dall-e-3",
-      prompt=prompt,
-      size="1024x1024",
-      quality="standard",
-      n=1,
-    )
-
-    return response.data[0].url
+    model = "dall-e-3"
+    size = "1024x1024"
+    quality = "standard"
+    with span('openai.image', model=model) as image:
+      key, cached = self.readCache('image', model=model, size=size, quality=quality, prompt=prompt)
+      if cached is not None:
+        image.set(cached=True)
+        return cached
+
+      response = RateLimiter.forKey('openai-image', self.OPENAI_API_KEY).call(lambda: openai.Image.create(
+        api_key=self.OPENAI_API_KEY,
+        model=model,
+        prompt=prompt,
+        size=size,
+        quality=quality,
+        n=1,
+      ))
+      url = response.data[0].url
+      image.set(bytes=len(prompt.encode('utf-8')), cost=imageCost(model, quality, size))
+
+      self.writeCache(key, url, kind='image')
+      return url
 
   def generateInsights(self, days, userId):
     """
-    Generate insights from the articles
+    Generate insights from the articles of every folder
     """
     if self.getConfig(userId):
-      for folder_id in self.FEEDLY_FOLDERS_LIST:
-        articles = self.getArticles(folder_id=folder_id, daysdelta=days)
-
-        if articles:
-          logging.info(f'Generating insights from articles in folder: {folder_id}')
-          article_prompts = [f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n' for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents)]
-          
-          role = 'You are a research analyst.'
-          prompt = f'Extract the key insights & trends in UK English from these {self.article_count} articles and highlight any resources worth checking. For each key insight, mention the source article:\n'
-          for article_prompt in article_prompts:
-            prompt += article_prompt
-          insights = self.callOpenAIChat(role, prompt)
-
-          self.mongo = MongoDB()
-          if self.mongo.insertInsights(userId=userId, insights=insights, urls=self.urls):
-            return [insights, self.urls]
-          else:
-            return "insights-failed"
-        else:
-          return "no-articles-found"
+      return self.processFolders(lambda folder_id: self.generateFolderInsights(userId=userId, folder_id=folder_id, days=days))
     else: 
       return "no-config-found"
 
-  def emailInsights(self):
+  def generateFolderInsights(self, userId, folder_id, days):
     """
-    Generate insights from the articles
+    Generate and save the insights from the articles in a folder
     """
-    for folder_id in self.FEEDLY_FOLDERS_LIST:
-      articles = self.getArticles(folder_id=folder_id, daysdelta=1)
+    urls = []
+    role = 'You are a research analyst.'
+    articles = self.trackArticles(self.iterArticles(folder_id=folder_id, daysdelta=days), urls)
+    condensed = self.condenseArticles(self.buildArticlePrompts(articles), instructions=role + self.buildInsightsPrompt(0))
+
+    if urls:
+      logging.info(f'Generating insights from {len(urls)} articles in folder: {folder_id}')
+      prompt = self.buildInsightsPrompt(len(urls)) + condensed
+      insights = self.callOpenAIChat(role, prompt)
+
+      since, until = self.windows.get(folder_id, (None, None))
+      insightId = self.mongo.insertInsights(userId=userId, insights=insights, urls=urls, folder=folder_id, since=since, until=until)
+      if insightId:
+        self.commitWatermark(folder_id)
+        return {"folder": folder_id, "status": "OK", "insightId": insightId, "insights": insights, "urls": urls}
+      else:
+        return {"folder": folder_id, "status": "insights-failed"}
+    else:
+      return {"folder": folder_id, "status": "no-articles-found"}
 
-      if articles:
-        logging.info(f'Generating insights from articles in folder: {folder_id}')
-        article_prompts = [f'URL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n' for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents)]
-        
-        role = 'You are a research analyst writing in UK English.'
-        prompt = f'Extract the key insights & trends from these {self.article_count} articles and highlight any resources worth checking. For each key insight, mention the source article:\n'
-        for article_prompt in article_prompts:
-          prompt += article_prompt
+  def buildInsightsPrompt(self, article_count):
+    return f'Extract the key insights & trends in UK English from these {article_count} articles and highlight any resources worth checking. For each key insight, mention the source article:\n'
 
-        insights = self.callOpenAIChat(role, prompt)
+  def generateDigest(self, days, userId):
+    """
+    Generate a digest of the insights of the last `days` complete days for every folder
+    """
+    if self.getConfig(userId):
+      return self.processFolders(lambda folder_id: self.generateFolderDigest(userId=userId, folder_id=folder_id, days=days))
+    else:
+      return "no-config-found"
 
-      self.sendEmail(subject=f'Feedly Insights from {self.article_count} articles for folder {folder_id}', body=insights, urls=self.urls)
+  def generateFolderDigest(self, userId, folder_id, days):
+    """
+    Combine the daily insights of a folder into a digest. The insights already stored for a day are reused and only
+    the missing days are generated. Days are combined into weekly and monthly roll-ups, which are cached in the
+    digest collection, so a long window costs little more than the days that have not been summarised yet.
+    """
+    window = completeDays(days)
+    first, last = window[0], window[-1]
+    cached = {(digest['period'], digest['start']): digest for digest in self.mongo.findDigests(userId, folder_id, first.isoformat(), last.isoformat())}
+    segments = segmentDays(window)
+    needed = self.findDigestDays(segments, cached)
+    stats = {"reusedDays": 0, "generatedDays": 0, "emptyDays": 0, "cachedRollups": 0, "generatedRollups": 0}
+
+    # Insights generated from windows overlapping the first and last days can still count for them
+    stored = self.mongo.findInsightsInWindow(userId, folder_id, since=dayStart(first) - MAX_SOURCE_MS, until=dayStart(last) + DAY_MS + MAX_SOURCE_MS) if needed else []
+    dayInsights = {}
+    missing = []
+    # An insight overlapping two days counts for both, but its text is only used for the first of them
+    used = set()
+    for day in needed:
+      if ('day', day.isoformat()) in cached:
+        dayInsights[day] = dict(cached[('day', day.isoformat())], complete=True)
+        stats["emptyDays"] += 1
+        continue
+
+      covering = coverDay(stored, day)
+      if covering is None:
+        missing.append(day)
+      else:
+        covering = [insight for insight in covering if insight['_id'] not in used]
+        used.update(insight['_id'] for insight in covering)
+        dayInsights[day] = {"insights": '\n'.join(insight['insights'] for insight in covering), "urls": [url for insight in covering for url in insight['urls']], "complete": True}
+        stats["reusedDays"] += 1
+    dayInsights.update(self.generateDigestDays(userId, folder_id, missing, stats))
+
+    parts = [self.buildDigestSegment(userId, folder_id, period, start, end, cached, dayInsights, stats) for period, start, end in segments]
+    parts = [part for part in parts if part['insights']]
+    logging.info(f'Digest of folder {folder_id} from {first} to {last}: {stats}')
+    if not parts:
+      return {"folder": folder_id, "status": "no-articles-found", **stats}
+
+    return {
+      "folder": folder_id,
+      "status": "OK",
+      "from": first.isoformat(),
+      "to": last.isoformat(),
+      "digest": self.combineDigestParts(segmentLabel('days', first, last), parts),
+      "urls": list(dict.fromkeys(url for part in parts for url in part['urls'])),
+      **stats
+    }
+
+  def findDigestDays(self, segments, cached):
+    """
+    Return the days needed to build the segments, leaving out the ones covered by a cached roll-up
+    """
+    days = []
+    for period, start, end in segments:
+      if period == 'day':
+        days.append(start)
+      elif (period, start.isoformat()) not in cached:
+        days += self.findDigestDays(childSegments(period, start, end), cached)
+    return days
+
+  def generateDigestDays(self, userId, folder_id, days, stats):
+    """
+    Generate and save the insights of the days missing from a digest, from a single fetch of the articles
+    since the first of them. Days known to have no articles are recorded so that they are not fetched again.
+    A day without articles that is not known to be empty, as the fetch may have failed or stopped before
+    reaching it, is returned as incomplete so that the roll-ups holding it are not cached.
+    """
+    if not days:
+      return {}
+
+    since = dayStart(days[0])
+    articles = list(traceIter('articles', self.fetchArticles(folder_id, since), measure=self.measureArticle, folder=folder_id))
+    # Feedly returns the newest articles first, so a day is only known to be empty if older articles were fetched
+    oldest = min((article['timestamp'] for article in articles), default=None)
+    groups = splitByDay(self.removeDuplicates(articles, since, folder_id), days)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=self.SUMMARY_WORKERS) as executor:
+      futures = {day: executor.submit(bind(self.generateDayInsights), userId, folder_id, day, dayArticles) for day, dayArticles in groups.items() if dayArticles}
+    for day in days:
+      if day in futures:
+        results[day] = dict(futures[day].result(), complete=True)
+        stats["generatedDays"] += 1
+      else:
+        known = oldest is not None and oldest < dayStart(day)
+        results[day] = {"insights": '', "urls": [], "complete": known}
+        stats["emptyDays"] += 1
+        if known:
+          self.mongo.saveDigest(userId, folder_id, 'day', day.isoformat(), day.isoformat(), '', [])
+    return results
+
+  def generateDayInsights(self, userId, folder_id, day, articles):
+    """
+    Generate and save the insights of the articles of a day, with the day as their window
+    """
+    articles = list(self.rankArticles(articles))
+    logging.info(f'Generating the insights of {day} from {len(articles)} articles in folder: {folder_id}')
+    role = 'You are a research analyst.'
+    prompt = self.buildInsightsPrompt(len(articles))
+    prompt += self.condenseArticles(self.buildArticlePrompts(articles), instructions=role + prompt)
+    insights = self.callOpenAIChat(role, prompt)
+    urls = [article['url'] for article in articles]
+    self.mongo.insertInsights(userId=userId, insights=insights, urls=urls, folder=folder_id, since=dayStart(day), until=dayStart(day) + DAY_MS)
+    return {"insights": insights, "urls": urls}
+
+  def buildDigestSegment(self, userId, folder_id, period, start, end, cached, days, stats):
+    """
+    Return the label, insights and URLs of a day, or of a roll-up combined from its weeks and days. A roll-up is only
+    cached once every one of its days was reused, generated or is known to be empty, so that a failed fetch is not
+    kept in every later digest.
+    """
+    label = segmentLabel(period, start, end)
+    if period == 'day':
+      return {"label": label, "insights": days[start]['insights'], "urls": days[start]['urls'], "complete": days[start]['complete']}
+    if (period, start.isoformat()) in cached:
+      stats["cachedRollups"] += 1
+      rollup = cached[(period, start.isoformat())]
+      return {"label": label, "insights": rollup['insights'], "urls": rollup['urls'], "complete": True}
+
+    children = [self.buildDigestSegment(userId, folder_id, *child, cached, days, stats) for child in childSegments(period, start, end)]
+    complete = all(child['complete'] for child in children)
+    parts = [part for part in children if part['insights']]
+    insights = self.combineDigestParts(label, parts) if parts else ''
+    urls = list(dict.fromkeys(url for part in parts for url in part['urls']))
+    if complete:
+      self.mongo.saveDigest(userId, folder_id, period, start.isoformat(), end.isoformat(), insights, urls)
+    else:
+      logging.info(f'Not caching the digest of {label} for folder {folder_id}, as some of its days could not be fetched')
+    stats["generatedRollups"] += 1
+    return {"label": label, "insights": insights, "urls": urls, "complete": complete}
+
+  def combineDigestParts(self, label, parts):
+    """
+    Combine the insights of several periods into one, or return the insights of a single period as they are
+    """
+    if len(parts) == 1:
+      return parts[0]['insights']
+
+    role = 'You are a research analyst.'
+    prompt = self.buildDigestPrompt(label, len(parts))
+    texts = [f'\nPeriod: {part["label"]}\n{part["insights"]}\n' for part in parts]
+    prompt += self.condenseArticles(texts, instructions=role + prompt)
+    return self.callOpenAIChat(role, prompt)
+
+  def buildDigestPrompt(self, label, period_count):
+    return f'Combine these insights from {period_count} periods covering {label} into a digest of the key insights & trends in UK English. Focus on the trends that recur across the periods and highlight any resources worth checking. For each key insight, keep the URL of the source article:\n'
+
+  def emailInsights(self):
+    """
+    Generate insights from the articles of every folder and email them over a single SMTP connection
+    """
+    try:
+      with SMTPSender(self.EMAIL_USERNAME, self.EMAIL_PASSWORD) as self.mailer:
+        return self.processFolders(self.emailFolderInsights)
+    finally:
+      self.mailer = None
+
+  def emailFolderInsights(self, folder_id):
+    urls = []
+    role = 'You are a research analyst writing in UK English.'
+    header = lambda article_count: f'Extract the key insights & trends from these {article_count} articles and highlight any resources worth checking. For each key insight, mention the source article:\n'
+    articles = self.trackArticles(self.iterArticles(folder_id=folder_id, daysdelta=1), urls)
+    condensed = self.condenseArticles(self.buildArticlePrompts(articles), instructions=role + header(0))
+
+    if urls:
+      logging.info(f'Generating insights from {len(urls)} articles in folder: {folder_id}')
+      insights = self.callOpenAIChat(role, header(len(urls)) + condensed)
+
+      if not self.sendEmail(subject=f'Feedly Insights from {len(urls)} articles for folder {folder_id}', body=insights, urls=urls):
+        return {"folder": folder_id, "status": "error", "message": "Could not send the email"}
+      self.commitWatermark(folder_id)
+      return {"folder": folder_id, "status": "OK"}
+    else:
+      return {"folder": folder_id, "status": "no-articles-found"}
+
+  def buildInsightsPostPrompt(self, post_prompt, insights, urls):
+    """
+    Build the LinkedIn post prompt from previously generated insights
+    """
+    if post_prompt != '':
+      return f'{post_prompt} \n{insights} \n{urls}'
+
+    prompt = f'\nContext: My mission is to demystify AI and make it accessible and practical for professional services firms. Through ProfessionalPulse, I aim to deliver bespoke AI data strategies that are not only technically sound but also align with the '
+    prompt += f'unique business goals and challenges of each client. We strive to turn AI from a concept into a tangible asset, driving innovation, efficiency, and competitive advantage.'
+    prompt += f'\nThe post must be written from the voice of the consultancy.'
+    prompt += f'\nDo not use the context in the post. It\'s for your information only.'
+    prompt += f'\nYou should only talk about the insights extracted from these articles with a bias towards process automation.'
+    prompt += f'\nWord the insights as if I was commenting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
+    prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and technology, and sound professional as the target audience are professionals.'
+    prompt += f'\nMention that the links are in the first comment.'
+    prompt += f'\nFinish with a call to action asking readers to message me on LinkedIn if they are interested in discussing either the insights or how I could help them.'
+    prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3, as well as some hashtags related to the insights.'
+    prompt += f'\nYou are tasked with generating a LinkedIn post including the links to the relevant articles from these insights: {insights}, generated from these URLs: {urls}'
+    return prompt
+
+  def buildArticlesPostPrompt(self, post_prompt, article_count):
+    """
+    Build the instructions of the LinkedIn post prompt, to be followed by the articles
+    """
+    if post_prompt != '':
+      return post_prompt
+
+    prompt = f'\nContext: At ProfessionalPulse, we\'re passionate about leveraging technology to transform the operations of Business Services teams within Professional Services Firms.'
+    prompt += f'Our journey began in the dynamic realm of IT and consultancy, and was inspired by real-life challenges faced by these teams.'
+    prompt += f'Today, we use our expertise and unique approach to help these teams navigate their challenges, boost efficiency, and strike a balance between their professional and personal lives.'
+    prompt += f'Discover more about our ethos, our journey, and how we can help you.'
+    prompt += f'\nDo not use the context in the post. It\'s for your information only.'
+    prompt += f'\nYou should only talk about the insights extracted from the articles with a bias towards process automation, and the links to the articles should be neatly listed at the very end of the post, after everything else.'
+    prompt += f'\nUse numbers for each insight to point to the relevant article URL.'
+    prompt += f'\nWord the insights as if I was commeting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
+    prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and technology, and sound professional as the target audience are professionals.'
+    prompt += f'\nMention that the links are in the first comment and add the links at the bottom, listed by the number of the insight they belong to.'
+    prompt += f'\nFinish with a call to action asking readers to message me on LinkedIn if they are interested in discussing either the insights or how I could help them.'
+    prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3'
+    prompt += f'\nYou are tasked with extracting insights and generate a LinkedIn post including the links to the relevant articles from these {article_count} articles:'
+    return prompt
 
   def generateLinkedInPost(self, userId, days, insightIds, prompt_role, post_prompt, image_prompt):
     """
@@ -148,190 +615,300 @@ class Main():
       articles = None
       insights = []
       urls = []
+      titles = []
       
       if len(insightIds) > 0:
-        for id in insightIds:
-          self.mongo = MongoDB()
-          insight = self.mongo.findInsightById(id)
-          if insight is not None:
-            insights.append(insight['insights'])
-            urls.append(insight['urls'])
-
-            logging.info(f'Generating LinkedIn post from insights')
-            self.urls = insight["urls"]
-            role = prompt_role
-            if post_prompt != '':
-              prompt = f'{post_prompt} \n{insights} \n{urls}'
-            else:
-              prompt = f'\nContext: My mission is to demystify AI and make it accessible and practical for professional services firms. Through ProfessionalPulse, I aim to deliver bespoke AI data strategies that are not only technically sound but also align with the '
-              prompt += f'unique business goals and challenges of each client. We strive to turn AI from a concept into a tangible asset, driving innovation, efficiency, and competitive advantage.'
-              prompt += f'\nThe post must be written from the voice of the consultancy.'
-              prompt += f'\nDo not use the context in the post. It\'s for your information only.'
-              prompt += f'\nYou should only talk about the insights extracted from these articles with a bias towards process automation.'
-              prompt += f'\nWord the insights as if I was commenting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
-              prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and technology, and sound professional as the target audience are professionals.'
-              prompt += f'\nMention that the links are in the first comment.'
-              prompt += f'\nFinish with a call to action asking readers to message me on LinkedIn if they are interested in discussing either the insights or how I could help them.'
-              prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3, as well as some hashtags related to the insights.'
-              prompt += f'\nYou are tasked with generating a LinkedIn post including the links to the relevant articles from these insights: {insights}, generated from these URLs: {urls}'
-      else:
-        articles = self.getArticles(folder_id=self.FEEDLY_FOLDERS_LIST[0], daysdelta=days)
-        if articles:
-          logging.info(f'Generating LinkedIn post from articles in folder: {self.FEEDLY_FOLDERS_LIST[0]}')
-          urls = self.urls
-          role = prompt_role
+        for insight in self.mongo.findInsightsByIds(insightIds):
+          insights.append(insight['insights'])
+          urls.append(insight['urls'])
 
-          if post_prompt != '':
-              prompt = post_prompt
-              for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents):
-                prompt += f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n'
-          else:
-            prompt = f'\nContext: At ProfessionalPulse, we\'re passionate about leveraging technology to transform the operations of Business Services teams within Professional Services Firms.'
-            prompt += f'Our journey began in the dynamic realm of IT and consultancy, and was inspired by real-life challenges faced by these teams.'
-            prompt += f'Today, we use our expertise and unique approach to help these teams navigate their challenges, boost efficiency, and strike a balance between their professional and personal lives.'
-            prompt += f'Discover more about our ethos, our journey, and how we can help you.'
-            prompt += f'\nDo not use the context in the post. It\'s for your information only.'
-            prompt += f'\nYou should only talk about the insights extracted from the articles with a bias towards process automation, and the links to the articles should be neatly listed at the very end of the post, after everything else.'
-            prompt += f'\nUse numbers for each insight to point to the relevant article URL.'
-            prompt += f'\nWord the insights as if I was commeting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
-            prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and technology, and sound professional as the target audience are professionals.'
-            prompt += f'\nMention that the links are in the first comment and add the links at the bottom, listed by the number of the insight they belong to.'
-            prompt += f'\nFinish with a call to action asking readers to message me on LinkedIn if they are interested in discussing either the insights or how I could help them.'
-            prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3'          
-            prompt += f'\nYou are tasked with extracting insights and generate a LinkedIn post including the links to the relevant articles from these {self.article_count} articles:'
-            for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents):
-              prompt += f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n'     
+        if len(insights) > 0:
+          logging.info(f'Generating LinkedIn post from insights')
+          role = prompt_role
+          prompt = self.buildInsightsPostPrompt(post_prompt, insights, urls)
+      else:
+        role = prompt_role
+        articles = self.trackArticles(self.iterArticles(folder_id=self.FEEDLY_FOLDERS_LIST[0], daysdelta=days, query=f'{post_prompt} {self.KEYWORDS}', flow='linkedinpost'), urls, titles)
+        condensed = self.condenseArticles(self.buildArticlePrompts(articles), instructions=role + self.buildArticlesPostPrompt(post_prompt, 0))
+        if urls:
+          logging.info(f'Generating LinkedIn post from {len(urls)} articles in folder: {self.FEEDLY_FOLDERS_LIST[0]}')
+          prompt = self.buildArticlesPostPrompt(post_prompt, len(urls)) + condensed
 
       if prompt is not None:
-        post = self.callOpenAIChat(role, prompt)
-        image = self.callOpenAIImage(f'{image_prompt} {post}')
-        if self.mongo.insertPost(userId=userId, insightIds=insightIds, post=post, image=image, urls=urls):
-          return [post, urls, image]
+        if self.pipelined:
+          executor = ThreadPoolExecutor(max_workers=1)
+          imageFuture = executor.submit(bind(self.generateImage), f'{image_prompt} {self.buildImageBrief(insights or titles)}')
+          try:
+            post = self.callOpenAIChat(role, prompt)
+            result = self.saveLinkedInPost(userId=userId, insightIds=insightIds, post=post, urls=urls, image_prompt=image_prompt, imageFuture=imageFuture)
+          finally:
+            # The image is only waited for once the post is saved, so a failed post does not wait for an image it will not use
+            executor.shutdown(wait=False, cancel_futures=True)
         else:
-          return "post-failed"
+          post = self.callOpenAIChat(role, prompt)
+          result = self.saveLinkedInPost(userId=userId, insightIds=insightIds, post=post, urls=urls, image_prompt=image_prompt)
+        # Does nothing for posts written from insights, as no articles were fetched
+        if result != "post-failed":
+          self.commitWatermark(self.FEEDLY_FOLDERS_LIST[0], flow='linkedinpost')
+        return result
       else:
         return "no-articles-found"
     else: 
       return "no-config-found"
 
-  def emailLinkedInPost(self):
+  def saveLinkedInPost(self, userId, insightIds, post, urls, image_prompt, imageFuture=None):
     """
-    Generate a LinkedIn post from the articles
+    Save the post with its image. If the image is already being generated, the post is saved
+    straight away and updated with the image when it arrives.
     """
-    for folder_id in self.FEEDLY_FOLDERS_LIST:
-      articles = self.getArticles(folder_id=folder_id, daysdelta=2)
-
-      if articles:
-        logging.info(f'Generating LinkedIn post from articles in folder: {folder_id}')
-        role = 'You are a marketing manager working for a consultancy called ProfessionalPulse.'
-        prompt = f'Imagine that you are a marketing manager for a consultancy called ProfessionalPulse.'
-        prompt += f'\nContext: At ProfessionalPulse, we\'re passionate about leveraging technology to transform the operations of Business Services teams within Professional Services Firms.'
-        prompt += f'Our journey began in the dynamic realm of IT and consultancy, and was inspired by real-life challenges faced by these teams.'
-        prompt += f'Today, we use our expertise and unique approach to help these teams navigate their challenges, boost efficiency, and strike a balance between their professional and personal lives.'
-        prompt += f'Discover more about our ethos, our journey, and how we can help you.'
-        prompt += f'\nYou are tasked with extracting insights and generate a LinkedIn post including the links to the relevant articles from these {self.article_count} articles:'
-        for url, title, summary, content in zip(self.urls, self.titles, self.summaries, self.contents):
-          prompt += f'\nURL: {url}\nTitle: {title}\nSummary: {summary}\nContent: {content}\n'
-        prompt += f'\nDo not use the context in the post. It\'s for your information only.'
-        prompt += f'\nYou should only talk about the insights extracted from these articles with a bias towards process automation, and the links to the articles should be neatly listed at the very end of the post, after everything else.'
-        prompt += f'\nUse numbers for each insight to point to the relevant article URL.'
-        prompt += f'\nWord the insights as if I was commeting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
-        prompt += f'\nThe post must be written in UK English, focused on the key insights around AI and technology, and sound professional as the target audience are professionals.'
-        prompt += f'\nMention that the links are in the first comment and add the links at the bottom, listed by the number of the insight they belong to.'
-        prompt += f'\nFinish with a call to action asking readers to message me on LinkedIn if they are interested in discussing either the insights or how I could help them.'
-        prompt += f'\nAll posts must include this at the bottom: Image source: DALL-E 3'
+    if imageFuture is None:
+      image, imagePath = self.generateImage(f'{image_prompt} {post}')
+      if self.mongo.insertPost(userId=userId, insightIds=insightIds, post=post, image=image, urls=urls, imagePath=imagePath):
+        return [post, urls, image]
+      else:
+        return "post-failed"
 
+    postId = self.mongo.insertPost(userId=userId, insightIds=insightIds, post=post, image=None, urls=urls)
+    if not postId:
+      imageFuture.cancel()
+      return "post-failed"
+    try:
+      image, imagePath = imageFuture.result()
+    except Exception as e:
+      logging.error(f'Error generating the image of post {postId}: \n{e}')
+      return [post, urls, None]
+    self.mongo.updatePostImage(postId, image=image, imagePath=imagePath)
+    return [post, urls, image]
+
+  def buildImageBrief(self, subjects):
+    """
+    Describe the post from its insights or article titles, so that its image can be generated while the post is written
+    """
+    return truncateToTokens('A LinkedIn post about: ' + '; '.join(subjects), self.IMAGE_BRIEF_TOKENS)
+
+  def generateImage(self, prompt):
+    """
+    Return the URL of the generated image and the path where it is stored locally, if any
+    """
+    image = self.callOpenAIImage(prompt)
+    return image, self.storeImage(image)
+
+  def storeImage(self, url):
+    """
+    Download the image before the temporary OpenAI URL expires
+    """
+    if not self.IMAGE_STORE_DIR or not url:
+      return None
+
+    path = os.path.join(self.IMAGE_STORE_DIR, f'{hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]}.png')
+    if not os.path.exists(path):
+      os.makedirs(self.IMAGE_STORE_DIR, exist_ok=True)
+      with span('image.download') as download:
+        response = requests.get(url, timeout=60)
+        response.raise_for_status()
+        download.set(bytes=len(response.content))
+      with open(f'{path}.tmp', 'wb') as file:
+        file.write(response.content)
+      os.replace(f'{path}.tmp', path)
+      logging.info(f'Stored image in {path}')
+    return path
+
+  def emailLinkedInPost(self):
+    """
+    Generate a LinkedIn post from the articles of every folder and email it over a single SMTP connection
+    """
+    try:
+      with SMTPSender(self.EMAIL_USERNAME, self.EMAIL_PASSWORD) as self.mailer:
+        return self.processFolders(self.emailFolderLinkedInPost)
+    finally:
+      self.mailer = None
+
+  def emailFolderLinkedInPost(self, folder_id):
+    urls = []
+    role = 'You are a marketing manager working for a consultancy called ProfessionalPulse.'
+    prompt = f'Imagine that you are a marketing manager for a consultancy called ProfessionalPulse.'
+    prompt += f'\nContext: At ProfessionalPulse, we\'re passionate about leveraging technology to transform the operations of Business Services teams within Professional Services Firms.'
+    prompt += f'Our journey began in the dynamic realm of IT and consultancy, and was inspired by real-life challenges faced by these teams.'
+    prompt += f'Today, we use our expertise and unique approach to help these teams navigate their challenges, boost efficiency, and strike a balance between their professional and personal lives.'
+    prompt += f'Discover more about our ethos, our journey, and how we can help you.'
+    task = lambda article_count: f'\nYou are tasked with extracting insights and generate a LinkedIn post including the links to the relevant articles from these {article_count} articles:'
+    instructions = f'\nDo not use the context in the post. It\'s for your information only.'
+    instructions += f'\nYou should only talk about the insights extracted from these articles with a bias towards process automation, and the links to the articles should be neatly listed at the very end of the post, after everything else.'
+    instructions += f'\nUse numbers for each insight to point to the relevant article URL.'
+    instructions += f'\nWord the insights as if I was commeting on the article rather than just writing an extract. Each insight must be a short paragraph rather than a single sentence.'
+    instructions += f'\nThe post must be written in UK English, focused on the key insights around AI and technology, and sound professional as the target audience are professionals.'
+    instructions += f'\nMention that the links are in the first comment and add the links at the bottom, listed by the number of the insight they belong to.'
+    instructions += f'\nFinish with a call to action asking readers to message me on LinkedIn if they are interested in discussing either the insights or how I could help them.'
+    instructions += f'\nAll posts must include this at the bottom: Image source: DALL-E 3'
+    titles = []
+    articles = self.trackArticles(self.iterArticles(folder_id=folder_id, daysdelta=2, flow='linkedinpost'), urls, titles)
+    condensed = self.condenseArticles(self.buildArticlePrompts(articles), instructions=role + prompt + task(0) + instructions)
+
+    if urls:
+      logging.info(f'Generating LinkedIn post from {len(urls)} articles in folder: {folder_id}')
+      prompt += task(len(urls)) + condensed + instructions
+
+      if self.pipelined:
+        executor = ThreadPoolExecutor(max_workers=1)
+        imageFuture = executor.submit(bind(self.generateImage), f'Generate an image for the following LinkedIn post: \n{self.buildImageBrief(titles)}')
+        try:
+          post = self.callOpenAIChat(role, prompt)
+          image, _ = imageFuture.result()
+        finally:
+          # A failed post does not wait for an image it will not use
+          executor.shutdown(wait=False, cancel_futures=True)
+      else:
         post = self.callOpenAIChat(role, prompt)
-        image = self.callOpenAIImage(f'Generate an image based on the following LinkedIn post: \n{post}')
-        body = post + f'\n\nImage URL: {image}'
-        self.sendEmail(subject=f'LinkedIn post from {self.article_count} articles for folder {folder_id}', body=body, urls=self.urls)
+        image, _ = self.generateImage(f'Generate an image based on the following LinkedIn post: \n{post}')
+      body = post + f'\n\nImage URL: {image}'
+      if not self.sendEmail(subject=f'LinkedIn post from {len(urls)} articles for folder {folder_id}', body=body, urls=urls):
+        return {"folder": folder_id, "status": "error", "message": "Could not send the email"}
+      self.commitWatermark(folder_id, flow='linkedinpost')
+      return {"folder": folder_id, "status": "OK"}
+    else:
+      return {"folder": folder_id, "status": "no-articles-found"}
 
   def sendEmail(self, subject, body, urls):
     """
-    Set up SMTP server
+    Send an email to the comma-separated EMAIL_RECIPIENT addresses and wait for it to be delivered.
+    The connection of the current run is reused, otherwise a connection is opened for this email only.
+    Returns whether the email was sent.
     """
-    smtp_server = smtplib.SMTP('smtp.gmail.com', 587)
-    smtp_server.ehlo()
-    smtp_server.starttls()
-    smtp_server.login(self.EMAIL_USERNAME, self.EMAIL_PASSWORD) # https://support.google.com/accounts/answer/185833
-
-    # Send email 
     logging.info(f'Sending email...')
+    mailer = self.mailer or SMTPSender(self.EMAIL_USERNAME, self.EMAIL_PASSWORD)
+    content = f'{urls}\n\n{body}'
 
     try:
-      msg = f'Subject: {subject}\n\n{urls}\n\n{body}'
-      smtp_server.sendmail(self.EMAIL_USERNAME, self.EMAIL_RECIPIENT, msg.encode('utf-8'))
-      logging.info('Email sent!')
-      smtp_server.quit()
-    except Exception as e:
-      logging.error(f'Error sending email: \n{e}')
-
-  def refreshFeedlyToken(self):
-    refresh_token = os.getenv('FEEDLY_REFRESH_TOKEN')
-    client_id = 'YOUR_CLIENT_ID'
-    client_secret = 'YOUR_CLIENT_SECRET'
-
-    url = 'https://cloud.feedly.com/v3/auth/token'
-    params = {
-        'refresh_token': refresh_token,
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'refresh_token'
+      with span('smtp.send', bytes=len(subject.encode('utf-8')) + len(content.encode('utf-8'))):
+        mailer.send(self.EMAIL_RECIPIENT, subject, content).result()
+      return True
+    except Exception:
+      # The sender has already logged the error
+      return False
+    finally:
+      if mailer is not self.mailer:
+        mailer.close()
+
+  def normaliseEntry(self, entry):
+    return {
+      'id': entry['id'],
+      'timestamp': entry.get('crawled', entry.get('published', 0)),
+      'url': entry['alternate'][0]['href'],
+      'title': entry['title'],
+      'summary': entry['summary']['content'] if 'summary' in entry else '',
+      'content': entry['fullContent'] if 'fullContent' in entry else ''
     }
 
-    response = requests.post(url, data=params)
-    access_token = response.json()['access_token']
+  def watermarkKey(self, folder_id, flow):
+    """
+    Insights and LinkedIn posts keep their own high-water mark, so that one does not skip the articles the other has not used yet
+    """
+    return folder_id if flow == 'insights' else f'{folder_id}:{flow}'
 
-  def getArticles(self, folder_id, daysdelta):
-    # Get articles from last 24 hours
+  def getSince(self, folder_id, daysdelta, flow='insights'):
+    """
+    Return the timestamp in ms after which articles are fetched: the start of the window,
+    or the high-water mark of the folder for incremental runs of the flow if it is more recent
+    """
     timeframe = datetime.now() - timedelta(days=daysdelta)
-    timestamp_ms = int(timeframe.timestamp() * 1000)
+    since = int(timeframe.timestamp() * 1000)
+
+    if self.incremental and self.store is not None and not self.fromStore:
+      watermark = self.store.getWatermark(self.userId, self.watermarkKey(folder_id, flow))
+      if watermark is not None and watermark > since:
+        logging.info(f'Only getting articles newer than the last run for folder {folder_id}')
+        since = watermark
+
+    return since
+
+  def iterArticles(self, folder_id, daysdelta, query=None, flow='insights'):
+    """
+    Yield the normalised articles of a folder without duplicates, most relevant to the query first
+    """
+    # Get articles from the last daysdelta days
+    since = self.getSince(folder_id, daysdelta, flow)
+    self.windows[folder_id] = (since, int(datetime.now().timestamp() * 1000))
+    articles = traceIter('articles', self.fetchArticles(folder_id, since), measure=self.measureArticle, folder=folder_id)
+    yield from self.rankArticles(self.removeDuplicates(articles, since, folder_id), query)
+
+  def measureArticle(self, article):
+    return sum(len(article[field].encode('utf-8')) for field in ['title', 'summary', 'content'])
+
+  def fetchArticles(self, folder_id, since):
+    """
+    Yield the normalised articles of a folder one at a time, as the pages of entries arrive
+    """
+    if self.fromStore and self.store is not None:
+      logging.info(f'Getting articles for folder {folder_id} from the local store')
+      yield from self.store.iterArticles(folder_id, since)
+      return
 
     logging.info(f'Getting articles for folder: {folder_id}')
-    # Get articles ids for this folder
-    feedly_url = f'{self.FEEDLY_API_URL}/v3/streams/ids?streamId={folder_id}&newerThan={timestamp_ms}&count=20'
-    logging.info(f'Getting articles with Feedly URL: {feedly_url}')
-    response = self.feedly.get(feedly_url)
-    
-    if(response.status_code == 200):
-      # logging.info(f'Feedly response: {json.dumps(json.loads(response.text), indent=4)}')
-      ids = json.loads(response.text)['ids']
-      # logging.info(f'IDs: {ids}')
-      logging.info(f'Retrieved {len(ids)} articles.')
-
-      # Get articles from the ids
-      feedly_entries_url = f'{self.FEEDLY_API_URL}/v3/entries/.mget'
-      entries_response = self.feedly.post(feedly_entries_url, None, ids)
-      # logging.info(f'Entries response: {json.dumps(json.loads(entries_response.text), indent=4)}')
-      articles = json.loads(entries_response.text)
-      self.article_count = len(articles)
-
-      if(self.article_count > 0):
-        # Concatenate articles this folder
-        self.urls = [a['alternate'][0]['href'] for a in articles]
-        self.titles = [a['title'] for a in articles]
-        self.summaries = [a['summary']['content'] if 'summary' in a else '' for a in articles]
-        self.contents = [a['fullContent'] if 'fullContent' in a else '' for a in articles]
-
-        return True
-      else: 
-        logging.info('========================================================================================')
-        logging.info(f'There are no articles to analyse for folder {folder_id}.')
-        logging.info('========================================================================================') 
-    else:
-      logging.warning(f'Could not get articles with status code: {response.status_code}. Details: \n{response.content}') 
+    articles = cleanArticles(self.normaliseEntry(entry) for entry in self.feedly.iterEntries(folder_id, newerThan=since))
+    for article in self.storeArticles(folder_id, articles):
+      if article['timestamp'] > since:
+        yield article
+
+  def removeDuplicates(self, articles, since, folder_id):
+    """
+    Collapse the copies of the same story published in several feeds or folders. Stories already seen by the user
+    in this folder before the window are dropped.
+    """
+    if os.getenv('DEDUP_ENABLED', 'true').lower() != 'true':
+      return articles
+    return dedupeArticles(articles, since=since, index=FingerprintIndex.getInstance(), scope=f'{self.userId}:{folder_id}')
+
+  def rankArticles(self, articles, query=None):
+    """
+    Keep the articles most relevant to the query, or to the keywords of the user, that fit the token budget.
+    Without keywords or a query the articles stream through unranked.
+    """
+    query = self.KEYWORDS if query is None else query
+    if not query.strip():
+      return articles
+    measure = lambda article: self.count_tokens(next(self.buildArticlePrompts([article])))
+    return rankArticles(articles, query, top_k=self.RANK_TOP_K, budget=self.RANK_TOKEN_BUDGET, measure=measure)
+
+  def storeArticles(self, folder_id, articles, batch_size=50):
+    """
+    Save the articles to the local store in batches as they stream past, and track the most recent one
+    """
+    batch = []
+    for article in articles:
+      self.watermarks[folder_id] = max(self.watermarks.get(folder_id, 0), article['timestamp'])
+      if self.store is not None:
+        batch.append(article)
+        if len(batch) >= batch_size:
+          self.store.saveArticles(folder_id, batch)
+          batch = []
+      yield article
+
+    if self.store is not None and batch:
+      self.store.saveArticles(folder_id, batch)
+
+  def commitWatermark(self, folder_id, flow='insights'):
+    """
+    Record that the articles fetched for the folder have been processed by the flow
+    """
+    if self.store is not None and not self.fromStore and self.userId is not None and folder_id in self.watermarks:
+      self.store.setWatermark(self.userId, self.watermarkKey(folder_id, flow), self.watermarks[folder_id])
 
-    return False
+  def getArticles(self, folder_id, daysdelta, query=None, flow='insights'):
+    articles = list(self.iterArticles(folder_id=folder_id, daysdelta=daysdelta, query=query, flow=flow))
+    if len(articles) == 0:
+      logging.info(f'There are no articles to analyse for folder {folder_id}.')
+    return articles
 
   def main(self, arg):
     self.args = arg
-    logging.info(f'Starting process for option: {self.args}')
-    self.getLocalConfig()
-
-    if self.args == 'Generate Insights':
-      self.emailInsights()
-    if self.args == 'Create LinkedIn post':
-      self.emailLinkedInPost()
+    with requestContext():
+      logging.info(f'Starting process for option: {self.args}')
+      self.getLocalConfig()
+
+      if self.args == 'Generate Insights':
+        self.emailInsights()
+      if self.args == 'Create LinkedIn post':
+        self.emailLinkedInPost()
     
 if __name__ == "__main__":
   main = Main()
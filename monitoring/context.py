@@ -0,0 +1,27 @@
+import uuid
+import contextvars
+from contextlib import contextmanager
+
+# Id of the API request, job or batch task being processed, used to correlate its spans and log lines
+requestId = contextvars.ContextVar('requestId', default=None)
+
+def getRequestId():
+    return requestId.get()
+
+@contextmanager
+def requestContext(id=None):
+    """
+    Process the enclosed code as part of a request, with the given id or a new one
+    """
+    token = requestId.set(id or uuid.uuid4().hex[:16])
+    try:
+        yield requestId.get()
+    finally:
+        requestId.reset(token)
+
+def bind(func):
+    """
+    Return func running in a copy of the current context, so that work submitted to a thread pool keeps the request id
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
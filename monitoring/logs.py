@@ -0,0 +1,22 @@
+import os
+import logging
+from monitoring.context import getRequestId
+
+class RequestIdFilter(logging.Filter):
+    """
+    Add the id of the current request to every log record
+    """
+    def filter(self, record):
+        record.requestId = getRequestId() or '-'
+        return True
+
+def configureLogging():
+    """
+    Configure the root logger at the LOG_LEVEL level. DEBUG logs every HTTP request made by the clients,
+    which is costly in production, so the default is INFO. Calling it again has no effect.
+    """
+    level = os.getenv('LOG_LEVEL', 'info').upper()
+    logging.basicConfig(level=level, format='%(asctime)s %(levelname)s [%(requestId)s] %(name)s: %(message)s')
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(existing, RequestIdFilter) for existing in handler.filters):
+            handler.addFilter(RequestIdFilter())
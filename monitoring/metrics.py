@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import asyncio
+import inspect
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from monitoring.context import getRequestId
+
+# USD per 1000 prompt and completion tokens. Prices can be overridden with OPENAI_PRICES, e.g. {"gpt-4": [0.03, 0.06]}
+CHAT_PRICES = {
+    'gpt-4-1106-preview': (0.01, 0.03),
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+    'gpt-3.5-turbo-1106': (0.001, 0.002)
+}
+CHAT_PRICES.update({model: tuple(prices) for model, prices in json.loads(os.getenv('OPENAI_PRICES', '{}')).items()})
+
+# USD per image by model, quality and size
+IMAGE_PRICES = {
+    ('dall-e-3', 'standard', '1024x1024'): 0.04,
+    ('dall-e-3', 'standard', '1024x1792'): 0.08,
+    ('dall-e-3', 'standard', '1792x1024'): 0.08,
+    ('dall-e-3', 'hd', '1024x1024'): 0.08,
+    ('dall-e-3', 'hd', '1024x1792'): 0.12,
+    ('dall-e-3', 'hd', '1792x1024'): 0.12
+}
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRICS = {
+    'marketing_stage_duration_seconds': ('histogram', 'Duration of the stages of the pipeline'),
+    'marketing_stage_bytes_total': ('counter', 'Bytes processed by the stages of the pipeline'),
+    'marketing_stage_items_total': ('counter', 'Items, such as articles, produced by the stages of the pipeline'),
+    'marketing_openai_tokens_total': ('counter', 'OpenAI tokens used, by model and kind'),
+    'marketing_openai_cost_usd_total': ('counter', 'Estimated cost of the OpenAI calls in USD'),
+    'marketing_openai_cache_hits_total': ('counter', 'OpenAI calls answered from the response cache'),
+    'marketing_request_duration_seconds': ('histogram', 'Time until the API sends the response headers')
+}
+
+spanLogger = logging.getLogger('spans')
+currentStage = contextvars.ContextVar('currentStage', default=None)
+
+def chatCost(model, promptTokens, completionTokens):
+    prompt, completion = CHAT_PRICES.get(model, (0, 0))
+    return (promptTokens * prompt + completionTokens * completion) / 1000
+
+def imageCost(model, quality, size, n=1):
+    return IMAGE_PRICES.get((model, quality, size), 0) * n
+
+class Histogram():
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+
+class Metrics():
+    """
+    Process-wide counters and histograms, rendered in the Prometheus text format
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def getInstance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = Metrics()
+        return cls._instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def increment(self, name, amount=1, **labels):
+        key = Metrics.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = Metrics.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(histogram.buckets), histogram.count, histogram.sum) for key, histogram in self.histograms.items()}
+
+        formatLabels = lambda labels: '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}' if labels else ''
+        formatValue = lambda value: str(int(value)) if float(value).is_integer() else repr(float(value))
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{formatLabels(labels)} {formatValue(value)}')
+            for (metric, labels), (buckets, count, total) in sorted(histograms.items()):
+                if metric == name:
+                    for bound, bucketCount in zip(BUCKETS, buckets):
+                        lines.append(f'{name}_bucket{formatLabels(labels + (("le", f"{bound:g}"),))} {bucketCount}')
+                    lines.append(f'{name}_bucket{formatLabels(labels + (("le", "+Inf"),))} {count}')
+                    lines.append(f'{name}_sum{formatLabels(labels)} {formatValue(total)}')
+                    lines.append(f'{name}_count{formatLabels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+class Span():
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.parent = currentStage.get()
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+def record(span, seconds, status):
+    """
+    Add a finished span to the metrics and log it as a JSON line
+    """
+    metrics = Metrics.getInstance()
+    attributes = span.attributes
+    metrics.observe('marketing_stage_duration_seconds', seconds, stage=span.stage, status=status)
+    if attributes.get('bytes'):
+        metrics.increment('marketing_stage_bytes_total', attributes['bytes'], stage=span.stage)
+    if attributes.get('items'):
+        metrics.increment('marketing_stage_items_total', attributes['items'], stage=span.stage)
+    if attributes.get('cached'):
+        metrics.increment('marketing_openai_cache_hits_total', stage=span.stage)
+    for kind in ['prompt', 'completion']:
+        if attributes.get(f'{kind}Tokens'):
+            metrics.increment('marketing_openai_tokens_total', attributes[f'{kind}Tokens'], model=attributes.get('model'), kind=kind)
+    if attributes.get('cost'):
+        metrics.increment('marketing_openai_cost_usd_total', attributes['cost'], model=attributes.get('model'))
+
+    if spanLogger.isEnabledFor(logging.INFO):
+        spanLogger.info(json.dumps({"span": span.stage, "requestId": getRequestId(), "parent": span.parent, "durationMs": round(seconds * 1000, 1), "status": status, **attributes}, default=str))
+
+@contextmanager
+def span(stage, **attributes):
+    """
+    Time the enclosed code as a stage of the current request. Attributes such as bytes, items, model,
+    promptTokens, completionTokens and cost can be added with set() on the yielded span.
+    """
+    current = Span(stage, attributes)
+    token = currentStage.set(stage)
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield current
+    except (GeneratorExit, asyncio.CancelledError):
+        status = 'cancelled'
+        raise
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        try:
+            currentStage.reset(token)
+        except ValueError:
+            # An async generator can be resumed in another context than the one it started in
+            pass
+        record(current, time.perf_counter() - started, status)
+
+def traceIter(stage, iterable, measure=None, **attributes):
+    """
+    Yield the items of an iterable, timing only the time spent producing them, not the time the consumer
+    spends on each item. measure(item) returns the number of bytes of an item.
+    """
+    current = Span(stage, attributes)
+    iterator = iter(iterable)
+    seconds = 0.0
+    items = 0
+    size = 0
+    status = 'ok'
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                seconds += time.perf_counter() - started
+            items += 1
+            size += measure(item) if measure is not None else 0
+            yield item
+    finally:
+        current.set(items=items, bytes=size)
+        record(current, seconds, status)
+
+async def atraceIter(stage, iterable, measure=None, **attributes):
+    """
+    Asynchronous variant of traceIter
+    """
+    current = Span(stage, attributes)
+    iterator = iterable.__aiter__()
+    seconds = 0.0
+    items = 0
+    size = 0
+    status = 'ok'
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                status = 'error'
+                raise
+            finally:
+                seconds += time.perf_counter() - started
+            items += 1
+            size += measure(item) if measure is not None else 0
+            yield item
+    finally:
+        current.set(items=items, bytes=size)
+        record(current, seconds, status)
+
+def traced(prefix):
+    """
+    Decorator recording each call of a function, coroutine or generator as the span {prefix}.{function name}
+    """
+    def decorate(func):
+        stage = f'{prefix}.{func.__name__}'
+        if inspect.isasyncgenfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return atraceIter(stage, func(*args, **kwargs))
+        elif inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return traceIter(stage, func(*args, **kwargs))
+        elif inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with span(stage):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,84 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from fastapi.concurrency import run_in_threadpool
+
+class Readiness():
+    """
+    Process-wide results of the warm-up checks run at start-up. The process is ready once every check
+    has finished, successfully or not, or the warm-up has timed out.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def getInstance(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = Readiness()
+        return cls._instance
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.checks = {}
+
+    def record(self, name, ok, seconds, error=None):
+        result = {"ok": ok, "durationMs": round(seconds * 1000, 1)}
+        if error is not None:
+            result["error"] = error
+        with self.lock:
+            self.checks[name] = result
+
+    def markReady(self):
+        with self.lock:
+            if self.finished is None:
+                self.finished = time.perf_counter()
+
+    def isReady(self):
+        return self.finished is not None
+
+    def status(self):
+        with self.lock:
+            checks = {name: dict(result) for name, result in self.checks.items()}
+            finished = self.finished
+        return {
+            "ready": finished is not None,
+            "warmUpMs": round(((finished or time.perf_counter()) - self.started) * 1000, 1),
+            "checks": checks
+        }
+
+async def runCheck(readiness, name, check):
+    """
+    Run a warm-up check, a coroutine function or a blocking function run in the thread pool, and record its result
+    """
+    started = time.perf_counter()
+    try:
+        if asyncio.iscoroutinefunction(check):
+            await check()
+        else:
+            await run_in_threadpool(check)
+        readiness.record(name, True, time.perf_counter() - started)
+    except Exception as e:
+        logging.warning(f'Warm-up check {name} failed: {e}')
+        readiness.record(name, False, time.perf_counter() - started, str(e))
+
+async def warmUp(checks):
+    """
+    Run the warm-up checks, a dictionary of names and functions, concurrently. Checks still running
+    after WARMUP_TIMEOUT seconds are recorded as timed out so that the process does not stay unready.
+    """
+    readiness = Readiness.getInstance()
+    timeout = float(os.getenv('WARMUP_TIMEOUT', 30))
+    tasks = {name: asyncio.create_task(runCheck(readiness, name, check)) for name, check in checks.items()}
+    _, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+    for name, task in tasks.items():
+        if task in pending:
+            task.cancel()
+            readiness.record(name, False, timeout, 'timed out')
+    readiness.markReady()
+    logging.info(f'Warm-up finished: {readiness.status()}')
@@ -0,0 +1,242 @@
+import os
+import re
+import logging
+import threading
+import multiprocessing
+from html import unescape
+from html.parser import HTMLParser
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from concurrent.futures import ProcessPoolExecutor
+from processing.packing import countTokens
+
+# Elements whose content is never part of the article text
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'iframe', 'svg', 'form', 'button', 'nav', 'footer', 'aside', 'figure', 'select', 'template'}
+# Elements that start a new line in the extracted text
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'tr', 'table', 'section', 'article', 'header', 'hr'}
+VOID_TAGS = {'br', 'hr', 'img', 'input', 'meta', 'link', 'source', 'wbr', 'area', 'base', 'col', 'embed', 'param', 'track'}
+# Class or id tokens of the share widgets, newsletter sign-ups, related links and other boilerplate blocks.
+# Whole tokens only, so that classes such as entry-content share-enabled or has-comments are kept.
+BOILERPLATE_ATTRIBUTES = re.compile(
+    r'(share|shares|sharing|share-buttons|sharedaddy|social|social-share|social-links|related|related-posts|related-articles'
+    r'|newsletter|subscribe|signup|sign-up|advert|advertisement|ad|ads|promo|sponsored|comments|comment-respond|footer'
+    r'|cookie-notice|cookie-banner|sidebar|author-bio|byline|tags|post-tags|breadcrumb|breadcrumbs|popup|modal)',
+    re.IGNORECASE
+)
+# Short lines added by feeds and blogs after the article, matched whole so that sentences starting with the same words are kept
+BOILERPLATE_LINES = re.compile(
+    r'^(the post .* appeared first on .*|this article was originally published on .*'
+    r'|(read more|continue reading|click here|share this( article| post)?|subscribe( now| here)?|sign up( now| here)?|follow us|related( posts| articles)?|advertisement)[\s:.!»›→…-]*)$',
+    re.IGNORECASE
+)
+TRACKING_PARAMETERS = re.compile(r'^(utm_.*|fbclid|gclid|mc_cid|mc_eid|ref|ref_src|cmpid|_hsenc|_hsmi|mkt_tok|igshid)$', re.IGNORECASE)
+# Anchored to label boundaries, so that hosts such as road.cc or racetrack.com are kept
+TRACKING_HOSTS = re.compile(r'(^|\.)(pixel|track|tracking|click|links|email|ad)\.|(^|\.)(feedproxy\.google\.com|feeds\.feedburner\.com|doubleclick\.net|list-manage\.com)$', re.IGNORECASE)
+# Below this share of the tag-stripped text, cleaning is assumed to have removed the article itself
+MIN_KEPT_RATIO = 0.2
+
+def cleanUrl(url):
+    """
+    Remove the tracking parameters and the fragment of a URL. Returns None for tracking links.
+    """
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return None
+    if parts.scheme not in ['http', 'https'] or TRACKING_HOSTS.search(parts.hostname or ''):
+        return None
+
+    query = urlencode([(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not TRACKING_PARAMETERS.match(key)])
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+
+def isBoilerplate(attributes):
+    tokens = f'{attributes.get("class") or ""} {attributes.get("id") or ""}'.split()
+    return any(BOILERPLATE_ATTRIBUTES.fullmatch(token) for token in tokens)
+
+class TextExtractor(HTMLParser):
+    """
+    Extracts the readable text of an HTML fragment, skipping boilerplate elements
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.stack = []
+        self.skipping = 0
+        self.link = None
+        self.linkStart = 0
+        self.started = False
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if tag in VOID_TAGS:
+            if tag in BLOCK_TAGS and not self.skipping:
+                self.parts.append('\n')
+            return
+
+        # The outermost container is the article itself, whatever its classes
+        skip = tag in SKIPPED_TAGS or (self.started and isBoilerplate(attributes))
+        self.started = True
+        self.stack.append((tag, skip))
+        if skip:
+            self.skipping += 1
+        if self.skipping:
+            return
+
+        if tag in BLOCK_TAGS:
+            self.parts.append('\n')
+        if tag == 'a':
+            self.link = cleanUrl(attributes.get('href') or '')
+            self.linkStart = len(self.parts)
+
+    def handle_endtag(self, tag):
+        # Pop up to the matching tag, which tolerates unclosed elements
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return
+        while self.stack:
+            open_tag, skip = self.stack.pop()
+            if skip:
+                self.skipping -= 1
+            if open_tag == tag:
+                break
+
+        if self.skipping:
+            return
+        if tag == 'a' and self.link is not None:
+            text = ''.join(self.parts[self.linkStart:]).strip()
+            if text and text != self.link:
+                self.parts.append(f' ({self.link})')
+            self.link = None
+        if tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+    def text(self):
+        return ''.join(self.parts)
+
+def stripTags(html):
+    """
+    Return the text of an HTML fragment without its tags, scripts and styles, and without removing any boilerplate
+    """
+    html = re.sub(r'<(script|style)\b[^>]*>.*?</\1\s*>', ' ', html, flags=re.IGNORECASE | re.DOTALL)
+    html = re.sub(r'<(br|/p|/div|/li|/h[1-6])\b[^>]*>', '\n', html, flags=re.IGNORECASE)
+    return unescape(re.sub(r'<[^>]+>', ' ', html))
+
+def joinLines(text, boilerplate=True):
+    lines = []
+    seen = set()
+    for line in text.split('\n'):
+        line = re.sub(r'\s+', ' ', line).strip()
+        # Drop empty lines, feed boilerplate and lines repeated within the article such as footers
+        if not line or (boilerplate and BOILERPLATE_LINES.match(line)) or line.lower() in seen:
+            continue
+        seen.add(line.lower())
+        lines.append(line)
+    return '\n'.join(lines)
+
+def htmlToText(html):
+    """
+    Return the readable text of an HTML fragment. If cleaning removes all or most of the text,
+    the tag-stripped text is returned instead so that the article is never lost.
+    """
+    if not html:
+        return ''
+    if '<' not in html:
+        return joinLines(unescape(html))
+
+    extractor = TextExtractor()
+    try:
+        extractor.feed(html)
+        extractor.close()
+        text = joinLines(extractor.text())
+    except Exception:
+        text = ''
+
+    stripped = joinLines(stripTags(html), boilerplate=False)
+    if len(text) < MIN_KEPT_RATIO * len(stripped):
+        logging.debug(f'Cleaning kept {len(text)} of {len(stripped)} characters, falling back to the tag-stripped text')
+        return stripped
+    return text
+
+def normalise(text):
+    return re.sub(r'[^a-z0-9]+', ' ', text.lower()).strip()
+
+def isDuplicate(summary, content):
+    """
+    A summary duplicates the content if it is empty, contained in the content or a truncated copy of it
+    """
+    summary = normalise(summary)
+    content = normalise(content)
+    if not summary or not content:
+        return False
+    prefix = summary[:200].rstrip('. ')
+    return summary in content or content.startswith(prefix)
+
+def cleanArticle(article):
+    """
+    Return a copy of the article with plain text summary and content, and the number of tokens saved
+    """
+    summary = htmlToText(article.get('summary', ''))
+    content = htmlToText(article.get('content', ''))
+    if isDuplicate(summary, content):
+        summary = ''
+
+    cleaned = dict(article)
+    cleaned['summary'] = summary
+    cleaned['content'] = content
+    cleaned['tokensSaved'] = countTokens(article.get('summary', '') + article.get('content', '')) - countTokens(summary + content)
+    return cleaned
+
+_executor = None
+_executorLock = threading.Lock()
+
+def getExecutor():
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            # Spawn rather than fork, as the application runs many threads
+            _executor = ProcessPoolExecutor(max_workers=int(os.getenv('CLEANING_WORKERS', os.cpu_count() or 1)), mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+def shutdownExecutor():
+    global _executor
+    with _executorLock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def cleanBatch(batch):
+    if len(batch) >= int(os.getenv('CLEANING_PROCESS_THRESHOLD', 16)) and int(os.getenv('CLEANING_WORKERS', os.cpu_count() or 1)) > 1:
+        return list(getExecutor().map(cleanArticle, batch, chunksize=4))
+    return [cleanArticle(article) for article in batch]
+
+def cleanArticles(articles, batch_size=None):
+    """
+    Clean the articles in batches as they stream past. Large batches are cleaned in a process pool.
+    """
+    batch_size = int(batch_size if batch_size is not None else os.getenv('CLEANING_BATCH_SIZE', 32))
+    batch = []
+    saved = 0
+    count = 0
+
+    def flush(batch):
+        nonlocal saved, count
+        cleaned = cleanBatch(batch)
+        for article in cleaned:
+            logging.debug(f'Saved {article["tokensSaved"]} tokens by cleaning {article["url"]}')
+            saved += article['tokensSaved']
+            count += 1
+        return cleaned
+
+    for article in articles:
+        batch.append(article)
+        if len(batch) >= batch_size:
+            yield from flush(batch)
+            batch = []
+
+    if batch:
+        yield from flush(batch)
+
+    if count > 0:
+        logging.info(f'Saved {saved} tokens by cleaning {count} articles ({saved // count} per article)')
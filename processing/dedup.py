@@ -0,0 +1,166 @@
+import os
+import re
+import hashlib
+import logging
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from processing.cleaning import cleanUrl
+from database.fingerprints import bands
+from clients.lazy import lazyImport
+
+np = lazyImport('numpy')
+
+WORD = re.compile(r'\w+')
+# Number of index entries written at a time
+INDEX_BATCH = 100
+
+def canonicalUrl(url):
+    """
+    Return the URL without tracking parameters, fragment, www prefix or trailing slash, or None for tracking links
+    """
+    url = cleanUrl(url or '')
+    if url is None:
+        return None
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit(('https', host, parts.path.rstrip('/') or '/', query, ''))
+
+def shingles(text, size=3):
+    words = WORD.findall(text.lower())
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def simhash(text, min_shingles=5):
+    """
+    Return the 64-bit SimHash of the word shingles of a text, or None if the text is too short to fingerprint
+    """
+    features = shingles(text)
+    if len(features) < min_shingles:
+        return None
+
+    digests = b''.join(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest() for feature in features)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    # Each bit of the fingerprint is set if it is set in the majority of the shingle hashes
+    majority = bits.sum(axis=0, dtype=np.int64) * 2 > len(features)
+    return int.from_bytes(np.packbits(majority, bitorder='little').tobytes(), 'little')
+
+class BatchIndex():
+    """
+    In-memory fingerprint index of the articles of a single run
+    """
+    def __init__(self):
+        self.canonicals = {}
+        self.bands = {}
+
+    def add(self, canonical, fingerprint, match):
+        if canonical is not None:
+            self.canonicals.setdefault(canonical, match)
+        if fingerprint is not None:
+            for band, value in enumerate(bands(fingerprint)):
+                self.bands.setdefault((band, value), []).append((fingerprint, match))
+
+    def findMatch(self, canonical, fingerprint, distance):
+        if canonical in self.canonicals:
+            return self.canonicals[canonical]
+        if fingerprint is None:
+            return None
+
+        best = None
+        for band, value in enumerate(bands(fingerprint)):
+            for candidate, match in self.bands.get((band, value), []):
+                bits = (candidate ^ fingerprint).bit_count()
+                if bits <= distance and (best is None or bits < best[0]):
+                    best = (bits, match)
+        return best[1] if best is not None else None
+
+def dedupeArticles(articles, since=0, index=None, distance=None, lookahead=None, scope=None):
+    """
+    Yield the articles without the copies of the same story, matched by canonical URL or by a SimHash of the title
+    and text within a small Hamming distance. The first copy is kept and records the URLs of the others in absorbedUrls.
+
+    Each article is checked against the fingerprints seen so far, so the articles are deduplicated as they stream
+    past. A kept article is held back until DEDUP_LOOKAHEAD more articles have been checked, as the copies of a story
+    are published at about the same time, so that it carries the URLs of its copies. Copies arriving later are still
+    removed, only their URL is not recorded.
+
+    With a persistent index, copies are matched across runs and users. An article seen again under the same
+    id keeps its cluster. A copy of a story already seen in the same scope, a user and folder, before since is
+    dropped as it is not new to them. Stories seen by other users are only used to merge copies.
+    """
+    distance = int(distance if distance is not None else os.getenv('DEDUP_DISTANCE', 3))
+    lookahead = int(lookahead if lookahead is not None else os.getenv('DEDUP_LOOKAHEAD', 32))
+    ids = set()
+    batch = BatchIndex()
+    # Clusters kept so far, with the article while it is held back
+    kept = {}
+    pending = deque()
+    entries = []
+    sightings = []
+    count = 0
+    absorbed = 0
+    dropped = 0
+
+    try:
+        for article in articles:
+            count += 1
+            ids.add(article['id'])
+            canonical = canonicalUrl(article['url'])
+            fingerprint = simhash(f'{article["title"]}\n{article["content"] or article["summary"]}')
+
+            match = index.findById(article['id']) if index is not None else None
+            if match is None:
+                match = batch.findMatch(canonical, fingerprint, distance)
+                if match is None and index is not None:
+                    match = index.findMatch(canonical, fingerprint, distance)
+                if match is None:
+                    match = (article['id'], article['timestamp'])
+                entries.append((article['id'], *match, canonical, fingerprint, article['timestamp']))
+            batch.add(canonical, fingerprint, match)
+
+            cluster, _ = match
+            seen = index.firstSeen(scope, cluster) if index is not None and scope is not None else None
+            if scope is not None:
+                sightings.append((cluster, article['timestamp']))
+            if cluster in kept:
+                copy = kept[cluster]
+                if copy is not None and article['url'] != copy['url'] and article['url'] not in copy['absorbedUrls']:
+                    copy['absorbedUrls'].append(article['url'])
+                absorbed += 1
+            elif seen is not None and seen <= since and cluster not in ids:
+                logging.debug(f'Dropping {article["url"]} as a copy of a story first seen before the window')
+                dropped += 1
+            else:
+                kept[cluster] = dict(article, absorbedUrls=[])
+                pending.append(cluster)
+
+            if index is not None and len(entries) + len(sightings) >= INDEX_BATCH:
+                flush(index, scope, entries, sightings)
+                entries = []
+                sightings = []
+            while len(pending) > lookahead:
+                yield release(kept, pending.popleft())
+
+        while pending:
+            yield release(kept, pending.popleft())
+    finally:
+        # Also reached when the caller stops early, so that the articles checked so far are indexed
+        if index is not None:
+            flush(index, scope, entries, sightings)
+        if absorbed or dropped:
+            logging.info(f'Removed {absorbed + dropped} duplicate articles out of {count} ({absorbed} copies absorbed, {dropped} seen before)')
+
+def flush(index, scope, entries, sightings):
+    if entries:
+        index.addArticles(entries)
+    if sightings:
+        index.addSightings(scope, sightings)
+
+def release(kept, cluster):
+    """
+    Return the article held back for a cluster, keeping only the cluster so that later copies are still removed
+    """
+    article = kept[cluster]
+    kept[cluster] = None
+    return article
@@ -0,0 +1,97 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+DAY_MS = 24 * 60 * 60 * 1000
+# Stored insights covering a longer window than this are not daily insights and are not reused
+MAX_SOURCE_MS = 36 * 60 * 60 * 1000
+
+def dayStart(day):
+    """
+    Return the start of a day in ms. Digests use UTC calendar days.
+    """
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+def dayOf(timestamp):
+    return datetime.fromtimestamp(timestamp / 1000, timezone.utc).date()
+
+def completeDays(days, today=None):
+    """
+    Return the `days` complete days before today, oldest first
+    """
+    today = today or datetime.now(timezone.utc).date()
+    return [today - timedelta(days=offset) for offset in range(days, 0, -1)]
+
+def monthEnd(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+def segmentDays(days, periods=('month', 'week')):
+    """
+    Split consecutive days into the complete calendar months and ISO weeks they hold, and the days left over.
+    Returns (period, first, last) tuples, oldest first.
+    """
+    segments = []
+    index = 0
+    while index < len(days):
+        day = days[index]
+        if 'month' in periods and day.day == 1 and monthEnd(day) <= days[-1]:
+            period, last = 'month', monthEnd(day)
+        elif 'week' in periods and day.weekday() == 0 and day + timedelta(days=6) <= days[-1]:
+            period, last = 'week', day + timedelta(days=6)
+        else:
+            period, last = 'day', day
+        segments.append((period, day, last))
+        index += (last - day).days + 1
+    return segments
+
+def childSegments(period, first, last):
+    """
+    Return the segments a roll-up is combined from: the weeks and days of a month, or the days of a week
+    """
+    days = [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+    return segmentDays(days, periods=('week',) if period == 'month' else ())
+
+def segmentLabel(period, first, last):
+    if period == 'month':
+        return first.strftime('%B %Y')
+    if period == 'week':
+        return f'the week of {first.isoformat()}'
+    if first == last:
+        return first.isoformat()
+    return f'{first.isoformat()} to {last.isoformat()}'
+
+def coverDay(insights, day, minCoverage=None):
+    """
+    Return the stored insights covering a day, oldest first, or None if they cover too little of it. Every insight
+    whose window overlaps the day counts for the overlap, so a daily run at any time of day covers the day together
+    with the run of the following day. Overlapping insights, such as a folder generated twice, are skipped in favour
+    of the newest.
+    """
+    minCoverage = float(minCoverage if minCoverage is not None else os.getenv('DIGEST_MIN_COVERAGE', 0.75))
+    start = dayStart(day)
+    candidates = [
+        insight for insight in insights
+        if insight.get('since') is not None and insight.get('until') is not None
+        and insight['until'] - insight['since'] <= MAX_SOURCE_MS
+        and insight['since'] < start + DAY_MS and start < insight['until']
+    ]
+
+    chosen = []
+    for insight in sorted(candidates, key=lambda insight: insight.get('timestamp', 0), reverse=True):
+        if not any(insight['since'] < other['until'] and other['since'] < insight['until'] for other in chosen):
+            chosen.append(insight)
+
+    covered = sum(max(0, min(insight['until'], start + DAY_MS) - max(insight['since'], start)) for insight in chosen)
+    if not chosen or covered < minCoverage * DAY_MS:
+        return None
+    return sorted(chosen, key=lambda insight: insight['since'])
+
+def splitByDay(articles, days):
+    """
+    Group the articles published on the given days by day, dropping the others
+    """
+    groups = {day: [] for day in days}
+    for article in articles:
+        day = dayOf(article['timestamp'])
+        if day in groups:
+            groups[day].append(article)
+    return groups
@@ -0,0 +1,113 @@
+import os
+import time
+import logging
+import threading
+
+ENCODING_NAME = 'cl100k_base'
+_encodings = {}
+# Time after which an encoder that could not be loaded is tried again
+_encodingRetries = {}
+_encodingLock = threading.Lock()
+
+def getEncoding(name=ENCODING_NAME):
+    """
+    Return the tiktoken encoder, loaded once per process. Loading the BPE ranks is far more expensive than encoding.
+    Returns None while the encoder cannot be loaded, and tries again every TIKTOKEN_RETRY_SECONDS.
+    """
+    # Every token count goes through here, so the lock is only taken until the encoder is loaded
+    if name in _encodings:
+        return _encodings[name]
+    if time.monotonic() < _encodingRetries.get(name, 0):
+        return None
+    # Folders are processed concurrently, so make sure only one thread loads the encoder
+    with _encodingLock:
+        if name in _encodings:
+            return _encodings[name]
+        if time.monotonic() < _encodingRetries.get(name, 0):
+            return None
+        encoding = loadEncoding(name)
+        if encoding is None:
+            _encodingRetries[name] = time.monotonic() + float(os.getenv('TIKTOKEN_RETRY_SECONDS', 300))
+        else:
+            _encodings[name] = encoding
+        return encoding
+
+def loadEncoding(name):
+    """
+    Returns None when the encoder cannot be loaded (e.g. no network access to download the ranks),
+    in which case token counts are estimated from the text length.
+    """
+    try:
+        # tiktoken is only imported when the first tokens are counted
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logging.warning(f'Could not load tiktoken encoding {name}, falling back to estimated token counts: {e}')
+        return None
+
+def countTokens(text):
+    enc = getEncoding()
+    if enc is None:
+        # Roughly 4 characters per token for English text
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+def truncateToTokens(text, max_tokens):
+    """
+    Truncate the text so that it does not exceed max_tokens
+    """
+    enc = getEncoding()
+    if enc is None:
+        return text[:max_tokens * 4]
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
+class PromptPacker():
+    """
+    Packs article prompts into chunks that each fit within a token budget
+    """
+    def __init__(self, budget=None):
+        self.budget = int(budget if budget is not None else os.getenv('PROMPT_TOKEN_BUDGET', 32000))
+
+    def measure(self, texts):
+        return [countTokens(text) for text in texts]
+
+    def fits(self, texts, reserved=0):
+        return sum(self.measure(texts)) <= self.budget - reserved
+
+    def pack(self, texts, reserved=0):
+        """
+        Greedily fill chunks with the texts, in order, up to the budget minus the reserved tokens.
+        A single text larger than the budget is truncated to fit in its own chunk.
+        """
+        chunks = list(self.iterPack(texts, reserved=reserved))
+        logging.info(f'Packed articles into {len(chunks)} chunk(s) with a budget of {max(self.budget - reserved, 1)} tokens')
+        return chunks
+
+    def iterPack(self, texts, reserved=0):
+        """
+        Same as pack, but consumes the texts lazily and yields each chunk as soon as it is full
+        """
+        budget = max(self.budget - reserved, 1)
+        chunk = []
+        chunk_tokens = 0
+
+        for text in texts:
+            tokens = countTokens(text)
+            if tokens > budget:
+                logging.info(f'Truncating article from {tokens} to {budget} tokens')
+                text = truncateToTokens(text, budget)
+                tokens = budget
+
+            if chunk and chunk_tokens + tokens > budget:
+                yield chunk
+                chunk = []
+                chunk_tokens = 0
+
+            chunk.append(text)
+            chunk_tokens += tokens
+
+        if chunk:
+            yield chunk
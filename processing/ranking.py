@@ -0,0 +1,84 @@
+import re
+import logging
+from collections import Counter
+from clients.lazy import lazyImport
+
+np = lazyImport('numpy')
+
+WORD = re.compile(r'[a-z0-9]+')
+STOPWORDS = {
+    'a', 'about', 'after', 'all', 'also', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'been', 'but', 'by', 'can', 'could',
+    'do', 'for', 'from', 'generate', 'has', 'have', 'how', 'i', 'if', 'in', 'into', 'is', 'it', 'its', 'me', 'more', 'my',
+    'not', 'of', 'on', 'or', 'our', 'post', 'should', 'so', 'than', 'that', 'the', 'their', 'them', 'these', 'they', 'this',
+    'to', 'up', 'us', 'was', 'we', 'were', 'what', 'when', 'which', 'who', 'will', 'with', 'write', 'you', 'your'
+}
+
+def tokenise(text):
+    return [word for word in WORD.findall(text.lower()) if len(word) > 1 and word not in STOPWORDS]
+
+def termCounts(text, columns):
+    """
+    Return the number of words of a text and how many times each query term, indexed by columns, appears in it
+    """
+    words = tokenise(text)
+    counts = np.zeros(len(columns))
+    for term, count in Counter(word for word in words if word in columns).items():
+        counts[columns[term]] = count
+    return len(words), counts
+
+def bm25Scores(tf, lengths, k1=1.5, b=0.75):
+    """
+    Return the Okapi BM25 score of each document from the counts of the query terms in it, one row
+    per document and one column per term, and the number of words of each document
+    """
+    if not len(tf):
+        return np.zeros(0)
+    df = (tf > 0).sum(axis=0)
+    idf = np.log((len(tf) - df + 0.5) / (df + 0.5) + 1)
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1))
+    return (idf * tf * (k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+
+def rankArticles(articles, query, top_k=0, budget=0, measure=None):
+    """
+    Return the articles most relevant to the query, best first: at most top_k of them and,
+    if a budget and a measure of the prompt of an article are given, only as many as fit the token budget.
+
+    The relevance of an article depends on how common the query terms are in the whole window, so every article
+    is read before the first one is returned. Only the counts of the query terms are kept besides the articles.
+    Without a query the articles are passed through as they arrive.
+    """
+    terms = sorted(set(tokenise(query or '')))
+    if not terms:
+        return articles
+
+    columns = {term: column for column, term in enumerate(terms)}
+    kept = []
+    rows = []
+    lengths = []
+    for article in articles:
+        # The title counts twice as it is the best summary of the article
+        length, counts = termCounts(f'{article["title"]} {article["title"]} {article["summary"]} {article["content"]}', columns)
+        kept.append(article)
+        rows.append(counts)
+        lengths.append(length)
+    if not kept:
+        return kept
+
+    scores = bm25Scores(np.array(rows), np.array(lengths, dtype=float))
+    # Stable sort so that articles with the same score keep the Feedly order
+    order = np.argsort(-scores, kind='stable')
+
+    ranked = []
+    used = 0
+    for index in order:
+        if top_k > 0 and len(ranked) >= top_k:
+            break
+        if budget > 0 and measure is not None:
+            tokens = measure(kept[index])
+            if used + tokens > budget and ranked:
+                continue
+            used += tokens
+        ranked.append(kept[index])
+
+    logging.info(f'Kept the {len(ranked)} most relevant of {len(kept)} articles (best score {scores[order[0]]:.2f})')
+    return ranked